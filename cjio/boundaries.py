@@ -0,0 +1,226 @@
+"""Flat representation of the boundaries of the geometries
+
+The nested "boundaries" arrays are flattened to one array with the vertex
+indices, plus the lengths of the arrays at each level (rings, surfaces,
+shells, solids). The operations on the vertex indices (remapping, finding the
+vertices used...) are then array operations, and the nested arrays are built
+back for the JSON.
+"""
+from itertools import chain
+
+MODULE_NUMPY_AVAILABLE = True
+try:
+    import numpy as np
+except ImportError as e:
+    MODULE_NUMPY_AVAILABLE = False
+
+#-- depth of the nested "boundaries", per geometry type
+DEPTH = {
+    'MultiPoint': 1,
+    'MultiLineString': 2,
+    'MultiSurface': 3,
+    'CompositeSurface': 3,
+    'Solid': 4,
+    'MultiSolid': 5,
+    'CompositeSolid': 5,
+    'GeometryInstance': 1
+}
+
+
+def flatten(boundaries, depth):
+    """Flatten nested boundaries
+
+    :param boundaries: The nested arrays
+    :param depth: Their depth (eg 3 for a MultiSurface)
+    :return: A tuple with the list of vertex indices, and for each level (the
+        outer one first) the list of the lengths of the arrays
+    :raises: TypeError if the arrays are not as deep as expected
+    """
+    level = boundaries
+    lengths = []
+    for _ in range(depth - 1):
+        lengths.append([len(a) for a in level])
+        level = list(chain.from_iterable(level))
+    return (level, lengths)
+
+
+def unflatten(level, lengths):
+    """Build back the nested boundaries from the output of flatten()"""
+    for ls in reversed(lengths):
+        nested = []
+        i = 0
+        for n in ls:
+            nested.append(level[i:i + n])
+            i += n
+        level = nested
+    return level
+
+
+def _leaves(a, out):
+    for each in a:
+        if isinstance(each, list):
+            _leaves(each, out)
+        else:
+            out.append(each)
+
+
+def _replace_leaves(a, it):
+    return [_replace_leaves(each, it) if isinstance(each, list) else next(it) for each in a]
+
+
+def collect(j):
+    """Gather the geometries of the CityObjects, and the ID of their CityObject"""
+    geometries = []
+    owners = []
+    for theid, co in j["CityObjects"].items():
+        for g in co.get("geometry", []):
+            geometries.append(g)
+            owners.append(theid)
+    return (geometries, owners)
+
+
+def _to_indices(levels):
+    try:
+        a = np.array(list(chain.from_iterable(levels)))
+    except ValueError:
+        return None
+    if a.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    if a.dtype.kind not in 'iu':
+        return None
+    return a.astype(np.int64)
+
+
+class BoundaryIndex:
+    """Flat index of the vertex indices of a list of geometries
+
+    ``flat`` holds the vertex indices of all the geometries one after the
+    other, those of the geometry ``i`` being ``flat[offsets[i]:offsets[i+1]]``.
+    After modifying the indices, update() writes them back in the
+    "boundaries" of the geometries.
+    """
+
+    def __init__(self, geometries, owners=None):
+        self.geometries = list(geometries)
+        self.owners = owners
+        self._boundaries = [g["boundaries"] for g in self.geometries]
+        self.lengths = []
+        levels = []
+        for g in self.geometries:
+            depth = DEPTH.get(g.get("type"))
+            lengths = None
+            if depth is not None:
+                try:
+                    level, lengths = flatten(g["boundaries"], depth)
+                except TypeError:
+                    lengths = None
+            if lengths is None:
+                #-- not nested as its type says, keep its structure as is
+                level = []
+                _leaves(g["boundaries"], level)
+            levels.append(level)
+            self.lengths.append(lengths)
+        sizes = np.fromiter((len(l) for l in levels), dtype=np.int64, count=len(levels))
+        self.offsets = np.zeros(len(levels) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=self.offsets[1:])
+        flat = _to_indices(levels)
+        if flat is None:
+            #-- arrays deeper than their type says are not caught by flatten()
+            for i, level in enumerate(levels):
+                if self.lengths[i] is not None and any(isinstance(each, list) for each in level):
+                    levels[i] = []
+                    _leaves(self.geometries[i]["boundaries"], levels[i])
+                    self.lengths[i] = None
+            flat = _to_indices(levels)
+            if flat is None:
+                raise ValueError("Boundaries must contain only vertex indices")
+        self.flat = flat
+        #-- incremented when the indices are replaced, see update()
+        self.version = 0
+        #-- the "boundaries" of the geometries are not written yet
+        self.pending = False
+
+    @classmethod
+    def from_flat(cls, geometries, owners, flat, offsets, lengths, write=True):
+        """Make the index from the arrays of another one, see update()
+
+        The "boundaries" of the geometries are built from flat; those of the
+        geometries without lengths (not nested as their type says) must be
+        there, their indices are replaced.
+
+        :param write: If False, the "boundaries" are only written by the next
+            update() (e.g. with the indices shifted), so that they are built
+            once; until then ``pending`` is True and the geometries must not
+            be read
+        """
+        bi = cls.__new__(cls)
+        bi.geometries = list(geometries)
+        bi.owners = owners
+        bi._boundaries = [g.get("boundaries") for g in bi.geometries]
+        bi.lengths = lengths
+        bi.offsets = offsets
+        bi.version = 0
+        if write:
+            bi.update(flat)
+        else:
+            bi.flat = flat
+            bi.pending = True
+        return bi
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def is_current(self, geometries):
+        """Are these the same geometries, with the same "boundaries" arrays?"""
+        if len(geometries) != len(self.geometries):
+            return False
+        for g, g2, b in zip(geometries, self.geometries, self._boundaries):
+            if (g is not g2) or (g["boundaries"] is not b):
+                return False
+        return True
+
+    def geometry_ids(self):
+        """For each index in flat, the index of its geometry"""
+        return np.repeat(np.arange(len(self.geometries)), np.diff(self.offsets))
+
+    def geometry_indices(self, i):
+        return self.flat[self.offsets[i]:self.offsets[i + 1]]
+
+    def owner_ranges(self):
+        """For each owner (CityObject) its (id, start, end) range in flat
+
+        The geometries of one CityObject must be next to each other, as
+        collect() returns them.
+        """
+        ranges = []
+        for i, owner in enumerate(self.owners):
+            if len(ranges) > 0 and ranges[-1][0] == owner:
+                ranges[-1][2] = int(self.offsets[i + 1])
+            else:
+                ranges.append([owner, int(self.offsets[i]), int(self.offsets[i + 1])])
+        return [tuple(r) for r in ranges]
+
+    def vertices_in_order(self):
+        """The vertex indices used, in the order they first appear"""
+        u, first = np.unique(self.flat, return_index=True)
+        return u[np.argsort(first)]
+
+    def remap(self, newids):
+        """Replace each vertex index i by newids[i]"""
+        self.update(np.asarray(newids)[self.flat])
+
+    def update(self, flat):
+        """Replace the vertex indices, and write them in the geometries"""
+        self.flat = flat
+        self.version += 1
+        self.pending = False
+        level = flat.tolist()
+        offsets = self.offsets.tolist()
+        for i, g in enumerate(self.geometries):
+            part = level[offsets[i]:offsets[i + 1]]
+            if self.lengths[i] is None:
+                b = _replace_leaves(g["boundaries"], iter(part))
+            else:
+                b = unflatten(part, self.lengths[i])
+            g["boundaries"] = b
+            self._boundaries[i] = b
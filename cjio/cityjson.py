@@ -5,13 +5,16 @@ import shutil
 
 import json
 import collections
-import jsonref
+import functools
 from pkg_resources import resource_filename
 from pkg_resources import resource_listdir
 import copy
+import hashlib
 import random
-from io import StringIO
-from sys import platform
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from io import StringIO, BytesIO
 from click import progressbar
 from datetime import datetime, date
 
@@ -37,7 +40,7 @@ try:
 except ImportError as e:
     MODULE_PANDAS_AVAILABLE = False
 
-from cjio import validation, subset, geom_help, convert, models
+from cjio import validation, subset, geom_help, convert, models, streaming, vertices, boundaries, spatial, triangulation, tiling
 from cjio.errors import InvalidOperation
 from cjio.utils import print_cmd_warning
 from cjio.metadata import generate_metadata
@@ -60,6 +63,44 @@ TOPLEVEL = ('Building',
             'Tunnel',
             'WaterBody')
 
+#-- number of vertices reprojected at once
+REPROJECT_CHUNK_SIZE = 100000
+
+#-- number of lines (OBJ) or facets (STL) written at once
+EXPORT_CHUNK_SIZE = 10000
+
+#-- a facet of a binary STL file: normal, 3 vertices, attribute byte count
+STL_FACET = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')]) if MODULE_NUMPY_AVAILABLE else None
+
+_transformers = threading.local()
+
+def get_transformer(epsg_from, epsg_to):
+    """Get a pyproj Transformer between two EPSG codes
+
+    The Transformers are created once per pair of EPSG codes and per thread
+    (they are not meant to be shared between threads). The axis order is
+    always x/y, or lon/lat.
+    """
+    if not hasattr(_transformers, 'cache'):
+        _transformers.cache = {}
+    key = (int(epsg_from), int(epsg_to))
+    if key not in _transformers.cache:
+        _transformers.cache[key] = pyproj.Transformer.from_crs(
+            'EPSG:%d' % key[0], 'EPSG:%d' % key[1], always_xy=True)
+    return _transformers.cache[key]
+
+def keeping_vertices(method):
+    """Run a method of CityJSON in a keep_vertices() block
+
+    For the methods converting the vertices several times, directly or with
+    the other methods.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.keep_vertices():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 def load(path, transform:bool=False):
     """Load a CityJSON file for working with it though the API
 
@@ -135,9 +176,112 @@ def save(citymodel, path: str, indent: bool = False):
     except IOError as e:
         raise IOError('Invalid output file: %s \n%s' % (path, e))
 
+def lod_key(lod):
+    """The LoD of a geometry as a string that can be compared
+
+    The LoD is a number in CityJSON v1.0 and a string in v1.1, so 2, 2.0 and
+    "2" all give "2", and 2.2 and "2.2" give "2.2". No LoD gives None.
+    """
+    if lod is None:
+        return None
+    try:
+        f = float(lod)
+    except (TypeError, ValueError):
+        return str(lod).strip()
+    if f.is_integer():
+        return str(int(f))
+    return repr(f)
+
+def geometry_lod(j, g):
+    """The lod_key() of a geometry of the city model j
+
+    A GeometryInstance has the LoD of its template.
+    """
+    if g["type"] == "GeometryInstance":
+        try:
+            return lod_key(j["geometry-templates"]["templates"][g["template"]].get("lod"))
+        except (KeyError, IndexError, TypeError):
+            return None
+    return lod_key(g.get("lod"))
+
+def _write_tile(path, j, triangles, quantize, normals):
+    glb = convert.to_glb(j, triangles=triangles, quantize=quantize, normals=normals)
+    b3dm = convert.to_b3dm(CityJSON(j=j), glb)
+    with open(path, 'wb') as fout:
+        fout.write(b3dm.getvalue())
+
+
 def reader(file, ignore_duplicate_keys=False):
     return CityJSON(file=file, ignore_duplicate_keys=ignore_duplicate_keys)
 
+def iter_cityobjects(path, ignore_duplicate_keys=False):
+    """Iterate over the CityObjects of a file without loading all of it
+
+    Only one CityObject at a time is decoded, use a
+    :class:`cjio.streaming.CityJSONStream` to also get the other root properties
+    (vertices, transform, metadata).
+
+    :param path: Path to a CityJSON file
+    :return: A generator of (id, CityObject) pairs
+    """
+    return streaming.CityJSONStream(path, ignore_duplicate_keys).iter_cityobjects()
+
+def header_of_stream(stream, vertices=True):
+    """A CityJSON with the root properties of a streaming.CityJSONStream
+
+    Its "CityObjects" are empty, they are to be read one at a time.
+
+    :param vertices: Whether to decode the vertices too
+    """
+    j = stream.header()
+    j["CityObjects"] = {}
+    j["vertices"] = stream.vertices if vertices else []
+    cm = CityJSON(j=j)
+    cm.path = os.path.abspath(stream.path)
+    cm.reference_date = datetime.fromtimestamp(os.path.getmtime(stream.path)).strftime('%Y-%m-%d')
+    return cm
+
+def get_info_stream(stream, long=False):
+    """get_info() of a streaming.CityJSONStream
+
+    The CityObjects are decoded one at a time; the vertices only if they are
+    counted (long) or if there is no "geographicalExtent" for the bbox.
+    """
+    needed = long or ("geographicalExtent" not in (stream.metadata or {}))
+    cm = header_of_stream(stream, vertices=needed)
+    return cm.get_info(long, cityobjects=stream.iter_cityobjects())
+
+def get_subset_ids_stream(stream, lsIDs, exclude=False):
+    """get_subset_ids() of a streaming.CityJSONStream
+
+    The CityObjects are read twice, one at a time: first to keep their links
+    (children, parent, members) and select the IDs, then to keep only those
+    selected. Only the vertices they use are decoded (with NumPy, otherwise
+    all of them), then the templates and appearance of the file are subset
+    as get_subset_ids() does.
+    """
+    links = {}
+    for theid, co in stream.iter_cityobjects():
+        links[theid] = {k: co[k] for k in ("type", "children", "parent", "members") if k in co}
+    re = subset.select_co_ids({"CityObjects": links}, lsIDs)
+    if exclude == True:
+        re = set(links) ^ re
+    del links
+    cm = header_of_stream(stream, vertices=not MODULE_NUMPY_AVAILABLE)
+    for theid, co in stream.iter_cityobjects():
+        if theid in re:
+            cm.j["CityObjects"][theid] = co
+    if MODULE_NUMPY_AVAILABLE:
+        #-- the vertices used, numbered in the same order
+        bi = boundaries.BoundaryIndex(*boundaries.collect(cm.j))
+        used = np.unique(bi.flat)
+        if len(used) > 0 and used[0] < 0:
+            raise IndexError("vertex #%d doesn't exist" % used[0])
+        bi.update(np.searchsorted(used, bi.flat))
+        cm.j["vertices"] = stream.vertices_at(used.tolist())
+    #-- all the CityObjects left are selected
+    return cm.get_subset_ids(list(cm.j["CityObjects"]))
+
 def off2cj(file):
     l = file.readline()
     # print(l)
@@ -212,6 +356,18 @@ def poly2cj(file):
 class CityJSON:
 
     def __init__(self, file=None, j=None, ignore_duplicate_keys=False):
+        #-- array of the vertices, and the list it was made from
+        self._vertices = None
+        self._vertices_src = None
+        #-- depth of the keep_vertices() blocks
+        self._keep_vertices = 0
+        #-- incremented when the vertices are modified by the methods
+        self._vertices_version = 0
+        self._boundary_index = None
+        self._spatial_index = None
+        self._spatial_state = None
+        self._cityobject_graph = None
+        self._triangulation = None
         if file is not None:
             self.read(file, ignore_duplicate_keys)
             self.path = os.path.abspath(file.name)
@@ -237,6 +393,15 @@ class CityJSON:
         return self.get_info()
 
 
+    def __getstate__(self):
+        #-- a copy is not in the keep_vertices() blocks of the original
+        state = dict(self.__dict__)
+        state["_keep_vertices"] = 0
+        state["_vertices"] = None
+        state["_vertices_src"] = None
+        return state
+
+
     ##-- API functions
     # TODO BD: refactor this whole CityJSON class
     def get_cityobjects(self, type=None, id=None):
@@ -264,7 +429,8 @@ class CityJSON:
                 id_list = id
             else:
                 raise TypeError("'id' must be a string or list of strings")
-            return {i:co for i,co in self.cityobjects.items() if co.id in id_list}
+            id_set = set(id_list)
+            return {i:co for i,co in self.cityobjects.items() if co.id in id_set}
 
 
     def set_cityobjects(self, cityobjects):
@@ -306,6 +472,191 @@ class CityJSON:
 
     ##-- end API functions
 
+    def get_vertices_array(self):
+        """Return the vertices as an (N, 3) NumPy array
+
+        j["vertices"] is converted at each call, since it can be modified in
+        place. Within a keep_vertices() block the array is kept and reused
+        as long as j["vertices"] is not replaced or resized. If you modify
+        the array, write it back with set_vertices_array().
+        """
+        if not MODULE_NUMPY_AVAILABLE:
+            raise ModuleNotFoundError("Modul 'numpy' is not available, please install it")
+        vs = self.j["vertices"]
+        if ((self._keep_vertices == 0) or (self._vertices is None) or (self._vertices_src is not vs) or
+            (len(self._vertices) != len(vs))):
+            self._vertices = vertices.to_array(vs, self.j.get("transform"))
+            self._vertices_src = vs
+        return self._vertices
+
+
+    def set_vertices_array(self, a):
+        """Replace the vertices with an (N, 3) NumPy array, j["vertices"] is updated"""
+        self.j["vertices"] = a.tolist()
+        self._vertices = a
+        self._vertices_src = self.j["vertices"]
+        self._vertices_version += 1
+
+
+    def _vertices_modified(self):
+        #-- j["vertices"] modified in place: the array kept is not valid
+        self._vertices = None
+        self._vertices_src = None
+        self._vertices_version += 1
+
+
+    @contextmanager
+    def keep_vertices(self):
+        """Reuse the array of the vertices in a block, see get_vertices_array()
+
+        In the block, j["vertices"] must not be modified in place, only
+        replaced (or with set_vertices_array()). The array is dropped at the
+        end of the outermost block.
+        """
+        self._keep_vertices += 1
+        try:
+            yield self
+        finally:
+            self._keep_vertices -= 1
+            if self._keep_vertices == 0:
+                self._vertices = None
+                self._vertices_src = None
+
+
+    def get_boundary_index(self):
+        """Return the flat index of the boundaries of the CityObjects
+
+        See boundaries.BoundaryIndex. It is reused as long as the geometries and
+        their "boundaries" arrays are the same objects, so boundaries modified
+        in place are not noticed: replace them instead.
+        """
+        if not MODULE_NUMPY_AVAILABLE:
+            raise ModuleNotFoundError("Modul 'numpy' is not available, please install it")
+        geometries, owners = boundaries.collect(self.j)
+        bi = self._boundary_index
+        if (bi is None) or (bi.owners != owners) or (not bi.is_current(geometries)):
+            bi = boundaries.BoundaryIndex(geometries, owners)
+            self._boundary_index = bi
+        return bi
+
+
+    def _spatial_key(self):
+        #-- identifies the vertices and the boundaries used for the centroids,
+        #-- to check the index saved next to the file
+        h = hashlib.sha1()
+        v = np.ascontiguousarray(self.get_vertices_array())
+        h.update(str(v.dtype).encode())
+        h.update(v.tobytes())
+        h.update(json.dumps(self.j.get("transform"), sort_keys=True).encode())
+        bi = self.get_boundary_index()
+        h.update(json.dumps(bi.owners).encode())
+        h.update(bi.offsets.astype(np.int64).tobytes())
+        h.update(bi.flat.astype(np.int64).tobytes())
+        return h.hexdigest()
+
+
+    def _spatial_current(self, state):
+        #-- the vertices, the boundaries and the transform are those indexed
+        vs, n, version, bi, biversion, transform = state
+        return ((vs is self.j["vertices"]) and (n == len(vs)) and (version == self._vertices_version) and
+                (bi is self.get_boundary_index()) and (biversion == bi.version) and
+                (transform == self.j.get("transform")))
+
+
+    @keeping_vertices
+    def get_spatial_index(self, sidecar=False):
+        """Return the spatial index of the centroids of the CityObjects
+
+        See spatial.SpatialIndex. It is kept until the vertices or the
+        boundaries are modified by the methods of CityJSON, j["vertices"] or
+        the "transform" are replaced, or the geometries or their "boundaries"
+        arrays are replaced (see get_boundary_index()). Modifying them in
+        place is not noticed.
+
+        :param sidecar: Read the index from the file next to the CityJSON file
+            (see spatial.sidecar_path()) if it is there and still valid, and
+            write it there when it's built; the content of the city model is
+            then hashed to check it
+        """
+        if not MODULE_NUMPY_AVAILABLE:
+            raise ModuleNotFoundError("Modul 'numpy' is not available, please install it")
+        si = self._spatial_index
+        if (si is not None) and self._spatial_current(self._spatial_state):
+            return si
+        si = None
+        sidecar = sidecar and (self.path is not None)
+        key = self._spatial_key() if sidecar else None
+        if sidecar:
+            si = spatial.SpatialIndex.load(spatial.sidecar_path(self.path), key)
+        if si is None:
+            ids, pts = spatial.centroids(self.get_boundary_index(), self.get_vertices_array(), self.j.get("transform"))
+            si = spatial.SpatialIndex(ids, pts, key)
+            if sidecar:
+                try:
+                    si.save(spatial.sidecar_path(self.path))
+                except OSError:
+                    print_cmd_warning("Cannot write the spatial index to %s" % spatial.sidecar_path(self.path))
+        bi = self.get_boundary_index()
+        self._spatial_index = si
+        self._spatial_state = (self.j["vertices"], len(self.j["vertices"]), self._vertices_version,
+                               bi, bi.version, copy.deepcopy(self.j.get("transform")))
+        return si
+
+
+    def get_cityobject_graph(self):
+        """Return the children/parent/members of the CityObjects
+
+        See subset.CityObjectGraph, it is rebuilt when j["CityObjects"] is
+        replaced or resized.
+        """
+        g = self._cityobject_graph
+        if (g is None) or (not g.is_current(self.j["CityObjects"])):
+            g = subset.CityObjectGraph(self.j["CityObjects"])
+            self._cityobject_graph = g
+        return g
+
+
+    @keeping_vertices
+    def get_triangulation(self, jobs=1, sidecar=False):
+        """Return the triangles of the faces of all the geometries
+
+        See triangulation.Triangulation. Only the geometries that have changed
+        since the last call are triangulated again. The faces are triangulated
+        in the real coordinates, translated to the minx,miny of the vertices.
+
+        :param jobs: The number of processes triangulating
+        :param sidecar: Reuse the triangles kept in the file next to the
+            CityJSON file (see triangulation.sidecar_path()), and keep the new
+            ones there
+        :return: A tuple (triangles, normals, offsets) as
+            geom_help.triangulate_geometries(), for the geometries in the order
+            of boundaries.collect()
+        """
+        if not MODULE_NUMPY_AVAILABLE:
+            raise ModuleNotFoundError("Modul 'numpy' is not available, please install it")
+        if self._triangulation is None:
+            self._triangulation = triangulation.Triangulation()
+        tr = self._triangulation
+        sidecar = sidecar and (self.path is not None)
+        if sidecar and (tr.path != triangulation.sidecar_path(self.path)):
+            tr.read(triangulation.sidecar_path(self.path))
+        coords = self.get_vertices_array().astype(np.float64)
+        if "transform" in self.j:
+            coords = (coords * np.array(self.j["transform"]["scale"])) + np.array(self.j["transform"]["translate"])
+        #-- translate to minx,miny
+        vnp = coords.copy()
+        if len(vnp) > 0:
+            vnp[:, :2] -= vnp[:, :2].min(axis=0)
+        #-- the hash of the geometries doesn't depend on the minx,miny
+        result = tr.get(self.get_boundary_index(), vnp, jobs, coords=coords)
+        if sidecar and tr.modified:
+            try:
+                tr.save(triangulation.sidecar_path(self.path))
+            except OSError:
+                print_cmd_warning("Cannot write the triangles to %s" % triangulation.sidecar_path(self.path))
+        return result
+
+
     def get_version(self):
         return self.j["version"]
 
@@ -364,18 +715,11 @@ class CityJSON:
                 return (False, None, '')
         else:
             schema = os.path.join(folder_schemas, 'cityjson.schema.json')  
-        #-- open the schema
+        #-- open the schema (resolved once, then reused)
         try:
-            fins = open(schema)
-        except: 
+            js = validation.load_schema(schema)
+        except OSError:
             return (False, None, '')
-        abs_path = os.path.abspath(os.path.dirname(schema))
-        #-- because Windows uses \ and not /        
-        if platform == "darwin" or platform == "linux" or platform == "linux2":
-            base_uri = 'file://{}/'.format(abs_path)
-        else:
-            base_uri = 'file:///{}/'.format(abs_path.replace('\\', '/'))
-        js = jsonref.loads(fins.read(), jsonschema=True, base_uri=base_uri)
         if v == "-1":
             v = schema
         return (True, js, v)
@@ -395,13 +739,7 @@ class CityJSON:
             schema = os.path.join(folder_schemas, 'cityjson.schema.json')  
         abs_path = os.path.abspath(os.path.dirname(schema))
         sco_path = abs_path + '/cityobjects.schema.json'
-        #-- because Windows uses \ and not /        
-        if platform == "darwin" or platform == "linux" or platform == "linux2":
-            base_uri = 'file://{}/'.format(abs_path)
-        else:
-            base_uri = 'file:///{}/'.format(abs_path.replace('\\', '/'))
-        jsco = jsonref.loads(open(sco_path).read(), jsonschema=True, base_uri=base_uri)
-        # jsco = json.loads(open(sco_path).read())
+        jsco = validation.load_schema(sco_path)
         return (True, jsco)
 
 
@@ -434,20 +772,14 @@ class CityJSON:
             schemapath = os.path.join(base_uri, s)
             if os.path.isfile(schemapath) == False:
                 return (False, ["Schema file '%s' can't be found" % s])
-            js = json.loads(open(schemapath).read())
+            #-- the file is resolved once, its validators are reused
+            js = validation.load_schema(schemapath)
 
             #-- 1. extraCityObjects
             if "extraCityObjects" in js:
                 for nco in js["extraCityObjects"]:
                     allnewco.add(nco)
-                    jtmp = {}
-                    jtmp["$schema"] = "http://json-schema.org/draft-07/schema#"
-                    jtmp["type"] = "object"
-                    if platform == "darwin" or platform == "linux" or platform == "linux2":
-                        jtmp["$ref"] = "file://%s#/extraCityObjects/%s" % (schemapath, nco)
-                    else:
-                        jtmp["$ref"] = "file:\\%s#/extraCityObjects/%s" % (schemapath, nco)
-                    jsotf = jsonref.loads(json.dumps(jtmp), jsonschema=True, base_uri=base_uri)
+                    jsotf = js["extraCityObjects"][nco]
                     for theid in self.j["CityObjects"]:
                         if self.j["CityObjects"][theid]["type"] == nco:
                             nco1 = self.j["CityObjects"][theid]
@@ -459,14 +791,7 @@ class CityJSON:
             #-- 2. extraRootProperties
             if "extraRootProperties" in js:
                 for nrp in js["extraRootProperties"]:
-                    jtmp = {}
-                    jtmp["$schema"] = "http://json-schema.org/draft-07/schema#"
-                    jtmp["type"] = "object"
-                    if platform == "darwin" or platform == "linux" or platform == "linux2":
-                        jtmp["$ref"] = "file://%s#/extraRootProperties/%s" % (schemapath, nrp)
-                    else:
-                        jtmp["$ref"] = "file:\\%s#/extraRootProperties/%s" % (schemapath, nrp)
-                    jsotf = jsonref.loads(json.dumps(jtmp), jsonschema=True, base_uri=base_uri)
+                    jsotf = js["extraRootProperties"][nrp]
                     for p in self.j:
                         if p == nrp:
                             thep = self.j[p]
@@ -479,14 +804,7 @@ class CityJSON:
             if "extraAttributes" in js:
                 for thetype in js["extraAttributes"]:
                     for ea in js["extraAttributes"][thetype]:
-                        jtmp = {}
-                        jtmp["$schema"] = "http://json-schema.org/draft-07/schema#"
-                        jtmp["type"] = "object"
-                        if platform == "darwin" or platform == "linux" or platform == "linux2":
-                            jtmp["$ref"] = "file://%s#/extraAttributes/%s/%s" % (schemapath, thetype, ea)
-                        else:
-                            jtmp["$ref"] = "file:\\%s#/extraAttributes/%s/%s" % (schemapath, thetype, ea)
-                        jsotf = jsonref.loads(json.dumps(jtmp), jsonschema=True, base_uri=base_uri)
+                        jsotf = js["extraAttributes"][thetype][ea]
                         for theid in self.j["CityObjects"]:
                             if ( (self.j["CityObjects"][theid]["type"] == thetype) and 
                                  ("attributes" in self.j["CityObjects"][theid])    and
@@ -509,7 +827,7 @@ class CityJSON:
         return (isValid, es)
 
 
-    def validate(self, skip_schema=False, folder_schemas=None, longerr=False):
+    def validate(self, skip_schema=False, folder_schemas=None, longerr=False, jobs=1):
         #-- only latest version, otherwise a mess with versions and different schemas
         #-- this is it, sorry people
         if (self.j["version"] != CITYJSON_VERSIONS_SUPPORTED[-1]):
@@ -524,7 +842,7 @@ class CityJSON:
                 return (False, True, ["Can't find the schema."], [])
             else:
                 print ('\t(using the schemas %s)' % (v))
-                isValid, errs = validation.validate_against_schema(self.j, js, longerr)
+                isValid, errs = validation.validate_against_schema(self.j, js, longerr, jobs=jobs)
                 if (isValid == False):
                     es += errs
                     return (False, True, es, [])
@@ -559,57 +877,18 @@ class CityJSON:
             if b == False:
                 isValid = False
                 es += errs
-        #-- for v0.7+ (where the parent-child concept was introduced)                
-        else:
-            b, errs = validation.parent_children_consistency(self.j)
-            if b == False:
-                isValid = False
-                es += errs
-
-        print("\t--Vertex indices coherent")
-        b, errs = validation.wrong_vertex_index(self.j)
-        if b == False:
-            isValid = False
-            es += errs
-        print("\t--Specific for CityGroups")
-        b, errs = validation.city_object_groups(self.j) 
-        if b == False:
-            isValid = False
-            es += errs
-        print("\t--Semantic arrays coherent with geometry")
-        b, errs = validation.semantics_array(self.j)
+        #-- and 4. WARNINGS
+        if skip_schema == True:
+            b, js, v = self.fetch_schema(folder_schemas)
+        b, jsco = self.fetch_schema_cityobjects(folder_schemas)
+        #-- all the checks in one pass over the CityObjects
+        #-- (parent-child concept introduced in v0.7)
+        b, woWarnings, errs, ws = validation.internal_consistency(self.j, js, jsco,
+                                      parent_children=(float(self.j["version"]) != 0.6),
+                                      report=lambda check: print("\t--" + check))
         if b == False:
             isValid = False
             es += errs
-        #-- 4. WARNINGS
-        woWarnings = True
-        print("\t--Root properties")
-        b, errs = validation.cityjson_properties(self.j, js)
-        if b == False:
-            woWarnings = False
-            ws += errs
-        print("\t--Empty geometries")
-        b, errs = validation.geometry_empty(self.j)
-        if b == False:
-            woWarnings = False
-            ws += errs
-        print("\t--Duplicate vertices")
-        b, errs = validation.duplicate_vertices(self.j)
-        if b == False:
-            woWarnings = False
-            ws += errs
-        print("\t--Orphan vertices")
-        b, errs = validation.orphan_vertices(self.j)
-        if b == False:
-            woWarnings = False
-            ws += errs
-        #-- fetch schema cityobjects.json
-        print("\t--CityGML attributes")
-        b, jsco = self.fetch_schema_cityobjects(folder_schemas)
-        b, errs = validation.citygml_attributes(self.j, jsco)
-        if b == False:
-            woWarnings = False
-            ws += errs
         # TODO: validate address attributes?
         return (isValid, woWarnings, es, ws)
 
@@ -628,8 +907,12 @@ class CityJSON:
         """
         if len(self.j["vertices"]) == 0:
             return [0, 0, 0, 0, 0, 0]
-        x, y, z = zip(*self.j["vertices"])
-        bbox = [min(x), min(y), min(z), max(x), max(y), max(z)]
+        if MODULE_NUMPY_AVAILABLE:
+            v = self.get_vertices_array()
+            bbox = v.min(axis=0).tolist() + v.max(axis=0).tolist()
+        else:
+            x, y, z = zip(*self.j["vertices"])
+            bbox = [min(x), min(y), min(z), max(x), max(y), max(z)]
         if "transform" in self.j:
             s = self.j["transform"]["scale"]
             t = self.j["transform"]["translate"]
@@ -687,6 +970,28 @@ class CityJSON:
                 recusionvisit(each, vs)
             else:
                 vs.append(each)
+        if MODULE_NUMPY_AVAILABLE:
+            bi = self.get_boundary_index()
+            ranges = bi.owner_ranges()
+            for co, start, end in ranges:
+                if start == end:
+                    self.j["CityObjects"][co]["geographicalExtent"] = [9e9, 9e9, 9e9, -9e9, -9e9, -9e9]
+            #-- the indices of a CityObject are contiguous in the index
+            ranges = [r for r in ranges if r[2] > r[1]]
+            if len(ranges) == 0:
+                return
+            pts = self.get_vertices_array()[bi.flat]
+            starts = np.array([r[1] for r in ranges])
+            mins = np.minimum.reduceat(pts, starts, axis=0).tolist()
+            maxs = np.maximum.reduceat(pts, starts, axis=0).tolist()
+            for (co, start, end), bmin, bmax in zip(ranges, mins, maxs):
+                bbox = bmin + bmax
+                if "transform" in self.j:
+                    s = self.j["transform"]["scale"]
+                    t = self.j["transform"]["translate"]
+                    bbox = [a * b + c for a, b, c in zip(bbox, (s + s), (t + t))]
+                self.j["CityObjects"][co]["geographicalExtent"] = bbox
+            return
         for co in self.j["CityObjects"]:
             vs = []
             bbox = [9e9, 9e9, 9e9, -9e9, -9e9, -9e9]    
@@ -718,15 +1023,26 @@ class CityJSON:
         #-- find the 3D centroid
         centroid = [0, 0, 0]
         total = 0
-        for g in self.j['CityObjects'][coid]['geometry']:
-            vs = []
-            recusionvisit(g["boundaries"], vs)
-            for each in vs:
-                v = self.j["vertices"][each]
-                total += 1
-                centroid[0] += v[0]
-                centroid[1] += v[1]
-                centroid[2] += v[2]
+        if MODULE_NUMPY_AVAILABLE:
+            vs = boundaries.BoundaryIndex(self.j['CityObjects'][coid]['geometry']).flat
+            total = len(vs)
+            if total != 0:
+                if self._keep_vertices > 0:
+                    rows = self.get_vertices_array()[vs]
+                else:
+                    #-- only the vertices of the CityObject are converted
+                    rows = vertices.to_array([self.j["vertices"][i] for i in vs.tolist()])
+                centroid = rows.sum(axis=0).tolist()
+        else:
+            for g in self.j['CityObjects'][coid]['geometry']:
+                vs = []
+                recusionvisit(g["boundaries"], vs)
+                for each in vs:
+                    v = self.j["vertices"][each]
+                    total += 1
+                    centroid[0] += v[0]
+                    centroid[1] += v[1]
+                    centroid[2] += v[2]
         if (total != 0):
             centroid[0] /= total
             centroid[1] /= total
@@ -778,7 +1094,8 @@ class CityJSON:
         
         return self.get_identifier()
 
-    def get_subset_bbox(self, bbox, exclude=False):
+    @keeping_vertices
+    def get_subset_bbox(self, bbox, exclude=False, sidecar=False):
         # print ('get_subset_bbox')
         #-- new sliced CityJSON object
         cm2 = CityJSON()
@@ -787,14 +1104,17 @@ class CityJSON:
         if "transform" in self.j:
             cm2.j["transform"] = self.j["transform"]
         re = set()            
-        for coid in self.j["CityObjects"]:
-            centroid = self.get_centroid(coid)
-            if ((centroid is not None) and
-                (centroid[0] >= bbox[0]) and
-                (centroid[1] >= bbox[1]) and
-                (centroid[0] <  bbox[2]) and
-                (centroid[1] <  bbox[3]) ):
-                re.add(coid)
+        if MODULE_NUMPY_AVAILABLE:
+            re.update(self.get_spatial_index(sidecar=sidecar).query(bbox))
+        else:
+            for coid in self.j["CityObjects"]:
+                centroid = self.get_centroid(coid)
+                if ((centroid is not None) and
+                    (centroid[0] >= bbox[0]) and
+                    (centroid[1] >= bbox[1]) and
+                    (centroid[0] <  bbox[2]) and
+                    (centroid[1] <  bbox[3]) ):
+                    re.add(coid)
         re2 = copy.deepcopy(re)
         if exclude == True:
             allkeys = set(self.j["CityObjects"].keys())
@@ -891,7 +1211,7 @@ class CityJSON:
         if "transform" in self.j:
             cm2.j["transform"] = self.j["transform"]
         #-- copy selected CO to the j2
-        re = subset.select_co_ids(self.j, lsIDs)
+        re = subset.select_co_ids(self.j, lsIDs, self.get_cityobject_graph())
         if exclude == True:
             allkeys = set(self.j["CityObjects"].keys())
             re = allkeys ^ re
@@ -1119,7 +1439,17 @@ class CityJSON:
         return total
 
 
-    def get_info(self, long=False):
+    def get_info(self, long=False, cityobjects=None):
+        """The summary of the city model, as JSON
+
+        The CityObjects are gone through once, so they can be those of a
+        streaming.CityJSONStream, see get_info_stream().
+
+        :param cityobjects: The (id, CityObject) pairs, those of
+            j["CityObjects"] by default
+        """
+        if cityobjects is None:
+            cityobjects = self.j["CityObjects"].items()
         info = collections.OrderedDict()
         info["cityjson_version"] = self.get_version()
         info["epsg"] = self.get_epsg()
@@ -1130,31 +1460,23 @@ class CityJSON:
                 d.add(i)
             info["extensions"] = sorted(list(d))
         info["transform/compressed"] = "transform" in self.j
-        info["cityobjects_total"] = self.number_city_objects()
+        total = 0
         d = set()
-        for key in self.j["CityObjects"]:
-            d.add(self.j['CityObjects'][key]['type'])
-        info["cityobjects_present"] = sorted(list(d))
-        if 'appearance' in self.j:
-            info["materials"] = 'materials' in self.j['appearance']
-            info["textures"] = 'textures' in self.j['appearance']
-        else:
-            info["materials"] = False
-            info["textures"] =  False
-        if long == False:
-            return json.dumps(info, indent=2)    
-        #-- all/long version
-        info["vertices_total"] = len(self.j["vertices"])
-        d.clear()
+        prims = set()
         lod = set()
         sem_srf = set()
         co_attributes = set()
-        for key in self.j["CityObjects"]:
-            if 'attributes' in self.j['CityObjects'][key]:
-                for attr in self.j['CityObjects'][key]['attributes'].keys():
+        for key, co in cityobjects:
+            if self.is_co_toplevel(co):
+                total += 1
+            d.add(co['type'])
+            if long == False:
+                continue
+            if 'attributes' in co:
+                for attr in co['attributes'].keys():
                     co_attributes.add(attr)
-            for geom in self.j['CityObjects'][key]['geometry']:
-                d.add(geom["type"])
+            for geom in co['geometry']:
+                prims.add(geom["type"])
                 if "lod" in geom:
                     lod.add(geom["lod"])
                 else: #-- it's a geometry-template
@@ -1163,7 +1485,19 @@ class CityJSON:
                     if "surfaces" in geom["semantics"]:
                         for srf in geom["semantics"]["surfaces"]:
                             sem_srf.add(srf["type"])
-        info["geom_primitives_present"] = list(d)
+        info["cityobjects_total"] = total
+        info["cityobjects_present"] = sorted(list(d))
+        if 'appearance' in self.j:
+            info["materials"] = 'materials' in self.j['appearance']
+            info["textures"] = 'textures' in self.j['appearance']
+        else:
+            info["materials"] = False
+            info["textures"] =  False
+        if long == False:
+            return json.dumps(info, indent=2)    
+        #-- all/long version
+        info["vertices_total"] = len(self.j["vertices"])
+        info["geom_primitives_present"] = list(prims)
         info["level_of_detail"] = list(lod)
         info["semantics_surfaces_present"] = list(sem_srf)
         info["cityobject_attributes"] = list(co_attributes)
@@ -1187,6 +1521,14 @@ class CityJSON:
                 a[i] = oldnewids[each]
         #--
         totalinput = len(self.j["vertices"])        
+        if MODULE_NUMPY_AVAILABLE:
+            bi = self.get_boundary_index()
+            used = bi.vertices_in_order()
+            newids = np.full(totalinput, -1, dtype=np.int64)
+            newids[used] = np.arange(len(used))
+            bi.remap(newids)
+            self.set_vertices_array(self.get_vertices_array()[used])
+            return (totalinput - len(self.j["vertices"]))
         oldnewids = {}
         newvertices = []
         #-- visit each geom to gather used ids 
@@ -1217,6 +1559,16 @@ class CityJSON:
                 a[i] = newids[each]
         #--            
         totalinput = len(self.j["vertices"])        
+        if MODULE_NUMPY_AVAILABLE and totalinput > 0:
+            #-- compare the vertices as integers, rounded to the precision
+            q = vertices.quantize(self.get_vertices_array(), precision)
+            if q is not None:
+                newv, newids = vertices.unique(q)
+                self.get_boundary_index().remap(newids)
+                if "transform" not in self.j:
+                    newv = newv / (10 ** precision)
+                self.set_vertices_array(newv)
+                return (totalinput - len(self.j["vertices"]))
         h = {}
         newids = [-1] * len(self.j["vertices"])
         newvertices = []
@@ -1247,23 +1599,33 @@ class CityJSON:
         return (totalinput - len(self.j["vertices"]))
 
 
+    @keeping_vertices
     def compress(self, important_digits=3):
         if "transform" in self.j:
             return False
         #-- find the minx/miny/minz
-        bbox = [9e9, 9e9, 9e9]    
-        for v in self.j["vertices"]:
-            for i in range(3):
-                if v[i] < bbox[i]:
-                    bbox[i] = v[i]
-        #-- convert vertices in self.j to int
-        n = [0, 0, 0]
-        p = '%.' + str(important_digits) + 'f' 
-        for v in self.j["vertices"]:
-            for i in range(3):
-                n[i] = v[i] - bbox[i]
-            for i in range(3):
-                v[i] = int((p % n[i]).replace('.', ''))
+        q = None
+        if MODULE_NUMPY_AVAILABLE and len(self.j["vertices"]) > 0:
+            v = self.get_vertices_array()
+            bbox = v.min(axis=0).tolist()
+            q = vertices.quantize(v - np.array(bbox), important_digits)
+        if q is not None:
+            self.set_vertices_array(q)
+        else:
+            bbox = [9e9, 9e9, 9e9]    
+            for v in self.j["vertices"]:
+                for i in range(3):
+                    if v[i] < bbox[i]:
+                        bbox[i] = v[i]
+            #-- convert vertices in self.j to int
+            n = [0, 0, 0]
+            p = '%.' + str(important_digits) + 'f' 
+            for v in self.j["vertices"]:
+                for i in range(3):
+                    n[i] = v[i] - bbox[i]
+                for i in range(3):
+                    v[i] = int((p % n[i]).replace('.', ''))
+            self._vertices_modified()
         #-- put transform
         self.j["transform"] = {}
         ss = '0.'
@@ -1282,6 +1644,12 @@ class CityJSON:
 
     def decompress(self):
         if "transform" in self.j:
+            if MODULE_NUMPY_AVAILABLE:
+                s = np.array(self.j["transform"]["scale"])
+                t = np.array(self.j["transform"]["translate"])
+                self.set_vertices_array(self.get_vertices_array() * s + t)
+                del self.j["transform"]
+                return True
             for v in self.j["vertices"]:
                 v[0] = (v[0] * self.j["transform"]["scale"][0]) + self.j["transform"]["translate"][0]
                 v[1] = (v[1] * self.j["transform"]["scale"][1]) + self.j["transform"]["translate"][1]
@@ -1292,7 +1660,16 @@ class CityJSON:
             return False
 
 
-    def merge(self, lsCMs):
+    @keeping_vertices
+    def merge(self, lsCMs, important_digits=None):
+        """Merge city models in this one
+
+        :param lsCMs: The list of the CityJSON to add, they are modified
+        :param important_digits: Compress the result with that many digits:
+            the vertices of all the city models are quantized to the same
+            "transform" and the duplicates are removed in one pass at the end
+            (like compress() after merge())
+        """
         # decompress() everything
         # updates CityObjects
         # updates vertices
@@ -1319,6 +1696,16 @@ class CityJSON:
                         a[i] = each + voffset
         #-- decompress current CM                        
         self.decompress()
+        #-- the vertices are put together at the end, with the boundaries of
+        #-- each city model and the offset of its vertices
+        dedup = (important_digits is not None) and MODULE_NUMPY_AVAILABLE
+        #-- the LoDs of the geometries of the CityObjects found in several city models
+        lods = {}
+        if dedup:
+            parts = [(self.get_boundary_index(), 0)]
+            arrays = [self.get_vertices_array()]
+            nvertices = len(arrays[0])
+            dropped = set()
 
         #-- metadata
         try:
@@ -1328,33 +1715,50 @@ class CityJSON:
         for cm in lsCMs:
             #-- decompress 
             cm.decompress()
-            offset = len(self.j["vertices"])
-            self.j["vertices"] += cm.j["vertices"]
+            if dedup:
+                parts.append((cm.get_boundary_index(), nvertices))
+                arrays.append(cm.get_vertices_array())
+                nvertices += len(arrays[-1])
+                offset = 0
+            else:
+                offset = len(self.j["vertices"])
+                self.j["vertices"] += cm.j["vertices"]
+                if MODULE_NUMPY_AVAILABLE:
+                    #-- shift all the vertex indices of cm at once
+                    bi = cm.get_boundary_index()
+                    bi.update(bi.flat + offset)
+                    offset = 0
             #-- add each CityObjects
             for theid in cm.j["CityObjects"]:
                 if theid in self.j["CityObjects"]:
+                    co = self.j["CityObjects"][theid]
                     #-- merge attributes if not present (based on the property name only)
                     if "attributes" in cm.j["CityObjects"][theid]:
+                        attributes = co.setdefault("attributes", {})
                         for a in cm.j["CityObjects"][theid]["attributes"]:
-                            if a not in self.j["CityObjects"][theid]["attributes"]:
-                                self.j["CityObjects"][theid]["attributes"][a] = cm.j["CityObjects"][theid]["attributes"][a]
-                    #-- merge geoms if not present (based on LoD only)
-                    for g in cm.j['CityObjects'][theid]['geometry']:
-                        thelod = str(g["lod"])
-                        # print ("-->", thelod)
-                        b = False
-                        for g2 in self.j['CityObjects'][theid]['geometry']:
-                            if g2["lod"] == thelod:
-                                b = True
-                                break
-                        if b == False:
-                            self.j['CityObjects'][theid]['geometry'].append(g)
-                            update_geom_indices(self.j['CityObjects'][theid]['geometry'][-1]["boundaries"], offset)    
+                            if a not in attributes:
+                                attributes[a] = cm.j["CityObjects"][theid]["attributes"][a]
+                    #-- merge geoms if not present (based on LoD only), with
+                    #-- the LoDs of the CityObject kept from one city model to the next
+                    if theid not in lods:
+                        lods[theid] = set(geometry_lod(self.j, g2) for g2 in co.get("geometry", []))
+                    added = []
+                    for g in cm.j['CityObjects'][theid].get('geometry', []):
+                        thelod = geometry_lod(cm.j, g)
+                        if (thelod is None) or (thelod not in lods[theid]):
+                            co.setdefault('geometry', []).append(g)
+                            added.append(thelod)
+                            if offset != 0:
+                                update_geom_indices(g["boundaries"], offset)    
+                        elif dedup:
+                            dropped.add(id(g))
+                    lods[theid].update(added)
                 else:
                     #-- copy the CO
                     self.j["CityObjects"][theid] = cm.j["CityObjects"][theid]
-                    for g in self.j['CityObjects'][theid]['geometry']:
-                        update_geom_indices(g["boundaries"], offset)
+                    if offset != 0:
+                        for g in self.j['CityObjects'][theid].get('geometry', []):
+                            update_geom_indices(g["boundaries"], offset)
             #-- templates
             if "geometry-templates" in cm.j:
                 if "geometry-templates" in self.j:
@@ -1375,7 +1779,7 @@ class CityJSON:
                 self.j["geometry-templates"]["vertices-templates"] += cm.j["geometry-templates"]["vertices-templates"]
                 #-- update the "template" in each GeometryInstance
                 for theid in cm.j["CityObjects"]:
-                    for g in self.j['CityObjects'][theid]['geometry']:
+                    for g in cm.j['CityObjects'][theid].get('geometry', []):
                         if g["type"] == 'GeometryInstance':
                             g["template"] += notemplates
             #-- materials
@@ -1386,17 +1790,20 @@ class CityJSON:
                     if "appearance" not in self.j:
                         self.j["appearance"] = {}
                     if "materials" not in self.j["appearance"]:
-                        self.j["appearance"]["materials"] = {}
+                        self.j["appearance"]["materials"] = []
                     offset = 0
                 #-- copy materials
                 for m in cm.j["appearance"]["materials"]:
                     self.j["appearance"]["materials"].append(m)
                 #-- update the "material" in each Geometry
                 for theid in cm.j["CityObjects"]:
-                    for g in self.j['CityObjects'][theid]['geometry']:
+                    for g in cm.j['CityObjects'][theid].get('geometry', []):
                         if 'material' in g:
                             for m in g['material']:
-                                update_geom_indices(g['material'][m]['values'], offset)
+                                if 'values' in g['material'][m]:
+                                    update_geom_indices(g['material'][m]['values'], offset)
+                                if g['material'][m].get('value') is not None:
+                                    g['material'][m]['value'] += offset
             #-- textures
             if ("appearance" in cm.j) and ("textures" in cm.j["appearance"]):
                 if ("appearance" in self.j) and ("textures" in self.j["appearance"]):
@@ -1418,22 +1825,57 @@ class CityJSON:
                     self.j["appearance"]["textures"].append(t)
                 #-- update the "texture" in each Geometry
                 for theid in cm.j["CityObjects"]:
-                    for g in self.j['CityObjects'][theid]['geometry']:
+                    for g in cm.j['CityObjects'][theid].get('geometry', []):
                         if 'texture' in g:
                             for m in g['texture']:
                                 update_texture_indices(g['texture'][m]['values'], toffset, voffset)
             #-- metadata
-            try:
-                fids = [fid for fid in cm.j["CityObjects"]]
-                src = {
-                    "description": cm.get_title(),
-                    "sourceReferenceSystem": "urn:ogc:def:crs:EPSG::{}".format(cm.get_epsg()) if cm.get_epsg() else None
-                }
-                self.add_lineage_item("Merge {} into {}".format(cm.get_identifier(), self.get_identifier()), features=fids, source=[src])
-            except:
-                pass
-        # self.remove_duplicate_vertices()
-        # self.remove_orphan_vertices()
+            self.add_merge_lineage(cm)
+        if dedup:
+            if not self._merge_vertices(parts, arrays, dropped, important_digits):
+                #-- not exact with integers, each city model is shifted
+                for bi, start in parts:
+                    bi.update(bi.flat + start)
+                self.set_vertices_array(np.concatenate(arrays))
+                self.compress(important_digits)
+        elif important_digits is not None:
+            self.compress(important_digits)
+        return True
+
+
+    def _merge_vertices(self, parts, arrays, dropped, important_digits):
+        """Put together the vertices of merged city models, compressed
+
+        The vertices used by the geometries kept are quantized (see
+        compress()), the duplicates are removed and the indices of each city
+        model are replaced at once.
+
+        :param parts: The BoundaryIndex of each city model, with the offset of
+            its vertices in the arrays
+        :param arrays: The arrays of the vertices of the city models
+        :param dropped: The id() of the geometries not kept
+        :return: False if the vertices can't be quantized
+        """
+        allv = np.concatenate(arrays).astype(np.float64)
+        flats = []
+        for bi, voffset in parts:
+            kept = np.array([id(g) not in dropped for g in bi.geometries], dtype=bool)
+            flats.append(bi.flat[kept[bi.geometry_ids()]] + voffset)
+        #-- the vertices used, in the order they first appear
+        u, first = np.unique(np.concatenate(flats), return_index=True)
+        used = u[np.argsort(first)]
+        bbox = allv[used].min(axis=0) if len(used) > 0 else np.zeros(3)
+        q = vertices.quantize(allv[used] - bbox, important_digits)
+        if q is None:
+            return False
+        newv, newids = vertices.unique(q)
+        remap = np.full(len(allv), -1, dtype=np.int64)
+        remap[used] = newids
+        for bi, voffset in parts:
+            bi.update(remap[bi.flat + voffset])
+        self.set_vertices_array(newv)
+        ss = float('1e-%d' % important_digits)
+        self.j["transform"] = {"scale": [ss, ss, ss], "translate": bbox.tolist()}
         return True
 
 
@@ -1521,168 +1963,277 @@ class CityJSON:
 
 
     def triangulate_face(self, face, vnp):
-
-        sf = np.array([], dtype=np.int32)
-        for ring in face:
-            sf = np.hstack( (sf, np.array(ring)) )
-        sfv = vnp[sf]
-        # print(sf)
-        # print(sfv)
-        rings = np.zeros(len(face), dtype=np.int32)
-        total = 0
-        for i in range(len(face)):
-            total += len(face[i])
-            rings[i] = total
-        # print(rings)
-
-        # 1. normal with Newell's method
-        n, b = geom_help.get_normal_newell(sfv)
-
+        triangles, tri_faces, n, valid = geom_help.triangulate_faces(*geom_help.faces_to_arrays([face]), vnp)
         #-- if already a triangle then return it
         if ( (len(face) == 1) and (len(face[0]) == 3) ):
-            return (face, True, n)
-        if b == False:
-            return (n, False, n)
-        # print ("Newell:", n)
-
-        # 2. project to the plane to get xy
-        sfv2d = np.zeros( (sfv.shape[0], 2))
-        # print (sfv2d)
-        for i,p in enumerate(sfv):
-            xy = geom_help.to_2d(p, n)
-            # print("xy", xy)
-            sfv2d[i][0] = xy[0]
-            sfv2d[i][1] = xy[1]
-        result = mapbox_earcut.triangulate_float64(sfv2d, rings)
-        # print (result.reshape(-1, 3))
-
-        for i,each in enumerate(result):
-            # print (sf[i])        
-            result[i] = sf[each]
-        
-        # print (result.reshape(-1, 3))
-        return (result.reshape(-1, 3), True, n)
+            return (face, True, n[0])
+        if valid[0] == False:
+            return (n[0], False, n[0])
+        return (triangles, True, n[0])
 
 
-    def export2b3dm(self):
-        glb = convert.to_glb(self.j)
+    @keeping_vertices
+    def export2b3dm(self, jobs=1, sidecar=False, quantize=False, normals=False):
+        glb = convert.to_glb(self.j, triangles=self.get_triangulation(jobs, sidecar),
+                             quantize=quantize, normals=normals)
         b3dm = convert.to_b3dm(self, glb)
         return b3dm
 
 
-    def export2gltf(self):
+    @keeping_vertices
+    def export2gltf(self, jobs=1, sidecar=False, quantize=False, normals=False):
         # TODO B: probably no need to double wrap this to_gltf(), but its long, and
         # the current cityjson.py is long already
-        glb = convert.to_glb(self.j)
+        glb = convert.to_glb(self.j, triangles=self.get_triangulation(jobs, sidecar),
+                             quantize=quantize, normals=normals)
         return glb
 
 
-    def export2obj(self):
+    @keeping_vertices
+    def export2tiles(self, path, jobs=1, sidecar=False, quantize=False, normals=False,
+                     max_features=tiling.MAX_FEATURES):
+        """Write the city model as 3D Tiles, in the folder 'path'
+
+        The CityObjects are partitioned in a quadtree (see tiling.quadtree()),
+        each leaf is written as a b3dm in path/tiles/ and the tree is written
+        to path/tileset.json. The vertices are reprojected to ECEF (EPSG:4978)
+        and the tiles are in the east, north and up axes at the centre of the
+        city model, the "transform" of the root tile placing them on the
+        Earth. Without a CRS (or without pyproj), the tiles are only
+        translated to the centre and stay in the axes of the city model,
+        with a warning.
+
+        :param jobs: The number of processes triangulating the faces and
+            writing the tiles
+        :param sidecar: See get_triangulation()
+        :param quantize: See convert.to_glb()
+        :param normals: See convert.to_glb()
+        :param max_features: The maximum number of CityObjects in a tile
+        :return: The tileset, as a dict
+        :raises: InvalidOperation if no CityObject has a geometry
+        """
+        triangles, normals_, offsets = self.get_triangulation(jobs, sidecar)
+        bi = self.get_boundary_index()
+        vnp = self.get_vertices_array().astype(np.float64)
+        if "transform" in self.j:
+            vnp = (vnp * np.array(self.j["transform"]["scale"])) + np.array(self.j["transform"]["translate"])
+        if len(bi.flat) == 0:
+            raise InvalidOperation("Cannot make tiles of a city model without geometries")
+        #-- the vertices in the local coordinates of the tiles
+        used = vnp[bi.flat]
+        center = (used.min(axis=0) + used.max(axis=0)) / 2
+        epsg = self.get_epsg()
+        if epsg is None:
+            print_cmd_warning("The city model has no CRS, the 3D Tiles are not placed on the Earth")
+        elif not MODULE_PYPROJ_AVAILABLE:
+            print_cmd_warning("Modul 'pyproj' is not available, the 3D Tiles are not placed on the Earth")
+        if (epsg is None) or (not MODULE_PYPROJ_AVAILABLE):
+            axes = np.identity(3)
+            origin = center
+            vnp = vnp - center
+        else:
+            lon, lat, h = get_transformer(epsg, 4979).transform(*center.tolist())
+            axes = tiling.enu_axes(lon, lat)
+            origin = np.array(get_transformer(epsg, 4978).transform(*center.tolist()))
+            ecef = np.column_stack(get_transformer(epsg, 4978).transform(vnp[:, 0], vnp[:, 1], vnp[:, 2]))
+            vnp = np.dot(ecef - origin, axes.T)
+        ids, bbs = tiling.bboxes(bi, vnp)
+        root = tiling.quadtree((bbs[:, :2] + bbs[:, 3:5]) / 2, max_features)
+        #-- the triangles of each CityObject
+        ranges = {}
+        for i, owner in enumerate(bi.owners):
+            if owner in ranges:
+                ranges[owner][1] = i + 1
+            else:
+                ranges[owner] = [i, i + 1]
+        os.makedirs(os.path.join(path, 'tiles'), exist_ok=True)
+        uris = []
+        tiles = []
+        for n, leaf in enumerate(tiling.leaves(root)):
+            uris.append('tiles/%d.b3dm' % n)
+            coids = [ids[i] for i in sorted(leaf["indices"].tolist())]
+            geoms = [np.arange(*ranges[theid]) for theid in coids]
+            t = [triangles[offsets[g]:offsets[g + 1]] for g in np.concatenate(geoms)]
+            tn = [normals_[offsets[g]:offsets[g + 1]] for g in np.concatenate(geoms)]
+            toffsets = np.zeros(len(t) + 1, dtype=np.int64)
+            np.cumsum([len(a) for a in t], out=toffsets[1:])
+            t = np.concatenate(t)
+            #-- the tile has only the vertices it uses, with the reference points
+            #-- of the GeometryInstances
+            cos = {theid: self.j["CityObjects"][theid] for theid in coids}
+            refs = [g["boundaries"][0] for co in cos.values() for g in co.get("geometry", [])
+                    if g["type"] == "GeometryInstance"]
+            used, local = np.unique(np.concatenate((t.reshape(-1), np.array(refs, dtype=np.int64))),
+                                    return_inverse=True)
+            local = local[:t.size]
+            for theid, co in cos.items():
+                if any(g["type"] == "GeometryInstance" for g in co.get("geometry", [])):
+                    cos[theid] = dict(co, geometry=[
+                        dict(g, boundaries=[int(np.searchsorted(used, g["boundaries"][0]))])
+                        if g["type"] == "GeometryInstance" else g for g in co["geometry"]])
+            j = {"CityObjects": cos, "vertices": vnp[used].tolist()}
+            if "geometry-templates" in self.j:
+                j["geometry-templates"] = self.j["geometry-templates"]
+            tiles.append((os.path.join(path, uris[-1]), j,
+                          (local.reshape(-1, 3), np.concatenate(tn), toffsets), quantize, normals))
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                list(pool.map(_write_tile, *zip(*tiles)))
+        else:
+            for tile in tiles:
+                _write_tile(*tile)
+        ts = tiling.tileset(root, bbs, uris, tiling.root_transform(axes, origin))
+        with open(os.path.join(path, 'tileset.json'), 'w') as fout:
+            json.dump(ts, fout)
+        return ts
+
+    @keeping_vertices
+    def export2obj(self, fout=None, jobs=1, sidecar=False):
+        """Write the city model as OBJ, the faces triangulated
+
+        :param fout: The text file to write to, the lines are written in
+            chunks of EXPORT_CHUNK_SIZE. If None, they are written to a
+            StringIO that is returned.
+        :param jobs: The number of processes triangulating the faces
+        :param sidecar: See get_triangulation()
+        """
+        out = StringIO() if fout is None else fout
         self.decompress()
-        out = StringIO()
         #-- write vertices
-        for v in self.j['vertices']:
-            out.write('v ' + str(v[0]) + ' ' + str(v[1]) + ' ' + str(v[2]) + '\n')
-        vnp = np.array(self.j["vertices"])
-        #-- translate to minx,miny
-        minx = 9e9
-        miny = 9e9
-        for each in vnp:
-            if each[0] < minx:
-                    minx = each[0]
-            if each[1] < miny:
-                    miny = each[1]
-        for each in vnp:
-            each[0] -= minx
-            each[1] -= miny
-        # print ("min", minx, miny)
-        # print(vnp)
+        vs = self.j['vertices']
+        for i in range(0, len(vs), EXPORT_CHUNK_SIZE):
+            out.write(''.join(['v %s %s %s\n' % (v[0], v[1], v[2]) for v in vs[i:i + EXPORT_CHUNK_SIZE]]))
+        triangles, normals, offsets = self.get_triangulation(jobs, sidecar)
+        owners = boundaries.collect(self.j)[1]
         #-- start with the CO
-        for theid in self.j['CityObjects']:
-            for geom in self.j['CityObjects'][theid]['geometry']:
-                out.write('o ' + str(theid) + '\n')
-                if ( (geom['type'] == 'MultiSurface') or (geom['type'] == 'CompositeSurface') ):
-                    for face in geom['boundaries']:
-                        re, b, n = self.triangulate_face(face, vnp)
-                        if b == True:
-                            for t in re:
-                                out.write("f %d %d %d\n" % (t[0] + 1, t[1] + 1, t[2] + 1))
-                elif (geom['type'] == 'Solid'):
-                    for shell in geom['boundaries']:
-                        for i, face in enumerate(shell):
-                            re, b, n = self.triangulate_face(face, vnp)
-                            if b == True:
-                                for t in re:
-                                    out.write("f %d %d %d\n" % (t[0] + 1, t[1] + 1, t[2] + 1))
+        lines = []
+        for i, theid in enumerate(owners):
+            lines.append('o %s\n' % theid)
+            lines.extend(["f %d %d %d\n" % (t[0], t[1], t[2]) for t in (triangles[offsets[i]:offsets[i + 1]] + 1).tolist()])
+            if len(lines) >= EXPORT_CHUNK_SIZE:
+                out.write(''.join(lines))
+                lines = []
+        out.write(''.join(lines))
         return out
 
-    def export2stl(self):
-        #TODO: refectoring, duplicated code from 2obj()
-        out = StringIO()
-        out.write("solid\n")
+    @keeping_vertices
+    def export2stl(self, fout=None, jobs=1, sidecar=False, binary=False):
+        """Write the city model as ASCII STL, the faces triangulated
 
-        #-- translate to minx,miny
-        vnp = np.array(self.j["vertices"])
-        minx = 9e9
-        miny = 9e9
-        for each in vnp:
-            if each[0] < minx:
-                    minx = each[0]
-            if each[1] < miny:
-                    miny = each[1]
-        for each in vnp:
-            each[0] -= minx
-            each[1] -= miny
-        # print ("min", minx, miny)
-        # print(vnp)
-        #-- start with the CO
-        for theid in self.j['CityObjects']:
-            for geom in self.j['CityObjects'][theid]['geometry']:
-                if ( (geom['type'] == 'MultiSurface') or (geom['type'] == 'CompositeSurface') ):
-                    for face in geom['boundaries']:
-                        re, b, n = self.triangulate_face(face, vnp)
-                        if b == True:
-                            for t in re:
-                                out.write("facet normal %f %f %f\nouter loop\n" % (n[0], n[1], n[2]))
-                                out.write("vertex %s %s %s\n" % (str(self.j["vertices"][t[0]][0]), str(self.j["vertices"][t[0]][1]), str(self.j["vertices"][t[0]][2])))
-                                out.write("vertex %s %s %s\n" % (str(self.j["vertices"][t[1]][0]), str(self.j["vertices"][t[1]][1]), str(self.j["vertices"][t[1]][2])))
-                                out.write("vertex %s %s %s\n" % (str(self.j["vertices"][t[2]][0]), str(self.j["vertices"][t[2]][1]), str(self.j["vertices"][t[2]][2])))
-                                out.write("endloop\nendfacet\n")
-                elif (geom['type'] == 'Solid'):
-                    for shell in geom['boundaries']:
-                        for i, face in enumerate(shell):
-                            re, b, n = self.triangulate_face(face, vnp)
-                            if b == True:
-                                for t in re:
-                                    out.write("facet normal %f %f %f\nouter loop\n" % (n[0], n[1], n[2]))
-                                    out.write("vertex %s %s %s\n" % (str(self.j["vertices"][t[0]][0]), str(self.j["vertices"][t[0]][1]), str(self.j["vertices"][t[0]][2])))
-                                    out.write("vertex %s %s %s\n" % (str(self.j["vertices"][t[1]][0]), str(self.j["vertices"][t[1]][1]), str(self.j["vertices"][t[1]][2])))
-                                    out.write("vertex %s %s %s\n" % (str(self.j["vertices"][t[2]][0]), str(self.j["vertices"][t[2]][1]), str(self.j["vertices"][t[2]][2])))
-                                    out.write("endloop\nendfacet\n")
+        :param fout: The text file to write to, the facets are written in
+            chunks of EXPORT_CHUNK_SIZE. If None, they are written to a
+            StringIO that is returned.
+        :param jobs: The number of processes triangulating the faces
+        :param sidecar: See get_triangulation()
+        :param binary: Write binary STL instead, see export2stl_binary()
+        """
+        if binary:
+            return self.export2stl_binary(fout, jobs, sidecar)
+        out = StringIO() if fout is None else fout
+        out.write("solid\n")
+        triangles, normals, offsets = self.get_triangulation(jobs, sidecar)
+        vnp = self.get_vertices_array()
+        #-- the coordinates as str() writes them
+        coordinates = "%d %d %d" if vnp.dtype.kind in 'iu' else "%r %r %r"
+        facet = "facet normal %f %f %f\nouter loop\nvertex %s\nvertex %s\nvertex %s\nendloop\nendfacet\n"
+        for i in range(0, len(triangles), EXPORT_CHUNK_SIZE):
+            #-- the vertices of the chunk are formatted once, then gathered
+            used, t = np.unique(triangles[i:i + EXPORT_CHUNK_SIZE].ravel(), return_inverse=True)
+            vs = np.array([coordinates % tuple(v) for v in vnp[used].tolist()], dtype=object)
+            t = t.reshape(-1, 3)
+            values = np.empty((len(t), 6), dtype=object)
+            values[:, :3] = normals[i:i + EXPORT_CHUNK_SIZE]
+            values[:, 3:] = vs[t]
+            out.write((facet * len(values)) % tuple(values.ravel().tolist()))
         out.write("endsolid")
         return out
 
-    def reproject(self, epsg):
+    @keeping_vertices
+    def export2stl_binary(self, fout=None, jobs=1, sidecar=False):
+        """Write the city model as binary STL, the faces triangulated
+
+        The normals and the (real) coordinates of the vertices are written as
+        float32, the facets are packed in chunks of EXPORT_CHUNK_SIZE. A
+        float32 keeps about 7 digits, so the coordinates are translated by the
+        minimum corner of the vertices (rounded down to metres) first: it is
+        written in the header, as "cjio translate <x> <y> <z>", to be added
+        back to get the real coordinates.
+
+        :param fout: The binary file to write to. If None, the file is written
+            to a BytesIO that is returned.
+        :param jobs: The number of processes triangulating the faces
+        :param sidecar: See get_triangulation()
+        """
+        out = BytesIO() if fout is None else fout
+        triangles, normals, offsets = self.get_triangulation(jobs, sidecar)
+        vnp = self.get_vertices_array()
+        if "transform" in self.j:
+            vnp = (vnp * np.array(self.j["transform"]["scale"])) + np.array(self.j["transform"]["translate"])
+        vnp = np.asarray(vnp, dtype=np.float64)
+        offset = np.floor(vnp.min(axis=0)) if len(vnp) > 0 else np.zeros(3)
+        vnp = vnp - offset
+        #-- the header must not start with "solid"
+        header = 'cjio translate %d %d %d' % tuple(offset.tolist())
+        out.write(header.encode().ljust(80, b' '))
+        out.write(np.array([len(triangles)], dtype='<u4').tobytes())
+        for i in range(0, len(triangles), EXPORT_CHUNK_SIZE):
+            t = triangles[i:i + EXPORT_CHUNK_SIZE]
+            facets = np.zeros(len(t), dtype=STL_FACET)
+            facets['normal'] = normals[i:i + EXPORT_CHUNK_SIZE]
+            facets['vertices'] = vnp[t]
+            out.write(facets.tobytes())
+        return out
+
+    @keeping_vertices
+    def reproject(self, epsg, jobs=1, chunk_size=REPROJECT_CHUNK_SIZE):
+        """Reproject the vertices to a new EPSG
+
+        :param epsg: The EPSG code to reproject to
+        :param jobs: Number of threads transforming the chunks of vertices
+        :param chunk_size: Number of vertices transformed at once
+        """
         if not MODULE_PYPROJ_AVAILABLE:
             raise ModuleNotFoundError("Modul 'pyproj' is not available, please install it from https://pypi.org/project/pyproj/")
         wascompressed = False
         if "transform" in self.j:
             self.decompress()
             wascompressed = True
-        p1 = pyproj.Proj(init='epsg:%d' % (self.get_epsg()))
-        p2 = pyproj.Proj(init='epsg:%d' % (epsg))
-        with progressbar(self.j['vertices']) as vertices:
-            for v in vertices:
-                x, y, z = pyproj.transform(p1, p2, v[0], v[1], v[2])
-                v[0] = x
-                v[1] = y
-                v[2] = z
+        epsg_from = self.get_epsg()
+        if MODULE_NUMPY_AVAILABLE:
+            v = self.get_vertices_array()
+            #-- contiguous copies, the chunks are transformed in place
+            x = np.array(v[:, 0], dtype=np.float64)
+            y = np.array(v[:, 1], dtype=np.float64)
+            z = np.array(v[:, 2], dtype=np.float64)
+            def transform_chunk(start):
+                end = start + chunk_size
+                get_transformer(epsg_from, epsg).transform(x[start:end], y[start:end], z[start:end], inplace=True)
+                return min(end, len(x)) - start
+            starts = range(0, len(x), chunk_size)
+            with progressbar(length=len(x)) as bar:
+                if jobs > 1:
+                    with ThreadPoolExecutor(max_workers=jobs) as pool:
+                        for n in pool.map(transform_chunk, starts):
+                            bar.update(n)
+                else:
+                    for start in starts:
+                        bar.update(transform_chunk(start))
+            self.set_vertices_array(np.column_stack((x, y, z)))
+        else:
+            t = get_transformer(epsg_from, epsg)
+            with progressbar(self.j['vertices']) as vs:
+                for v in vs:
+                    x, y, z = t.transform(v[0], v[1], v[2])
+                    v[0] = x
+                    v[1] = y
+                    v[2] = z
         self.set_epsg(epsg)
         self.update_bbox()
         if wascompressed == True:
             self.compress()
 
 
+    @keeping_vertices
     def extract_lod(self, thelod):
         for co in self.j["CityObjects"]:
             re = []
@@ -1703,23 +2254,30 @@ class CityJSON:
             pass
 
 
+    @keeping_vertices
     def translate(self, values, minimum_xyz):
         if minimum_xyz == True:
             #-- find the minimums
             bbox = [9e9, 9e9, 9e9]    
-            for v in self.j["vertices"]:
-                for i in range(3):
-                    if v[i] < bbox[i]:
-                        bbox[i] = v[i]
+            if MODULE_NUMPY_AVAILABLE and len(self.j["vertices"]) > 0:
+                bbox = self.get_vertices_array().min(axis=0).tolist()
+            else:
+                for v in self.j["vertices"]:
+                    for i in range(3):
+                        if v[i] < bbox[i]:
+                            bbox[i] = v[i]
             bbox[0] = -bbox[0]
             bbox[1] = -bbox[1]
             bbox[2] = -bbox[2]
         else:
             bbox = values
-        for v in self.j['vertices']:
-            v[0] = v[0] + bbox[0]
-            v[1] = v[1] + bbox[1]
-            v[2] = v[2] + bbox[2]
+        if MODULE_NUMPY_AVAILABLE:
+            self.set_vertices_array(self.get_vertices_array() + np.array(bbox))
+        else:
+            for v in self.j['vertices']:
+                v[0] = v[0] + bbox[0]
+                v[1] = v[1] + bbox[1]
+                v[2] = v[2] + bbox[2]
         self.set_epsg(None)
         self.update_bbox()
         return bbox
@@ -1750,6 +2308,7 @@ class CityJSON:
                                  overwrite_values=overwrite,
                                  recompute_uuid=new_uuid)
 
+    @keeping_vertices
     def update_metadata(self, overwrite=False, new_uuid=False):
         """
         Computes and updates the "metadata" property of this CityJSON file
@@ -1762,6 +2321,18 @@ class CityJSON:
 
         return (True, errors)
     
+    def add_merge_lineage(self, cm):
+        """Adds the lineage item of the merge of a city model in this one"""
+        try:
+            fids = [fid for fid in cm.j["CityObjects"]]
+            src = {
+                "description": cm.get_title(),
+                "sourceReferenceSystem": "urn:ogc:def:crs:EPSG::{}".format(cm.get_epsg()) if cm.get_epsg() else None
+            }
+            self.add_lineage_item("Merge {} into {}".format(cm.get_identifier(), self.get_identifier()), features=fids, source=[src])
+        except:
+            pass
+
     def add_lineage_item(self, description: str, features: list = None, source: list = None, processor: dict = None):
         """Adds a lineage item in metadata.
 
@@ -7,7 +7,8 @@ import copy
 import glob
 import re
 import cjio
-from cjio import cityjson, utils
+from cjio import cityjson, utils, validation, merging, pipeline, streaming
+from cjio.errors import InvalidOperation
 
 
 #-- https://stackoverflow.com/questions/47437472/in-python-click-how-do-i-see-help-for-subcommands-whose-parents-have-required
@@ -55,6 +56,7 @@ def cli(context, input, ignore_duplicate_keys):
 @cli.resultcallback()
 def process_pipeline(processors, input, ignore_duplicate_keys):
     extensions = ['.json', '.off', '.poly'] #-- input allowed
+    stream = None
     try:
         f = click.open_file(input, mode='r', encoding='utf-8-sig')
         extension = os.path.splitext(input)[1].lower()
@@ -71,36 +73,47 @@ def process_pipeline(processors, input, ignore_duplicate_keys):
         #-- CityJSON file
         else: 
             utils.print_cmd_status("Parsing %s" % (input))
-            cm = cityjson.reader(file=f, ignore_duplicate_keys=ignore_duplicate_keys)
-            if not isinstance(cm.get_version(), str):
-                str1 = "CityJSON version should be a string 'X.Y' (eg '1.0')"
-                raise click.ClickException(str1) 
-            pattern = re.compile("^(\d\.)(\d)$") #-- correct pattern for version
-            pattern2 = re.compile("^(\d\.)(\d\.)(\d)$") #-- wrong pattern with X.Y.Z
-            if pattern.fullmatch(cm.get_version()) == None:
-                if pattern2.fullmatch(cm.get_version()) != None:
-                    str1 = "CityJSON version should be only X.Y (eg '1.0') and not X.Y.Z (eg '1.0.1')"
-                    raise click.ClickException(str1)
-                else:
-                    str1 = "CityJSON version is wrongly formatted"
-                    raise click.ClickException(str1)
-            if (cm.get_version() not in cityjson.CITYJSON_VERSIONS_SUPPORTED):
-                allv = ""
-                for v in cityjson.CITYJSON_VERSIONS_SUPPORTED:
-                    allv = allv + v + "/"
-                str1 = "CityJSON version %s not supported (only versions: %s), not every operators will work.\nPerhaps it's time to upgrade cjio? 'pip install cjio -U'" % (cm.get_version(), allv)
-                raise click.ClickException(str1)
-            elif (cm.get_version() != cityjson.CITYJSON_VERSIONS_SUPPORTED[-1]):
-                str1 = "v%s is not the latest version, and not everything will work.\n" % cm.get_version()
-                str1 += "Upgrade the file with 'upgrade_version' command: 'cjio input.json upgrade_version save out.json'" 
-                click.echo(click.style(str1, fg='red'))
-            
+            if (input != '-') and pipeline.streamed(processors):
+                stream = streaming.CityJSONStream(input, ignore_duplicate_keys)
+                check_version(stream.get("version"))
+            else:
+                cm = cityjson.reader(file=f, ignore_duplicate_keys=ignore_duplicate_keys)
+                check_version(cm.get_version())
     except ValueError as e:
         raise click.ClickException('%s: "%s".' % (e, input))
     except IOError as e:
         raise click.ClickException('Invalid file: "%s".\n%s' % (input, e))
-    for processor in processors:
-        cm = processor(cm)
+    if stream is not None:
+        #-- the first command reads the file itself
+        cm = processors[0].stream(stream)
+        processors = processors[1:]
+    pipeline.execute(processors, cm)
+
+
+def check_version(version):
+    """Check the "version" of the CityJSON file, ClickException if it can't be processed"""
+    if not isinstance(version, str):
+        str1 = "CityJSON version should be a string 'X.Y' (eg '1.0')"
+        raise click.ClickException(str1) 
+    pattern = re.compile("^(\d\.)(\d)$") #-- correct pattern for version
+    pattern2 = re.compile("^(\d\.)(\d\.)(\d)$") #-- wrong pattern with X.Y.Z
+    if pattern.fullmatch(version) == None:
+        if pattern2.fullmatch(version) != None:
+            str1 = "CityJSON version should be only X.Y (eg '1.0') and not X.Y.Z (eg '1.0.1')"
+            raise click.ClickException(str1)
+        else:
+            str1 = "CityJSON version is wrongly formatted"
+            raise click.ClickException(str1)
+    if (version not in cityjson.CITYJSON_VERSIONS_SUPPORTED):
+        allv = ""
+        for v in cityjson.CITYJSON_VERSIONS_SUPPORTED:
+            allv = allv + v + "/"
+        str1 = "CityJSON version %s not supported (only versions: %s), not every operators will work.\nPerhaps it's time to upgrade cjio? 'pip install cjio -U'" % (version, allv)
+        raise click.ClickException(str1)
+    elif (version != cityjson.CITYJSON_VERSIONS_SUPPORTED[-1]):
+        str1 = "v%s is not the latest version, and not everything will work.\n" % version
+        str1 += "Upgrade the file with 'upgrade_version' command: 'cjio input.json upgrade_version save out.json'" 
+        click.echo(click.style(str1, fg='red'))
 
 
 @cli.command('info')
@@ -112,22 +125,51 @@ def info_cmd(context, long):
     def processor(cm):
         click.echo(cm.get_info(long=long))
         return cm
-    return processor
+    def stream(s):
+        click.echo(cityjson.get_info_stream(s, long=long))
+    return pipeline.Step(processor, writes=[], stream=stream)
 
 
 @cli.command('export')
 @click.argument('filename')
 @click.option('--format',
-              type=click.Choice(['obj', 'stl', 'glb', 'b3dm']),
+              type=click.Choice(['obj', 'stl', 'glb', 'b3dm', '3dtiles']),
               required=True,
               help="Export format")
-def export_cmd(filename, format):
+@click.option('--jobs', default=1, type=click.IntRange(1, None),
+              help='Number of processes triangulating the faces (default=1).')
+@click.option('--sidecar', is_flag=True, help='Keep the triangles of the faces in a file next to the input file, and reuse them.')
+@click.option('--binary', is_flag=True, help='Write binary STL (STL only).')
+@click.option('--quantize', is_flag=True,
+              help='Quantize the positions (int16) and the normals (int8) with KHR_mesh_quantization, and reorder the triangles for the GPU (glb, b3dm and 3dtiles only).')
+@click.option('--normals', is_flag=True, help='Add the normals of the faces (glb, b3dm and 3dtiles only).')
+def export_cmd(filename, format, jobs, sidecar, binary, quantize, normals):
     """Export the CityJSON to another format.
 
-    OBJ, Binary glTF (glb), Batched 3DModel (b3dm), STL. Currently textures are not supported, sorry.
+    OBJ, Binary glTF (glb), Batched 3DModel (b3dm), STL, 3D Tiles. Currently textures are not supported, sorry.
+
+    3D Tiles are written to a folder: tileset.json, and one b3dm per tile
+    in tiles/.
+
+    The faces can be triangulated by several processes, the output is the
+    same:
+
+    \b
+        $ cjio myfile.json export --format obj --jobs 4 myfile.obj
     """
     def exporter(cm):
         output = utils.verify_filename(filename)
+        if format.lower() == '3dtiles':
+            if not output['dir']:
+                raise click.ClickException('3D Tiles are written to a folder, not to "%s".' % filename)
+            utils.print_cmd_status("Exporting CityJSON to 3D Tiles (%s)" % output['path'])
+            try:
+                cm.export2tiles(output['path'], jobs=jobs, sidecar=sidecar, quantize=quantize, normals=normals)
+            except IOError as e:
+                raise click.ClickException('Invalid output folder: "%s".\n%s' % (output['path'], e))
+            except InvalidOperation as e:
+                raise click.ClickException(str(e))
+            return
         if output['dir']:
             os.makedirs(output['path'], exist_ok=True)
             input_filename = os.path.splitext(os.path.basename(cm.path))[0]
@@ -139,16 +181,14 @@ def export_cmd(filename, format):
             utils.print_cmd_status("Exporting CityJSON to OBJ (%s)" % (output['path']))
             try:
                 with click.open_file(output['path'], mode='w') as fo:
-                    re = cm.export2obj()
-                    fo.write(re.getvalue())
+                    cm.export2obj(fo, jobs=jobs, sidecar=sidecar)
             except IOError as e:
                 raise click.ClickException('Invalid output file: "%s".\n%s' % (output['path'], e))
         elif format.lower() == 'stl':
             utils.print_cmd_status("Exporting CityJSON to STL (%s)" % (output['path']))
             try:
-                with click.open_file(output['path'], mode='w') as fo:
-                    re = cm.export2stl()
-                    fo.write(re.getvalue())
+                with click.open_file(output['path'], mode='wb' if binary else 'w') as fo:
+                    cm.export2stl(fo, jobs=jobs, sidecar=sidecar, binary=binary)
             except IOError as e:
                 raise click.ClickException('Invalid output file: "%s".\n%s' % (output['path'], e))
         elif format.lower() == 'glb':
@@ -156,7 +196,7 @@ def export_cmd(filename, format):
             bufferbin = "{}.glb".format(fname)
             binfile = os.path.join(os.path.dirname(output['path']), bufferbin)
             utils.print_cmd_status("Exporting CityJSON to glb %s" % binfile)
-            glb = cm.export2gltf()
+            glb = cm.export2gltf(jobs=jobs, sidecar=sidecar, quantize=quantize, normals=normals)
             # TODO B: how many buffer can there be in the 'buffers'?
             try:
                 glb.seek(0)
@@ -168,7 +208,7 @@ def export_cmd(filename, format):
             fname = os.path.splitext(os.path.basename(output['path']))[0]
             b3dmbin = "{}.b3dm".format(fname)
             binfile = os.path.join(os.path.dirname(output['path']), b3dmbin)
-            b3dm = cm.export2b3dm()
+            b3dm = cm.export2b3dm(jobs=jobs, sidecar=sidecar, quantize=quantize, normals=normals)
             utils.print_cmd_status("Exporting CityJSON to b3dm %s" % binfile)
             utils.print_cmd_warning("Although the conversion works, the output is probably incorrect.")
             try:
@@ -248,7 +288,11 @@ def save_cmd(filename, indent, textures):
               help='Specify a folder where the schemas are (cityjson.json needs to be the master file).')
 @click.option('--long', is_flag=True,
               help='More gory details about the validation errors.')
-def validate_cmd(hide_errors, skip_schema, folder_schemas, long):
+@click.option('--cache_schemas', is_flag=True,
+              help='Keep the resolved schemas in the cache folder of the user, they are then read faster the next times.')
+@click.option('--jobs', default=1, type=click.IntRange(1, None),
+              help='Number of processes validating the City Objects against the schemas (default=1).')
+def validate_cmd(hide_errors, skip_schema, folder_schemas, long, cache_schemas, jobs):
     """
     Validate the CityJSON file: (1) against its schemas; (2) extra validations.
 
@@ -257,7 +301,11 @@ def validate_cmd(hide_errors, skip_schema, folder_schemas, long):
     This is used when there are Extensions used.
     
     If the file is too large (and thus validation is slow),
-    an option is to crop a subset and just validate it:
+    the City Objects can be validated by several processes:
+
+        $ cjio myfile.json validate --jobs 8
+
+    or an option is to crop a subset and just validate it:
 
         $ cjio myfile.json subset --random 2 validate
     
@@ -274,8 +322,10 @@ def validate_cmd(hide_errors, skip_schema, folder_schemas, long):
                 utils.print_cmd_status('===== Validation (with provided schemas) =====')
         else:
             utils.print_cmd_status('===== Validation (with official CityJSON schemas) =====')
+        if cache_schemas:
+            validation.set_schema_cache_dir(validation.default_schema_cache_dir())
         #-- validate    
-        bValid, woWarnings, errors, warnings = cm.validate(skip_schema=skip_schema, folder_schemas=folder_schemas, longerr=long)
+        bValid, woWarnings, errors, warnings = cm.validate(skip_schema=skip_schema, folder_schemas=folder_schemas, longerr=long, jobs=jobs)
         click.echo('=====')
         if bValid == True:
             click.echo(click.style('File is valid', fg='green'))
@@ -300,7 +350,13 @@ def validate_cmd(hide_errors, skip_schema, folder_schemas, long):
 
 @cli.command('merge')
 @click.argument('filepattern')
-def merge_cmd(filepattern):
+@click.option('--output', default=None, type=str,
+              help='Write the merge to this file, reading the files one at a time instead of keeping them all in memory. The city model passed to the next commands is not modified.')
+@click.option('--jobs', default=1, type=click.IntRange(1, None),
+              help='Number of processes reading the files (default=1).')
+@click.option('--digit', default=None, type=click.IntRange(1, 12),
+              help='Compress the merge with this number of digits, the duplicate vertices of all the files are removed at once.')
+def merge_cmd(filepattern, output, jobs, digit):
     """
     Merge the current CityJSON with others.
     All City Objects with their textures/materials/templates are handled.
@@ -308,23 +364,67 @@ def merge_cmd(filepattern):
     Possible to give a wildcard but put it between quotes:
 
         $ cjio myfile.json merge '/home/elvis/temp/*.json' info
+
+    With --output, a City Object whose ID is already in the merge is skipped
+    (instead of its attributes and geometries being merged):
+
+        $ cjio myfile.json merge --output merged.json '/home/elvis/temp/*.json'
+
+    With --digit, the result is compressed (as with 'compress --digit') and
+    the vertices shared by the files are kept once:
+
+        $ cjio myfile.json merge --digit 3 '/home/elvis/temp/*.json' save merged.json
     """
+    def load(path):
+        try:
+            f = click.open_file(path, mode='r', encoding='utf-8-sig')
+            return cityjson.reader(f)
+        except ValueError as e:
+            raise click.ClickException('%s: "%s".' % (e, path))
+        except IOError as e:
+            raise click.ClickException('Invalid file: "%s".' % (path))
+
+    def inputs(g):
+        if (jobs == 1) or (len(g) < 2) or (not merging.MODULE_NUMPY_AVAILABLE):
+            for i in g:
+                yield load(i)
+            return
+        try:
+            for other in merging.iter_parsed(g, jobs):
+                yield other
+        except ValueError as e:
+            raise click.ClickException('%s.' % e)
+        except IOError as e:
+            raise click.ClickException('Invalid file: "%s".' % (e.filename))
+
+    def streamer(cm, g):
+        utils.print_cmd_status('Merging files to %s' % output)
+        try:
+            fo = click.open_file(output, mode='w', encoding='utf-8')
+        except IOError as e:
+            raise click.ClickException('Invalid output file: %s \n%s' % (output, e))
+        with fo:
+            writer = merging.MergeWriter(fo)
+            writer.add(cm)
+            for other in inputs(g):
+                writer.add(other)
+            writer.close()
+        if len(writer.duplicates) > 0:
+            utils.print_cmd_warning('%d City Objects already in the merge were skipped' % len(writer.duplicates))
+
     def processor(cm):
-        utils.print_cmd_status('Merging files')
-        lsCMs = []
         g = glob.glob(filepattern)
-        for i in g:
-            try:
-                f = click.open_file(i, mode='r', encoding='utf-8-sig')
-                lsCMs.append(cityjson.reader(f))
-            except ValueError as e:
-                raise click.ClickException('%s: "%s".' % (e, input))
-            except IOError as e:
-                raise click.ClickException('Invalid file: "%s".' % (input))
+        if output is not None:
+            if digit is not None:
+                raise click.ClickException('--digit cannot be used with --output.')
+            streamer(cm, g)
+            return cm
+        utils.print_cmd_status('Merging files')
+        lsCMs = list(inputs(g))
         if len(lsCMs) == 0:
             click.echo("WARNING: No files to merge.")
         else:
-            cm.merge(lsCMs)
+            cm.merge(lsCMs, important_digits=digit)
         return cm
     return processor
 
@@ -337,7 +437,8 @@ def merge_cmd(filepattern):
     type=click.Choice(['Building', 'Bridge', 'Road', 'TransportSquare', 'LandUse', 'Railway', 'TINRelief', 'WaterBody', 'PlantCover', 'SolitaryVegetationObject', 'CityFurniture', 'GenericCityObject', 'Tunnel']), 
     help='The City Object type')
 @click.option('--exclude', is_flag=True, help='Excludes the selection, thus delete the selected object(s).')
-def subset_cmd(id, bbox, random, cotype, exclude):
+@click.option('--sidecar', is_flag=True, help='Keep the spatial index for --bbox in a file next to the input file, and reuse it.')
+def subset_cmd(id, bbox, random, cotype, exclude, sidecar):
     """
     Create a subset of a CityJSON file.
     One can select City Objects by
@@ -359,10 +460,19 @@ def subset_cmd(id, bbox, random, cotype, exclude):
         if len(id) > 0:
             s = s.get_subset_ids(id, exclude=exclude)
         if len(bbox) > 0:
-            s = s.get_subset_bbox(bbox, exclude=exclude)
+            s = s.get_subset_bbox(bbox, exclude=exclude, sidecar=sidecar)
         if cotype is not None:
             s = s.get_subset_cotype(cotype, exclude=exclude)
         return s 
+    def stream(stream):
+        #-- the CityObjects selected by ID are read, not the whole file
+        utils.print_cmd_status('Subset of CityJSON')
+        s = cityjson.get_subset_ids_stream(stream, id, exclude=exclude)
+        if cotype is not None:
+            s = s.get_subset_cotype(cotype, exclude=exclude)
+        return s
+    if (random is None) and (len(bbox) == 0) and (len(id) > 0):
+        return pipeline.Step(processor, stream=stream)
     return processor
 
 
@@ -376,12 +486,8 @@ def clean_cmd(digit):
     +
     remove_orphan_vertices    
     """
-    def processor(cm):
-        utils.print_cmd_status('Clean the file')
-        cm.remove_duplicate_vertices(digit)
-        cm.remove_orphan_vertices()
-        return cm
-    return processor
+    return pipeline.Step(vertex_ops=[("duplicates", digit), ("orphans",)],
+                         message='Clean the file')
 
 
 @cli.command('remove_duplicate_vertices')
@@ -397,11 +503,8 @@ def remove_duplicate_vertices_cmd(precision):
 
         $ cjio myfile.json remove_duplicate_vertices 3 info
     """
-    def processor(cm):
-        utils.print_cmd_status('Remove duplicate vertices')
-        cm.remove_duplicate_vertices(precision)
-        return cm
-    return processor
+    return pipeline.Step(vertex_ops=[("duplicates", precision)],
+                         message='Remove duplicate vertices')
 
 
 @cli.command('remove_orphan_vertices')
@@ -411,11 +514,8 @@ def remove_orphan_vertices_cmd():
     Only the geometry vertices are processed,
     and not those of the textures/templates.
     """
-    def processor(cm):
-        utils.print_cmd_status('Remove orphan vertices')
-        cm.remove_orphan_vertices()
-        return cm
-    return processor
+    return pipeline.Step(vertex_ops=[("orphans",)],
+                         message='Remove orphan vertices')
 
 
 @cli.command('remove_materials')
@@ -427,7 +527,7 @@ def remove_materials_cmd():
         utils.print_cmd_status('Remove all material')
         cm.remove_materials()
         return cm
-    return processor
+    return pipeline.Step(processor, reads=["appearance"], writes=["appearance"])
 
 
 @cli.command('compress')
@@ -442,12 +542,9 @@ def compress_cmd(digit):
         $ cjio myfile.json compress --digit 3 info
 
     """
-    def processor(cm):
-        utils.print_cmd_status('Compressing the CityJSON (with %d digit)' % digit)
-        if cm.compress(digit) == False:
-            click.echo("WARNING: CityJSON already compressed.")
-        return cm
-    return processor
+    return pipeline.Step(vertex_ops=[("compress", digit)],
+                         message='Compressing the CityJSON (with %d digit)' % digit,
+                         warning="WARNING: CityJSON already compressed.")
 
 
 @cli.command('decompress')
@@ -472,7 +569,7 @@ def remove_textures_cmd():
         utils.print_cmd_status('Remove all textures')
         cm.remove_textures()
         return cm
-    return processor
+    return pipeline.Step(processor, reads=["appearance"], writes=["appearance"])
 
 
 @cli.command('assign_epsg')
@@ -488,12 +585,13 @@ def update_crs_cmd(newepsg):
         utils.print_cmd_status('Assign EPSG:%d' % newepsg)
         cm.set_epsg(newepsg)
         return cm
-    return processor
+    return pipeline.Step(processor, reads=["metadata"], writes=["metadata"])
 
 
 @cli.command('reproject')
 @click.argument('epsg', type=int)
-def update_crs_cmd(epsg):
+@click.option('--jobs', default=1, type=click.IntRange(1, None), help='Number of threads reprojecting the vertices (default=1).')
+def update_crs_cmd(epsg, jobs):
     """
     Reproject the CityJSON to a new EPSG.
     The current file must have an EPSG defined (do it with function assign_epsg).
@@ -509,7 +607,7 @@ def update_crs_cmd(epsg):
         if (cm.get_epsg() == None):
             click.echo("WARNING: CityJSON has no EPSG defined, can't be reprojected.")
         else:    
-            cm.reproject(epsg)
+            cm.reproject(epsg, jobs=jobs)
         return cm
     return processor
 
@@ -542,7 +640,7 @@ def locate_textures_cmd():
         loc = cm.get_textures_location()
         click.echo(loc)
         return cm
-    return processor
+    return pipeline.Step(processor, reads=["appearance"], writes=[])
 
 
 @cli.command('update_textures')
@@ -557,7 +655,7 @@ def update_textures_cmd(newlocation, relative):
         utils.print_cmd_status('Update location of textures')
         cm.update_textures_location(newlocation, relative=relative)
         return cm
-    return processor
+    return pipeline.Step(processor, reads=["appearance"], writes=["appearance"])
 
 
 @cli.command('extract_lod')
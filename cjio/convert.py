@@ -1,7 +1,7 @@
 from io import BytesIO
 import json
 
-from cjio import geom_help
+from cjio import geom_help, boundaries
 
 MODULE_NUMPY_AVAILABLE = True
 try:
@@ -30,6 +30,100 @@ def byte_offset(x, byte_boundary):
     return (res, padding)
 
 
+def optimize_vertex_cache(triangles, nvertices, cache_size=16):
+    """Reorder triangles for the post-transform vertex cache of the GPU
+
+    Tipsify, from Sander, Nehab and Barczak (2007) "Fast triangle reordering
+    for vertex locality and reduced overdraw".
+
+    :param triangles: The (t, 3) array of the vertex indices of the triangles
+    :param nvertices: The number of vertices, all used by the triangles
+    :return: The order of the triangles
+    """
+    tris = triangles.tolist()
+    adjacency = [[] for v in range(nvertices)]
+    for t, tri in enumerate(tris):
+        for v in tri:
+            adjacency[v].append(t)
+    live = [len(a) for a in adjacency]
+    cache_time = [0] * nvertices
+    emitted = [False] * len(tris)
+    dead_end = []
+    order = []
+    stamp = cache_size + 1
+    cursor = 0
+    f = 0
+    while f >= 0:
+        candidates = []
+        for t in adjacency[f]:
+            if not emitted[t]:
+                for v in tris[t]:
+                    dead_end.append(v)
+                    if v not in candidates:
+                        candidates.append(v)
+                    live[v] -= 1
+                    if stamp - cache_time[v] > cache_size:
+                        cache_time[v] = stamp
+                        stamp += 1
+                emitted[t] = True
+                order.append(t)
+        #-- the next fanning vertex: still in the cache, and with live triangles
+        f = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                p = 0
+                if stamp - cache_time[v] + 2 * live[v] <= cache_size:
+                    p = stamp - cache_time[v]
+                if p > best:
+                    best = p
+                    f = v
+        if f == -1:
+            while len(dead_end) > 0:
+                d = dead_end.pop()
+                if live[d] > 0:
+                    f = d
+                    break
+        if f == -1:
+            while cursor < nvertices:
+                if live[cursor] > 0:
+                    f = cursor
+                    break
+                cursor += 1
+    return np.array(order, dtype=np.int64)
+
+
+def batch_table_column(values):
+    """The typed array of a column of the batch table, if it has only numbers
+
+    A column of ints (in 32 bits) is INT, the other columns of numbers are
+    DOUBLE, the missing values (None) being NaN.
+
+    :return: A tuple with the array and its componentType, or None if the
+        column must stay in the JSON
+    """
+    ints = True
+    numbers = 0
+    for v in values:
+        if v is None:
+            ints = False
+        elif isinstance(v, bool) or not isinstance(v, (int, float)):
+            return None
+        elif isinstance(v, int):
+            if abs(v) >= 2**53:
+                return None
+            ints = ints and (-2**31 <= v < 2**31)
+            numbers += 1
+        else:
+            ints = False
+            numbers += 1
+    if numbers == 0:
+        return None
+    if ints:
+        return (np.array(values, dtype='<i4'), "INT")
+    return (np.array([np.nan if v is None else v for v in values], dtype='<f8'), "DOUBLE")
+
+
 def to_b3dm(cm, glb):
     """Convert a CityJSON to batched 3d model"""
     # glb is a buffered I/O, as the output of to_gltf()
@@ -44,46 +138,50 @@ def to_b3dm(cm, glb):
         'BATCH_LENGTH': len(cm.j['CityObjects'])
     }).encode('utf-8')
     # The JSON header must end on an 8-byte boundary within the containing tile binary. The JSON header must be padded with trailing Space characters (0x20) to satisfy this requirement.
-    offset, padding = byte_offset(len(feature_table_header_b), 8)
+    offset, padding = byte_offset(28 + len(feature_table_header_b), 8)
     for i in range(padding):
         feature_table_header_b += ' '.encode('utf-8')
 
     #-- Batch table
-    attributes = set()
-    for coid,co in cm.j['CityObjects'].items():
-        try:
-            attributes |= set(co['attributes'].keys())
-        except KeyError:
-            pass
-    if len(attributes) > 0:
-        batch_table = {attribute: [] for attribute in attributes}
-        for coid,co in cm.j['CityObjects'].items():
-            for attribute in attributes:
-                try:
-                    batch_table[attribute].append(co['attributes'][attribute])
-                except KeyError:
-                    batch_table[attribute].append(None)
-    else:
-        batch_table = dict()
-    # TODO B: write the attributes into the binary body of the the batch table
+    # the attributes in columns, in one pass over the CityObjects
+    columns = dict()
+    for i, co in enumerate(cm.j['CityObjects'].values()):
+        for attribute, value in co.get('attributes', {}).items():
+            if attribute not in columns:
+                columns[attribute] = [None] * len(cm.j['CityObjects'])
+            columns[attribute][i] = value
+    # the numbers go in the binary body, the rest in the JSON header
+    batch_table = dict()
+    batch_table_bin = bytearray()
+    for attribute, values in columns.items():
+        column = batch_table_column(values)
+        if column is None:
+            batch_table[attribute] = values
+        else:
+            offset, padding = byte_offset(len(batch_table_bin), 8)
+            batch_table_bin.extend(bytearray(padding))
+            batch_table[attribute] = {"byteOffset": offset, "componentType": column[1], "type": "SCALAR"}
+            batch_table_bin.extend(column[0].tobytes())
     batch_table_header_b = json.dumps(batch_table).encode('utf-8')
-    offset, padding = byte_offset(len(batch_table_header_b), 8)
+    offset, padding = byte_offset(28 + len(feature_table_header_b) + len(batch_table_header_b), 8)
     for i in range(padding):
         batch_table_header_b += ' '.encode('utf-8')
+    offset, padding = byte_offset(len(batch_table_bin), 8)
+    batch_table_bin.extend(bytearray(padding))
 
     #-- binary glTF
     offset, padding = byte_offset(glb.tell(), 8)
     glb.write(bytearray(padding))
 
     # the b3dm header is 28-bytes
-    byte_length = 28 + len(feature_table_header_b) + len(batch_table_header_b) + glb.tell()
+    byte_length = 28 + len(feature_table_header_b) + len(batch_table_header_b) + len(batch_table_bin) + glb.tell()
     #-- b3dm Header
     magic = "b3dm"
     version = 1
     feature_table_json_blen = len(feature_table_header_b)
     feature_table_bin_blen = 0
     batch_table_json_blen = len(batch_table_header_b)
-    batch_table_bin_blen = 0
+    batch_table_bin_blen = len(batch_table_bin)
 
     b3dm_bin.write(magic.encode('utf-8'))
     b3dm_bin.write(version.to_bytes(4, byteorder='little', signed=False))
@@ -94,15 +192,99 @@ def to_b3dm(cm, glb):
     b3dm_bin.write(batch_table_bin_blen.to_bytes(4, byteorder='little', signed=False))
     b3dm_bin.write(feature_table_header_b)
     b3dm_bin.write(batch_table_header_b)
+    b3dm_bin.write(batch_table_bin)
     b3dm_bin.write(glb.getvalue())
 
     assert b3dm_bin.tell() == byte_length
 
     return b3dm_bin
 
-def to_glb(j):
+def material_id(comType, matid=0):
+    """The index of the material of a CityObject type, matid if it has none"""
+    if (comType == "Building" or comType == "BuildingPart" or comType == "BuildingInstallation"):
+        matid = 0
+    elif (comType == "TINRelief"):
+        matid = 1
+    elif (comType == "Road" or comType == "Railway" or comType == "TransportSquare"):
+        matid = 2
+    elif (comType == "WaterBody"):
+        matid = 3
+    elif (comType == "PlantCover" or comType == "SolitaryVegetationObject"):
+        matid = 4
+    elif (comType == "LandUse"):
+        matid = 5
+    elif (comType == "CityFurniture"):
+        matid = 6
+    elif (
+            comType == "Bridge" or comType == "BridgePart" or comType == "BridgeInstallation" or comType == "BridgeConstructionElement"):
+        matid = 7
+    elif (comType == "Tunnel" or comType == "TunnelPart" or comType == "TunnelInstallation"):
+        matid = 8
+    elif (comType == "GenericCityObject"):
+        matid = 9
+    return matid
+
+
+def instance_trs(matrix, reference):
+    """Decompose the transformation of a GeometryInstance
+
+    The 4x4 "transformationMatrix" (row-major) is split in a translation
+    (to which the reference point is added), a rotation and a scale. A
+    mirroring is a negative scale along x, a shear is lost.
+
+    :return: A tuple (translation, rotation, scale), the rotation being a
+        quaternion (x, y, z, w)
+    """
+    m = np.array(matrix, dtype=np.float64).reshape(4, 4)
+    a = m[:3, :3]
+    scale = np.sqrt((a ** 2).sum(axis=0))
+    scale[scale == 0] = 1.0
+    r = a / scale
+    if np.linalg.det(r) < 0:
+        scale[0] = -scale[0]
+        r[:, 0] = -r[:, 0]
+    #-- the closest rotation
+    u, sv, vt = np.linalg.svd(r)
+    r = np.dot(u, vt)
+    tr = r[0, 0] + r[1, 1] + r[2, 2]
+    if tr > 0:
+        k = np.sqrt(tr + 1.0) * 2
+        q = [(r[2, 1] - r[1, 2]) / k, (r[0, 2] - r[2, 0]) / k, (r[1, 0] - r[0, 1]) / k, 0.25 * k]
+    elif (r[0, 0] > r[1, 1]) and (r[0, 0] > r[2, 2]):
+        k = np.sqrt(1.0 + r[0, 0] - r[1, 1] - r[2, 2]) * 2
+        q = [0.25 * k, (r[0, 1] + r[1, 0]) / k, (r[0, 2] + r[2, 0]) / k, (r[2, 1] - r[1, 2]) / k]
+    elif r[1, 1] > r[2, 2]:
+        k = np.sqrt(1.0 + r[1, 1] - r[0, 0] - r[2, 2]) * 2
+        q = [(r[0, 1] + r[1, 0]) / k, 0.25 * k, (r[1, 2] + r[2, 1]) / k, (r[0, 2] - r[2, 0]) / k]
+    else:
+        k = np.sqrt(1.0 + r[2, 2] - r[0, 0] - r[1, 1]) * 2
+        q = [(r[0, 2] + r[2, 0]) / k, (r[1, 2] + r[2, 1]) / k, 0.25 * k, (r[1, 0] - r[0, 1]) / k]
+    return (m[:3, 3] + reference, np.array(q), scale)
+
+
+def to_glb(j, jobs=1, triangles=None, indexed=True, quantize=False, normals=False):
     """Convert to Binary glTF (.glb)
 
+    The faces are triangulated by 'jobs' processes, unless their 'triangles'
+    are given (as returned by CityJSON.get_triangulation()).
+
+    There is one mesh per CityObject. The indices of all the meshes are in
+    one bufferView (16-bit when possible), and their vertices in another one,
+    with the POSITION and the _BATCHID (the index of the CityObject)
+    interleaved. If 'indexed', the triangles of a CityObject share their
+    vertices, else each corner of a triangle is a vertex.
+
+    With 'normals', the (flat) normals of the faces are added, the vertices of
+    a CityObject are then shared only by the triangles with the same normal.
+
+    With 'quantize', the file uses KHR_mesh_quantization: the positions are
+    int16 (the node of a CityObject scales and translates them back), the
+    normals int8, and the triangles are reordered for the vertex cache.
+
+    The templates of the GeometryInstances are triangulated once, each is one
+    mesh drawn at all its instances with EXT_mesh_gpu_instancing; the
+    _BATCHID is then an attribute of the instances.
+
     Adapted from CityJSON2glTF: https://github.com/tudelft3d/CityJSON2glTF
     """
     gltf_json = {
@@ -130,179 +312,294 @@ def to_glb(j):
     asset["version"] = "2.0"
     gltf_json["asset"] = asset
 
-    # index bufferview
-    bufferViews = []
     meshes = []
-    poscount = 0
     nodes = []
     node_indices = []
     accessors = []
     matid = 0
-    material_ids = []
 
-    vertexlist = np.array(j["vertices"])
+    vertexlist = np.array(j["vertices"], dtype=np.float64).reshape(-1, 3)
+    #-- in the coordinates of the templates
+    if "transform" in j:
+        vertexlist = (vertexlist * np.array(j["transform"]["scale"])) + np.array(j["transform"]["translate"])
+    #-- all the faces are triangulated at once
+    if triangles is None:
+        geometries, owners = boundaries.collect(j)
+        triangles = geom_help.triangulate_geometries(geometries, vertexlist, jobs, owners)
+    triangles, tri_normals, tri_offsets = triangles
+
+    #-- the vertices of all the CityObjects go in one bufferView, with their
+    #-- POSITION and _BATCHID interleaved, and their indices in another one
+    if len(j['CityObjects']) <= 65536:
+        batchid_type, batchid_dtype = 5123, '<u2'
+    else:
+        batchid_type, batchid_dtype = 5126, '<f4'
+    # each attribute starts on 4 bytes
+    attributes = [('position', ('<i2' if quantize else '<f4', (3,)), 8 if quantize else 12)]
+    if normals:
+        attributes.append(('normal', ('<i1' if quantize else '<f4', (3,)), 4 if quantize else 12))
+    attributes.append(('batchid', batchid_dtype, 4))
+    vertex_dtype = np.dtype({'names': [a[0] for a in attributes],
+                             'formats': [a[1] for a in attributes],
+                             'offsets': [sum(a[2] for a in attributes[:i]) for i in range(len(attributes))],
+                             'itemsize': sum(a[2] for a in attributes)})
+    if quantize:
+        gltf_json["extensionsUsed"] = ["KHR_mesh_quantization"]
+        gltf_json["extensionsRequired"] = ["KHR_mesh_quantization"]
+    vertex_bin = bytearray()
+    index_bin = bytearray()
+    gi = 0
+    #-- the instances of each template, (index of the CityObject, its type, geometry)
+    instances = {}
 
     for coi,theid in enumerate(j['CityObjects']):
-        forimax = []
-
-        if len(j['CityObjects'][theid]['geometry']) != 0:
-
-            comType = j['CityObjects'][theid]['type']
-            if (comType == "Building" or comType == "BuildingPart" or comType == "BuildingInstallation"):
-                matid = 0
-            elif (comType == "TINRelief"):
-                matid = 1
-            elif (comType == "Road" or comType == "Railway" or comType == "TransportSquare"):
-                matid = 2
-            elif (comType == "WaterBody"):
-                matid = 3
-            elif (comType == "PlantCover" or comType == "SolitaryVegetationObject"):
-                matid = 4
-            elif (comType == "LandUse"):
-                matid = 5
-            elif (comType == "CityFurniture"):
-                matid = 6
-            elif (
-                    comType == "Bridge" or comType == "BridgePart" or comType == "BridgeInstallation" or comType == "BridgeConstructionElement"):
-                matid = 7
-            elif (comType == "Tunnel" or comType == "TunnelPart" or comType == "TunnelInstallation"):
-                matid = 8
-            elif (comType == "GenericCityObject"):
-                matid = 9
-            material_ids.append(matid)
-
-            for geom in j['CityObjects'][theid]['geometry']:
-                poscount = poscount + 1
-                if geom['type'] == "Solid":
-                    triList = []
-                    for shell in geom['boundaries']:
-                        for face in shell:
-                            tri = geom_help.triangulate_face(face, vertexlist)
-                            for t in tri:
-                                triList.append(list(t))
-                    trigeom = (flatten(triList))
-
-                elif (geom['type'] == 'MultiSurface') or (geom['type'] == 'CompositeSurface'):
-                    triList = []
-                    for face in geom['boundaries']:
-                        tri = geom_help.triangulate_face(face, vertexlist)
-                        for t in tri:
-                            triList.append(t)
-                    trigeom = (flatten(triList))
-                flatgeom = trigeom
-                forimax.append(flatgeom)
-
-            #----- buffer and bufferView
-            flatgeom = flatten(forimax)
-            vtx_np = np.zeros((len(flatgeom), 3))
-            vtx_idx_np = np.zeros(len(flatgeom))
-            # need to reindex the vertices, otherwise if the vtx index exceeds the nr. of vertices in the
-            # accessor then we get "ACCESSOR_INDEX_OOB" error
-            for i,v in enumerate(flatgeom):
-                vtx_np[i] = vertexlist[v]
-                vtx_idx_np[i] = i
-            bin_vtx = vtx_np.astype(np.float32).tostring()
-            # convert geometry indices to binary
-            bin_geom = vtx_idx_np.astype(np.uint32).tostring()
-            # convert batchid to binary
-            batchid_np = np.array([i for g in vtx_idx_np])
-            bin_batchid = batchid_np.astype(np.uint32).tostring()
-
-            #-- geometry indices bufferView
-            bpos = len(gltf_bin)
-            offset, padding = byte_offset(bpos, 4)
-            bufferView = dict()
-            bufferView["buffer"] = 0
-            bufferView["byteOffset"] = offset
-            bufferView["byteLength"] = len(bin_geom)
-            bufferView["target"] = 34963 # For 'target' property constants see: https://github.com/KhronosGroup/glTF-Tutorials/blob/master/gltfTutorial/gltfTutorial_005_BuffersBufferViewsAccessors.md#bufferviews
-            # write to the buffer
-            gltf_bin.extend(bin_geom)
-            gltf_bin.extend(bytearray(padding))
-            bufferViews.append(bufferView)
-
-            #-- geometry vertices bufferView
-            bpos = len(gltf_bin)
-            offset, padding = byte_offset(bpos, 4)
-            bufferView = dict()
-            bufferView["buffer"] = 0
-            bufferView["byteOffset"] = offset
-            bufferView["byteStride"] = 12
-            bufferView["byteLength"] = len(bin_vtx)
-            bufferView["target"] = 34962
-            # write to the buffer
-            gltf_bin.extend(bin_vtx)
-            gltf_bin.extend(bytearray(padding))
-            bufferViews.append(bufferView)
-
-            #-- batchid bufferView
-            bpos = len(gltf_bin)
-            offset, padding = byte_offset(bpos, 4)
-            bufferView = dict()
-            bufferView["buffer"] = 0
-            bufferView["byteOffset"] = offset
-            bufferView["byteStride"] = 4
-            bufferView["byteLength"] = len(bin_batchid)
-            bufferView["target"] = 34962
-            # write to the buffer
-            gltf_bin.extend(bin_batchid)
-            gltf_bin.extend(bytearray(padding))
-            bufferViews.append(bufferView)
+        for g in j['CityObjects'][theid].get('geometry', []):
+            if g['type'] == 'GeometryInstance':
+                instances.setdefault(g['template'], []).append((coi, j['CityObjects'][theid]['type'], g))
+        ngeoms = len(j['CityObjects'][theid].get('geometry', []))
+        t0, t1 = tri_offsets[gi], tri_offsets[gi + ngeoms]
+        cotriangles = triangles[t0:t1]
+        gi += ngeoms
+
+        if len(cotriangles) != 0:
+
+            matid = material_id(j['CityObjects'][theid]['type'], matid)
+
+            #----- vertices and indices
+            corners = cotriangles.reshape(-1)
+            if normals:
+                conormals = tri_normals[t0:t1]
+                if quantize:
+                    conormals = np.rint(conormals * 127)
+                unormals, normal_ids = np.unique(conormals, axis=0, return_inverse=True)
+                # a vertex is a pair (vertex, normal)
+                corners = corners * len(unormals) + np.repeat(normal_ids.reshape(-1), 3)
+            if indexed:
+                # the vertices of the CityObject are shared by its triangles, their indices
+                # are local to the CityObject
+                used, local = np.unique(corners, return_inverse=True)
+                local = local.reshape(-1, 3)
+            else:
+                used = corners
+                local = np.arange(len(used)).reshape(-1, 3)
+            if quantize:
+                local = local[optimize_vertex_cache(local, len(used))]
+                # the vertices in the order they are first used
+                u, first = np.unique(local, return_index=True)
+                order = u[np.argsort(first)]
+                rank = np.empty_like(order)
+                rank[order] = np.arange(len(order))
+                used = used[order]
+                local = rank[local]
+            local = local.reshape(-1)
+            vtx = np.zeros(len(used), dtype=vertex_dtype)
+            if normals:
+                vtx['normal'] = unormals[used % len(unormals)]
+                used = used // len(unormals)
+            positions = vertexlist[used]
+            node = {}
+            if quantize:
+                # the positions in [-32767, 32767] in a cube around the CityObject
+                pmin = positions.min(axis=0)
+                extent = float((positions.max(axis=0) - pmin).max())
+                scale = extent / 65534 if extent > 0 else 1.0
+                vtx['position'] = np.rint((positions - pmin) / scale) - 32767
+                node["translation"] = (pmin + 32767 * scale).tolist()
+                node["scale"] = [scale, scale, scale]
+            else:
+                vtx['position'] = positions
+            vtx['batchid'] = coi
+            # 65535 is the primitive restart value of unsigned short indices
+            if len(used) < 65535:
+                bin_geom = local.astype('<u2').tobytes()
+                index_type = 5123
+            else:
+                bin_geom = local.astype('<u4').tobytes()
+                index_type = 5125
 
             # ----- accessors
 
             # accessor for geometry indices bufferView
             accessor = dict()
-            accessor["bufferView"] = 0 if coi == 0  else coi * 3
-            accessor["componentType"] = 5125
-            accessor["count"] = int(vtx_idx_np.size)
+            accessor["bufferView"] = "indices"
+            accessor["byteOffset"] = len(index_bin)
+            accessor["componentType"] = index_type
+            accessor["count"] = int(local.size)
             accessor["type"] = "SCALAR"
-            accessor["max"] = [int(vtx_idx_np.max())]
-            accessor["min"] = [int(vtx_idx_np.min())]
+            accessor["max"] = [int(local.max())]
+            accessor["min"] = [int(local.min())]
             accessors.append(accessor)
+            index_bin.extend(bin_geom)
+            offset, padding = byte_offset(len(index_bin), 4)
+            index_bin.extend(bytearray(padding))
 
+            primitive_attributes = dict()
             # accessor for geometry vertices bufferView
             accessor = dict()
-            accessor["bufferView"] = 1 if coi == 0  else coi * 3 + 1
-            accessor["componentType"] = 5126
-            accessor["count"] = int(vtx_idx_np.size)
+            accessor["bufferView"] = "vertices"
+            accessor["byteOffset"] = len(vertex_bin) + vertex_dtype.fields['position'][1]
+            accessor["componentType"] = 5122 if quantize else 5126
+            accessor["count"] = len(used)
             accessor["type"] = "VEC3"
-            accessor["max"] = [float(np.amax(vtx_np, axis=0)[0]),
-                               float(np.amax(vtx_np, axis=0)[1]),
-                               float(np.amax(vtx_np, axis=0)[2])]
-            accessor["min"] = [float(np.amin(vtx_np, axis=0)[0]),
-                               float(np.amin(vtx_np, axis=0)[1]),
-                               float(np.amin(vtx_np, axis=0)[2])]
+            accessor["max"] = vtx['position'].max(axis=0).tolist()
+            accessor["min"] = vtx['position'].min(axis=0).tolist()
             accessors.append(accessor)
+            primitive_attributes["POSITION"] = len(accessors) - 1
+
+            if normals:
+                accessor = dict()
+                accessor["bufferView"] = "vertices"
+                accessor["byteOffset"] = len(vertex_bin) + vertex_dtype.fields['normal'][1]
+                accessor["componentType"] = 5120 if quantize else 5126
+                if quantize:
+                    accessor["normalized"] = True
+                accessor["count"] = len(used)
+                accessor["type"] = "VEC3"
+                accessors.append(accessor)
+                primitive_attributes["NORMAL"] = len(accessors) - 1
 
             # accessor for batchid bufferView
             accessor = dict()
-            accessor["bufferView"] = 2 if coi == 0  else coi * 3 + 2
-            accessor["componentType"] = 5123
-            accessor["count"] = int(vtx_idx_np.size)
+            accessor["bufferView"] = "vertices"
+            accessor["byteOffset"] = len(vertex_bin) + vertex_dtype.fields['batchid'][1]
+            accessor["componentType"] = batchid_type
+            accessor["count"] = len(used)
             accessor["type"] = "SCALAR"
             accessors.append(accessor)
+            primitive_attributes["_BATCHID"] = len(accessors) - 1
+            vertex_bin.extend(vtx.tobytes())
 
             # ----- meshes
             # one mesh per CityObject
             mesh = dict()
             mesh["name"] = str(theid)
             mesh["primitives"] = [{
-                "indices": len(accessors) - 3,
+                "indices": len(accessors) - 1 - len(primitive_attributes),
                 "material": matid,
-                "attributes": {
-                    "_BATCHID": len(accessors) - 1,
-                    "POSITION": len(accessors) - 2,
-                }
+                "attributes": primitive_attributes
             }]
             meshes.append(mesh)
 
             # ----- nodes
             # a node has a mesh, and the mesh is referenced by its index in the meshes
             # , "matrix": [1,0,0,0,0,0,-1,0,0,1,0,0,0,0,0,1]}
-            nodes.append({"mesh": coi})
+            node["mesh"] = len(meshes) - 1
+            nodes.append(node)
             # one node per CityObject
-            node_indices.append(coi)
+            node_indices.append(len(nodes) - 1)
+
+    #-- the templates, each one mesh with a node drawing all its instances
+    template_bin = bytearray()
+    instance_bin = bytearray()
+    template_attributes = [('position', ('<f4', (3,)), 12)]
+    if normals:
+        template_attributes.append(('normal', ('<i1' if quantize else '<f4', (3,)), 4 if quantize else 12))
+    template_dtype = np.dtype({'names': [a[0] for a in template_attributes],
+                               'formats': [a[1] for a in template_attributes],
+                               'offsets': [sum(a[2] for a in template_attributes[:i]) for i in range(len(template_attributes))],
+                               'itemsize': sum(a[2] for a in template_attributes)})
+    if len(instances) > 0:
+        templates = j.get('geometry-templates', {}).get('templates', [])
+        used_templates = sorted(t for t in instances if t < len(templates))
+        template_vertices = np.array(j.get('geometry-templates', {}).get('vertices-templates', []),
+                                     dtype=np.float64).reshape(-1, 3)
+        ttriangles, tnormals, toffsets = geom_help.triangulate_geometries(
+            [templates[t] for t in used_templates], template_vertices, jobs)
+        for ti, t in enumerate(used_templates):
+            t0, t1 = toffsets[ti], toffsets[ti + 1]
+            if t1 == t0:
+                continue
+            corners = ttriangles[t0:t1].reshape(-1)
+            if normals:
+                tn = tnormals[t0:t1]
+                if quantize:
+                    tn = np.rint(tn * 127)
+                unormals, normal_ids = np.unique(tn, axis=0, return_inverse=True)
+                corners = corners * len(unormals) + np.repeat(normal_ids.reshape(-1), 3)
+            used, local = np.unique(corners, return_inverse=True)
+            vtx = np.zeros(len(used), dtype=template_dtype)
+            if normals:
+                vtx['normal'] = unormals[used % len(unormals)]
+                used = used // len(unormals)
+            vtx['position'] = template_vertices[used]
+            if len(used) < 65535:
+                bin_geom = local.astype('<u2').tobytes()
+                index_type = 5123
+            else:
+                bin_geom = local.astype('<u4').tobytes()
+                index_type = 5125
+            accessors.append({"bufferView": "indices", "byteOffset": len(index_bin),
+                              "componentType": index_type, "count": int(local.size), "type": "SCALAR",
+                              "max": [int(local.max())], "min": [int(local.min())]})
+            index_bin.extend(bin_geom)
+            offset, padding = byte_offset(len(index_bin), 4)
+            index_bin.extend(bytearray(padding))
+            primitive_attributes = dict()
+            accessors.append({"bufferView": "templates",
+                              "byteOffset": len(template_bin) + template_dtype.fields['position'][1],
+                              "componentType": 5126, "count": len(used), "type": "VEC3",
+                              "max": vtx['position'].max(axis=0).tolist(),
+                              "min": vtx['position'].min(axis=0).tolist()})
+            primitive_attributes["POSITION"] = len(accessors) - 1
+            if normals:
+                accessor = {"bufferView": "templates",
+                            "byteOffset": len(template_bin) + template_dtype.fields['normal'][1],
+                            "componentType": 5120 if quantize else 5126, "count": len(used), "type": "VEC3"}
+                if quantize:
+                    accessor["normalized"] = True
+                accessors.append(accessor)
+                primitive_attributes["NORMAL"] = len(accessors) - 1
+            template_bin.extend(vtx.tobytes())
+            meshes.append({
+                "name": "template-%d" % t,
+                "primitives": [{
+                    "indices": len(accessors) - 1 - len(primitive_attributes),
+                    "material": material_id(instances[t][0][1]),
+                    "attributes": primitive_attributes
+                }]
+            })
+
+            #-- the instances, each one TRS and the _BATCHID of its CityObject, one
+            #-- attribute after the other (they are not vertex attributes)
+            trs = [instance_trs(g.get('transformationMatrix', np.identity(4).reshape(-1)),
+                                vertexlist[g['boundaries'][0]]) for coi, cotype, g in instances[t]]
+            instance_attributes = dict()
+            for name, gltf_type, values in (("TRANSLATION", "VEC3", [a[0] for a in trs]),
+                                            ("ROTATION", "VEC4", [a[1] for a in trs]),
+                                            ("SCALE", "VEC3", [a[2] for a in trs]),
+                                            ("_BATCHID", "SCALAR", [i[0] for i in instances[t]])):
+                accessors.append({"bufferView": "instances", "byteOffset": len(instance_bin),
+                                  "componentType": 5126, "count": len(trs), "type": gltf_type})
+                instance_attributes[name] = len(accessors) - 1
+                instance_bin.extend(np.array(values, dtype='<f4').tobytes())
+            nodes.append({"mesh": len(meshes) - 1,
+                          "extensions": {"EXT_mesh_gpu_instancing": {"attributes": instance_attributes}}})
+            node_indices.append(len(nodes) - 1)
+    if len(instance_bin) > 0:
+        for k in ("extensionsUsed", "extensionsRequired"):
+            gltf_json[k] = gltf_json.get(k, []) + ["EXT_mesh_gpu_instancing"]
+
+    #-- bufferViews
+    # For 'target' property constants see: https://github.com/KhronosGroup/glTF-Tutorials/blob/master/gltfTutorial/gltfTutorial_005_BuffersBufferViewsAccessors.md#bufferviews
+    bufferViews = []
+    views = {}
+    for name, view_bin, stride, target in (("indices", index_bin, None, 34963),
+                                           ("vertices", vertex_bin, vertex_dtype.itemsize, 34962),
+                                           ("templates", template_bin, template_dtype.itemsize, 34962),
+                                           ("instances", instance_bin, None, None)):
+        if len(view_bin) == 0:
+            continue
+        view = {"buffer": 0, "byteOffset": len(gltf_bin)}
+        if stride is not None:
+            view["byteStride"] = stride
+        view["byteLength"] = len(view_bin)
+        if target is not None:
+            view["target"] = target
+        views[name] = len(bufferViews)
+        bufferViews.append(view)
+        gltf_bin.extend(view_bin)
+    for accessor in accessors:
+        accessor["bufferView"] = views[accessor["bufferView"]]
 
     #-- buffers
     buffer = dict()
@@ -1,4 +1,9 @@
 import math
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from cjio import boundaries
 
 # FIXME: temporary solution to make Numpy conditional because of PyInstaller issues on Windows
 # Traceback (most recent call last):
@@ -47,51 +52,267 @@ def to_2d(p, n):
 
 def get_normal_newell(poly):
     # find normal with Newell's method
-    # print (poly)
-    n = np.array([0.0, 0.0, 0.0], dtype=np.float64)
-    # if len(poly) == 0:
-    #     print ("NOPOINTS")
-    for i,p in enumerate(poly):
-        ne = i + 1
-        if (ne == len(poly)):
-            ne = 0
-        n[0] += ( (poly[i][1] - poly[ne][1]) * (poly[i][2] + poly[ne][2]) )
-        n[1] += ( (poly[i][2] - poly[ne][2]) * (poly[i][0] + poly[ne][0]) )
-        n[2] += ( (poly[i][0] - poly[ne][0]) * (poly[i][1] + poly[ne][1]) )
-    
+    poly = np.asarray(poly, dtype=np.float64)
+    nxt = np.roll(poly, -1, axis=0)
+    n = np.array([((poly[:, 1] - nxt[:, 1]) * (poly[:, 2] + nxt[:, 2])).sum(),
+                  ((poly[:, 2] - nxt[:, 2]) * (poly[:, 0] + nxt[:, 0])).sum(),
+                  ((poly[:, 0] - nxt[:, 0]) * (poly[:, 1] + nxt[:, 1])).sum()])
     if (n==np.array([0.0, 0.0, 0.0])).all():
-        # print("one wrong")
         return (n, False)
     n = n / math.sqrt(n[0]*n[0] + n[1]*n[1] + n[2]*n[2])    
     return (n, True)
 
 
-def triangulate_face(face, vnp):
-    if not MODULE_EARCUT_AVAILABLE:
+def faces_to_arrays(faces):
+    """Flatten a list of faces (each a list of rings)
+
+    :return: A tuple (flat, ring_offsets, face_offsets): the vertex indices of
+        all the rings one after the other, ring i is
+        flat[ring_offsets[i]:ring_offsets[i+1]] and the rings of face f are
+        those from face_offsets[f] to face_offsets[f+1]
+    """
+    flat, (nrings, lrings) = boundaries.flatten(faces, 3)
+    return (np.array(flat, dtype=np.int64).reshape(-1),
+            np.concatenate(([0], np.cumsum(lrings, dtype=np.int64))),
+            np.concatenate(([0], np.cumsum(nrings, dtype=np.int64))))
+
+
+def geometries_to_arrays(geometries):
+    """Flatten the faces of the MultiSurfaces, CompositeSurfaces and Solids
+
+    The other geometries have no faces.
+
+    :return: A tuple (flat, ring_offsets, face_offsets, geometry_offsets), as
+        for faces_to_arrays(), and the faces of geometry g are those from
+        geometry_offsets[g] to geometry_offsets[g+1]
+    """
+    flat = []
+    nrings = []
+    lrings = []
+    nfaces = []
+    for g in geometries:
+        if (g['type'] == 'MultiSurface') or (g['type'] == 'CompositeSurface'):
+            level, lengths = boundaries.flatten(g['boundaries'], 3)
+        elif g['type'] == 'Solid':
+            level, lengths = boundaries.flatten(g['boundaries'], 4)
+            lengths = lengths[1:]
+        else:
+            nfaces.append(0)
+            continue
+        flat.extend(level)
+        nrings.extend(lengths[0])
+        lrings.extend(lengths[1])
+        nfaces.append(len(lengths[0]))
+    return (np.array(flat, dtype=np.int64).reshape(-1),
+            np.concatenate(([0], np.cumsum(lrings, dtype=np.int64))),
+            np.concatenate(([0], np.cumsum(nrings, dtype=np.int64))),
+            np.concatenate(([0], np.cumsum(nfaces, dtype=np.int64))))
+
+
+def get_normals_newell(v, face_starts):
+    """Normals of many faces with Newell's method
+
+    Like get_normal_newell() the points of all the rings of a face are taken
+    as one polygon.
+
+    :param v: The (n, 3) array of the points of the faces, one after the other
+    :param face_starts: The (f+1) positions in v where the faces start
+    :return: A tuple with the (f, 3) array of the normals and the (f) array
+        telling which ones could be computed (the others are 0)
+    """
+    f = len(face_starts) - 1
+    sizes = np.diff(face_starts)
+    nonempty = sizes > 0
+    nxt = np.arange(1, len(v) + 1)
+    nxt[face_starts[1:][nonempty] - 1] = face_starts[:-1][nonempty]
+    w = v[nxt[:len(v)]] if len(v) > 0 else v
+    c = np.column_stack(((v[:, 1] - w[:, 1]) * (v[:, 2] + w[:, 2]),
+                         (v[:, 2] - w[:, 2]) * (v[:, 0] + w[:, 0]),
+                         (v[:, 0] - w[:, 0]) * (v[:, 1] + w[:, 1])))
+    n = np.zeros((f, 3), dtype=np.float64)
+    if nonempty.any():
+        n[nonempty] = np.add.reduceat(c, face_starts[:-1][nonempty], axis=0)
+    valid = (n != 0.0).any(axis=1)
+    n[valid] /= np.sqrt((n[valid] ** 2).sum(axis=1))[:, None]
+    return (n, valid)
+
+
+def to_2d_batch(v, n):
+    """Project each point of v on the plane of its normal (a row of n)
+
+    The same projection as to_2d(), for arrays of points and normals.
+    """
+    x3 = 1.1 - (1.1 * n.sum(axis=1))[:, None] * n
+    x3 /= np.sqrt((x3 ** 2).sum(axis=1))[:, None]
+    y3 = np.cross(n, x3)
+    return np.column_stack(((v * x3).sum(axis=1), (v * y3).sum(axis=1)))
+
+
+def triangulate_faces(flat, ring_offsets, face_offsets, vnp):
+    """Triangulate many faces at once
+
+    The normals and the projections to 2D of all the faces are computed
+    together. The triangles are kept as they are, the convex quads are cut in
+    two triangles (as earcut would), and only the other faces are given to
+    earcut. The faces whose normal can't be computed are skipped (but not the
+    triangles).
+
+    :param flat: The vertex indices of the rings, see faces_to_arrays()
+    :param ring_offsets: Where the rings start in flat
+    :param face_offsets: Where the faces start in the rings
+    :param vnp: The (N, 3) array of the vertices
+    :return: A tuple (triangles, tri_faces, normals, valid): the (t, 3) array
+        of the vertex indices of the triangles, the face of each triangle, and
+        the normal of each face and if it could be computed
+    """
+    f = len(face_offsets) - 1
+    face_starts = ring_offsets[face_offsets]
+    sizes = np.diff(face_starts)
+    nrings = np.diff(face_offsets)
+    v = np.asarray(vnp, dtype=np.float64)[flat].reshape(-1, 3)
+    n, valid = get_normals_newell(v, face_starts)
+    single = nrings == 1
+    tri = single & (sizes == 3)
+    quad = single & (sizes == 4) & valid
+    s = face_starts[:-1]
+    if quad.any():
+        vf = np.repeat(np.arange(f), sizes)
+        qs = s[quad]
+        qi = qs[:, None] + np.arange(4)
+        xy = to_2d_batch(v[qi.reshape(-1)], n[vf[qi.reshape(-1)]]).reshape(-1, 4, 2)
+        d = np.roll(xy, -1, axis=1) - xy
+        cross = d[:, :, 0] * np.roll(d, -1, axis=1)[:, :, 1] - d[:, :, 1] * np.roll(d, -1, axis=1)[:, :, 0]
+        convex = (cross > 0).all(axis=1) | (cross < 0).all(axis=1)
+        ccw = cross[:, 0] > 0
+        quad[quad] = convex
+        qs = qs[convex]
+        ccw = ccw[convex]
+    rest = np.flatnonzero(valid & ~tri & ~quad & (sizes > 0))
+    if (len(rest) > 0) and not MODULE_EARCUT_AVAILABLE:
         raise ModuleNotFoundError("mapbox-earcut is not installed")
+    #-- earcut, on the faces left
+    earcut = []
+    if len(rest) > 0:
+        restv = np.concatenate([np.arange(face_starts[i], face_starts[i + 1]) for i in rest])
+        xy = to_2d_batch(v[restv], n[np.repeat(rest, sizes[rest])])
+        pos = 0
+        for i in rest.tolist():
+            ends = (ring_offsets[face_offsets[i] + 1:face_offsets[i + 1] + 1] - face_starts[i]).astype(np.uint32)
+            result = mapbox_earcut.triangulate_float64(xy[pos:pos + sizes[i]], ends)
+            earcut.append(flat[face_starts[i] + result.astype(np.int64)].reshape(-1, 3))
+            pos += sizes[i]
+    #-- number of triangles of each face, and where they go
+    counts = np.zeros(f, dtype=np.int64)
+    counts[tri] = 1
+    counts[quad] = 2
+    counts[rest] = [len(t) for t in earcut]
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    triangles = np.zeros((offsets[-1], 3), dtype=np.int64)
+    if tri.any():
+        triangles[offsets[:-1][tri]] = flat[s[tri][:, None] + np.arange(3)]
+    if quad.any():
+        q = flat[qs[:, None] + np.arange(4)]
+        o = offsets[:-1][quad]
+        #-- the triangles that earcut makes, depending on the orientation
+        triangles[o] = np.where(ccw[:, None], q[:, [2, 3, 0]], q[:, [1, 0, 3]])
+        triangles[o + 1] = np.where(ccw[:, None], q[:, [2, 0, 1]], q[:, [1, 3, 2]])
+    for i, t in zip(rest.tolist(), earcut):
+        triangles[offsets[i]:offsets[i + 1]] = t
+    return (triangles, np.repeat(np.arange(f), counts), n, valid)
+
+
+def _compact(a, n):
+    """The smallest unsigned type for indices up to n"""
+    return a.astype(np.uint32 if n < 2**32 else np.uint64)
+
+
+def _triangulate_chunk(path, flat, ring_offsets, face_offsets):
+    #-- the vertices are read from the file shared by all the processes
+    vnp = np.load(path, mmap_mode='r')
+    triangles, tri_faces, n, valid = triangulate_faces(flat, ring_offsets, face_offsets, vnp)
+    return (_compact(triangles, len(vnp)), _compact(tri_faces, len(face_offsets)), n, valid)
+
+
+def _chunk_geometries(geometry_offsets, owners, nchunks):
+    """Cut the geometries in about nchunks ranges with the same number of faces
+
+    A range does not cut the geometries of a CityObject (the same owner).
+    """
+    total = geometry_offsets[-1]
+    cuts = [0]
+    for k in range(1, nchunks):
+        g = int(np.searchsorted(geometry_offsets, total * k // nchunks))
+        if owners is not None:
+            while 0 < g < len(owners) and owners[g] == owners[g - 1]:
+                g += 1
+        if g > cuts[-1] and g < len(geometry_offsets) - 1:
+            cuts.append(g)
+    cuts.append(len(geometry_offsets) - 1)
+    return cuts
+
+
+def triangulate_faces_parallel(flat, ring_offsets, face_offsets, geometry_offsets,
+                               vnp, jobs, owners=None):
+    """triangulate_faces() with several processes
+
+    The geometries are split in chunks (the geometries of a CityObject stay in
+    one chunk), each triangulated by a process. The vertices are written once
+    to a temporary file that the processes map in memory, instead of being
+    sent to each of them. The results are put back in the order of the
+    geometries, and are the same as with triangulate_faces().
+
+    :param geometry_offsets: Where the geometries start in the faces, see
+        geometries_to_arrays()
+    :param jobs: The number of processes
+    :param owners: The CityObject of each geometry
+    """
+    cuts = _chunk_geometries(geometry_offsets, owners, jobs * 4)
+    fd, path = tempfile.mkstemp(suffix='.npy')
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            np.save(fout, np.ascontiguousarray(vnp, dtype=np.float64).reshape(-1, 3))
+        args = []
+        for g0, g1 in zip(cuts[:-1], cuts[1:]):
+            f0, f1 = geometry_offsets[g0], geometry_offsets[g1]
+            r0, r1 = face_offsets[f0], face_offsets[f1]
+            v0, v1 = ring_offsets[r0], ring_offsets[r1]
+            args.append((flat[v0:v1], ring_offsets[r0:r1 + 1] - v0, face_offsets[f0:f1 + 1] - r0))
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(_triangulate_chunk, [path] * len(args), *zip(*args)))
+    finally:
+        os.remove(path)
+    starts = [geometry_offsets[g] for g in cuts[:-1]]
+    triangles = np.concatenate([np.zeros((0, 3), dtype=np.int64)] +
+                               [r[0].astype(np.int64) for r in results])
+    tri_faces = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                               [r[1].astype(np.int64) + f0 for r, f0 in zip(results, starts)])
+    n = np.concatenate([np.zeros((0, 3), dtype=np.float64)] + [r[2] for r in results])
+    valid = np.concatenate([np.zeros(0, dtype=bool)] + [r[3] for r in results])
+    return (triangles, tri_faces, n, valid)
+
+
+def triangulate_geometries(geometries, vnp, jobs=1, owners=None):
+    """Triangulate the faces of a list of geometries, see triangulate_faces()
+
+    :param jobs: The number of processes, see triangulate_faces_parallel()
+    :param owners: The CityObject of each geometry
+    :return: A tuple (triangles, normals, offsets): the (t, 3) array of the
+        vertex indices of the triangles, the normal of the face of each
+        triangle, and the triangles of geometry g are those from offsets[g]
+        to offsets[g+1]
+    """
+    flat, ring_offsets, face_offsets, geometry_offsets = geometries_to_arrays(geometries)
+    if (jobs > 1) and (len(geometries) > 1):
+        triangles, tri_faces, n, valid = triangulate_faces_parallel(
+            flat, ring_offsets, face_offsets, geometry_offsets, vnp, jobs, owners)
+    else:
+        triangles, tri_faces, n, valid = triangulate_faces(flat, ring_offsets, face_offsets, vnp)
+    return (triangles, n[tri_faces], np.searchsorted(tri_faces, geometry_offsets))
+
+
+def triangulate_face(face, vnp):
     if ((len(face) == 1) and (len(face[0]) == 3)):
         #        print ("Already a triangle")
         return face
-    sf = np.array([], dtype=np.int32)
-    for ring in face:
-        sf = np.hstack((sf, np.array(ring)))
-    sfv = vnp[sf]
-    rings = np.zeros(len(face), dtype=np.int32)
-    total = 0
-    for i in range(len(face)):
-        total += len(face[i])
-        rings[i] = total
-        # 1. normal with Newell's method
-    n = get_normal_newell(sfv)
-    sfv2d = np.zeros((sfv.shape[0], 2))
-    for i, p in enumerate(sfv):
-        xy = to_2d(p, n)
-        sfv2d[i][0] = xy[0]
-        sfv2d[i][1] = xy[1]
-    result = mapbox_earcut.triangulate_float32(sfv2d, rings)
-
-    for i, each in enumerate(result):
-        result[i] = int(sf[each])
-
-    #    print (type(result.reshape(-1, 3).tolist()[0][0]))
-    return result.reshape(-1, 3).tolist()
+    triangles, tri_faces, n, valid = triangulate_faces(*faces_to_arrays([face]), vnp)
+    return triangles.tolist()
@@ -0,0 +1,355 @@
+"""Merge of city models written to a file one city model at a time
+
+CityJSON.merge() keeps all the city models in memory and adds them to the
+first one. MergeWriter writes the CityObjects of each city model to the output
+file as soon as it is added, and its other arrays (vertices, templates,
+materials, textures) to temporary files that are copied to the output at the
+end. Only the number of items of these arrays (to shift the indices of the
+next city models) and the IDs of the CityObjects are kept, so the memory used
+is that of the largest city model.
+
+The files to merge can be read by several processes (see iter_parsed()), they
+send back the vertices and the boundaries as arrays. The main process only
+decodes the rest of the JSON, and the nested "boundaries" are built once,
+when the merge shifts their indices. On delft.json, this costs the main
+process 0.008 s (0.029 s with the shift) against 0.026 s to read the file
+(0.077 s with the shift), so more processes make the merge faster.
+"""
+import copy
+import json
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+MODULE_NUMPY_AVAILABLE = True
+try:
+    import numpy as np
+except ImportError as e:
+    MODULE_NUMPY_AVAILABLE = False
+
+from cjio import boundaries
+
+#-- the root properties that are written from the city models added
+MERGED_PROPERTIES = ("type", "CityObjects", "vertices", "transform", "geometry-templates")
+APPEARANCE_ARRAYS = ("materials", "textures", "vertices-texture")
+
+
+def _shift(a, offset):
+    for i, each in enumerate(a):
+        if isinstance(each, list):
+            _shift(each, offset)
+        elif each is not None:
+            a[i] = each + offset
+
+
+def _collect(a, out):
+    for each in a:
+        if isinstance(each, list):
+            _collect(each, out)
+        elif each is not None:
+            out.add(each)
+
+
+def _renumber(a, newids):
+    for i, each in enumerate(a):
+        if isinstance(each, list):
+            _renumber(each, newids)
+        elif each is not None:
+            a[i] = newids[each]
+
+
+def _shift_texture(a, toffset, voffset):
+    #-- in a ring, the texture is first and the texture vertices follow
+    for i, each in enumerate(a):
+        if isinstance(each, list):
+            _shift_texture(each, toffset, voffset)
+        elif each is not None:
+            a[i] = each + (toffset if i == 0 else voffset)
+
+
+class _Spool:
+    """A JSON array written to a temporary file, item by item"""
+
+    def __init__(self):
+        self.f = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+        self.count = 0
+
+    def extend(self, items):
+        if len(items) == 0:
+            return
+        if self.count > 0:
+            self.f.write(',')
+        self.f.write(json.dumps(items, separators=(',', ':'))[1:-1])
+        self.count += len(items)
+
+    def copy(self, fout):
+        """Write the array to fout, and close the temporary file"""
+        fout.write('[')
+        self.f.seek(0)
+        shutil.copyfileobj(self.f, fout)
+        fout.write(']')
+        self.f.close()
+
+
+class MergeWriter:
+    """Write the merge of city models to a CityJSON file
+
+    The city models are added one after the other with add(), and close()
+    finishes the file. The result is that of CityJSON.merge() into the first
+    city model added, with the vertices not compressed (and the
+    "geographicalExtent" of all the city models); but a CityObject can't be
+    changed once it is written, so when an ID is found again its CityObject
+    is skipped (see ``duplicates``) instead of its attributes and geometries
+    being merged. The vertices of a city model with such CityObjects are only
+    those the CityObjects written use.
+
+    :param fout: The text file to write to
+    """
+
+    def __init__(self, fout):
+        self.fout = fout
+        #-- the root properties of the first city model, where the lineage
+        #-- of the merge is added
+        self.target = None
+        self.ids = set()
+        self.duplicates = []
+        self.vertices = _Spool()
+        self.templates = _Spool()
+        self.vertices_templates = _Spool()
+        self.appearance = {k: _Spool() for k in APPEARANCE_ARRAYS}
+        self.bbox = None
+        self.fout.write('{"type":"CityJSON","CityObjects":{')
+
+    def add(self, cm):
+        """Write the CityObjects of a city model, and keep its other arrays
+
+        The indices in the geometries of cm are shifted in place.
+        """
+        from cjio import cityjson
+        j = cm.j
+        if self.target is None:
+            header = {k: v for k, v in j.items() if k not in MERGED_PROPERTIES}
+            #-- the metadata, as CityJSON.merge() does, but updated in a copy
+            #-- (cm is not modified)
+            tmp = cityjson.CityJSON(j=dict(j, metadata=copy.deepcopy(j.get("metadata", {}))))
+            tmp.path = cm.path
+            tmp.reference_date = cm.reference_date
+            try:
+                tmp.update_metadata(overwrite=True)
+            except:
+                pass
+            header["metadata"] = tmp.j["metadata"]
+            self.target = cityjson.CityJSON(j=header)
+            self.target.path = cm.path
+        else:
+            self.target.add_merge_lineage(cm)
+        voffset = self.vertices.count
+        toffset = self.templates.count
+        moffset = self.appearance["materials"].count
+        xoffset = self.appearance["textures"].count
+        uvoffset = self.appearance["vertices-texture"].count
+        #-- the CityObjects written
+        cos = {}
+        for theid, co in j["CityObjects"].items():
+            if theid in self.ids:
+                self.duplicates.append(theid)
+            else:
+                self.ids.add(theid)
+                cos[theid] = co
+        skipped = len(cos) < len(j["CityObjects"])
+        #-- the real coordinates of the vertices written, and their new indices
+        if MODULE_NUMPY_AVAILABLE:
+            vnp = cm.get_vertices_array().astype(np.float64)
+            if "transform" in j:
+                vnp = (vnp * np.array(j["transform"]["scale"])) + np.array(j["transform"]["translate"])
+            bi = cm.get_boundary_index()
+            if skipped:
+                kept = np.zeros(len(bi.flat), dtype=bool)
+                for theid, start, end in bi.owner_ranges():
+                    kept[start:end] = theid in cos
+                used = np.unique(bi.flat[kept])
+                newids = np.full(len(vnp), -1, dtype=np.int64)
+                newids[used] = np.arange(len(used)) + voffset
+                vnp = vnp[used]
+                #-- the geometries skipped keep their indices
+                bi.update(np.where(kept, newids[bi.flat], bi.flat))
+            elif (voffset != 0) or bi.pending:
+                bi.update(bi.flat + voffset)
+            if len(vnp) > 0:
+                b = np.concatenate((vnp.min(axis=0), vnp.max(axis=0)))
+                self.bbox = b if self.bbox is None else np.concatenate((np.minimum(self.bbox[:3], b[:3]),
+                                                                        np.maximum(self.bbox[3:], b[3:])))
+            vertices = vnp.tolist()
+        else:
+            vertices = j["vertices"]
+            if "transform" in j:
+                s = j["transform"]["scale"]
+                t = j["transform"]["translate"]
+                vertices = [[v[i] * s[i] + t[i] for i in range(3)] for v in vertices]
+            if skipped:
+                used = set()
+                for co in cos.values():
+                    for g in co.get("geometry", []):
+                        _collect(g["boundaries"], used)
+                used = sorted(used)
+                newids = {old: i + voffset for i, old in enumerate(used)}
+                vertices = [vertices[i] for i in used]
+                for co in cos.values():
+                    for g in co.get("geometry", []):
+                        _renumber(g["boundaries"], newids)
+            elif voffset != 0:
+                for co in j["CityObjects"].values():
+                    for g in co.get("geometry", []):
+                        _shift(g["boundaries"], voffset)
+        #-- the indices of the templates and of the appearances
+        for co in cos.values():
+            for g in co.get("geometry", []):
+                if g["type"] == "GeometryInstance":
+                    g["template"] += toffset
+                if moffset != 0:
+                    for m in g.get("material", {}).values():
+                        if "values" in m:
+                            _shift(m["values"], moffset)
+                        if m.get("value") is not None:
+                            m["value"] += moffset
+                if (xoffset != 0) or (uvoffset != 0):
+                    for m in g.get("texture", {}).values():
+                        _shift_texture(m["values"], xoffset, uvoffset)
+        if len(cos) > 0:
+            if len(self.ids) > len(cos):
+                self.fout.write(',')
+            self.fout.write(json.dumps(cos, separators=(',', ':'))[1:-1])
+        self.vertices.extend(vertices)
+        #-- the templates
+        if "geometry-templates" in j:
+            templates = j["geometry-templates"]["templates"]
+            if self.vertices_templates.count != 0:
+                for t in templates:
+                    _shift(t["boundaries"], self.vertices_templates.count)
+            self.templates.extend(templates)
+            self.vertices_templates.extend(j["geometry-templates"]["vertices-templates"])
+        for k in APPEARANCE_ARRAYS:
+            self.appearance[k].extend(j.get("appearance", {}).get(k, []))
+
+    def close(self):
+        """Write the arrays and the root properties, the file is then complete"""
+        fout = self.fout
+        fout.write('},"vertices":')
+        self.vertices.copy(fout)
+        if self.templates.count > 0:
+            fout.write(',"geometry-templates":{"templates":')
+            self.templates.copy(fout)
+            fout.write(',"vertices-templates":')
+            self.vertices_templates.copy(fout)
+            fout.write('}')
+        else:
+            self.templates.f.close()
+            self.vertices_templates.f.close()
+        header = dict(self.target.j) if self.target is not None else {}
+        appearance = {k: v for k, v in header.pop("appearance", {}).items() if k not in APPEARANCE_ARRAYS}
+        spools = [(k, s) for k, s in self.appearance.items() if s.count > 0]
+        if (len(spools) > 0) or (len(appearance) > 0):
+            fout.write(',"appearance":{')
+            for i, (k, s) in enumerate(spools):
+                fout.write('%s%s:' % ("," if i > 0 else "", json.dumps(k)))
+                s.copy(fout)
+            if len(appearance) > 0:
+                fout.write('%s%s' % ("," if len(spools) > 0 else "",
+                                     json.dumps(appearance, separators=(',', ':'))[1:-1]))
+            fout.write('}')
+        for k, s in self.appearance.items():
+            if s.count == 0:
+                s.f.close()
+        if ("metadata" in header) and (self.bbox is not None):
+            header["metadata"] = dict(header["metadata"], geographicalExtent=self.bbox.tolist())
+        for k, v in header.items():
+            fout.write(',%s:%s' % (json.dumps(k), json.dumps(v, separators=(',', ':'))))
+        fout.write('}')
+
+
+def parse(path, ignore_duplicate_keys=False):
+    """Read a CityJSON file to merge, as arrays
+
+    This is what the processes of iter_parsed() do. The vertices (not
+    compressed) and the flat boundaries are returned as arrays, which are
+    much faster to pass to another process than the nested lists; the rest
+    of the city model is returned as JSON.
+
+    :return: A tuple to give to load()
+    """
+    from cjio import cityjson
+    with open(path, 'r', encoding='utf-8-sig') as fin:
+        try:
+            cm = cityjson.reader(fin, ignore_duplicate_keys)
+        except ValueError as e:
+            raise ValueError('%s: "%s"' % (e, path))
+    cm.decompress()
+    vnp = cm.get_vertices_array()
+    bi = cm.get_boundary_index()
+    #-- the lengths of all the levels of all the geometries, -1 levels when
+    #-- a geometry is not nested as its type says (its boundaries stay)
+    nlevels = []
+    sizes = []
+    lengths = []
+    for g, ls in zip(bi.geometries, bi.lengths):
+        if ls is None:
+            nlevels.append(-1)
+            continue
+        nlevels.append(len(ls))
+        for l in ls:
+            sizes.append(len(l))
+            lengths.extend(l)
+        g["boundaries"] = None
+    cm.j["vertices"] = []
+    return (json.dumps(cm.j, separators=(',', ':')), cm.path, vnp, bi.flat, bi.offsets,
+            np.array(nlevels, dtype=np.int64), np.array(sizes, dtype=np.int64), np.array(lengths, dtype=np.int64))
+
+
+def load(parsed):
+    """The CityJSON of a file read by parse(), with its boundary index
+
+    The "boundaries" of the geometries are not written: the index is
+    ``pending`` (see boundaries.BoundaryIndex.from_flat()), they are built
+    once by the update() shifting their indices in the merge.
+    """
+    from cjio import cityjson
+    text, path, vnp, flat, offsets, nlevels, sizes, lengths = parsed
+    cm = cityjson.CityJSON(j=json.loads(text))
+    cm.path = path
+    cm.set_vertices_array(vnp)
+    geometries, owners = boundaries.collect(cm.j)
+    sizes = iter(sizes.tolist())
+    lengths = lengths.tolist()
+    i = 0
+    glengths = []
+    for n in nlevels.tolist():
+        if n < 0:
+            glengths.append(None)
+            continue
+        ls = []
+        for _ in range(n):
+            size = next(sizes)
+            ls.append(lengths[i:i + size])
+            i += size
+        glengths.append(ls)
+    cm._boundary_index = boundaries.BoundaryIndex.from_flat(geometries, owners, flat, offsets, glengths, write=False)
+    return cm
+
+
+def iter_parsed(paths, jobs, ignore_duplicate_keys=False):
+    """Read CityJSON files with 'jobs' processes, see parse()
+
+    At most 'jobs' files are read ahead, so the files can be merged as they
+    come without all of them being in memory.
+
+    :return: A generator of the CityJSON, in the order of the paths
+    """
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for path in paths:
+            pending.append(pool.submit(parse, path, ignore_duplicate_keys))
+            if len(pending) > jobs:
+                yield load(pending.popleft().result())
+        while len(pending) > 0:
+            yield load(pending.popleft().result())
@@ -0,0 +1,257 @@
+"""Execution of the chain of commands of the CLI
+
+Each command gives a processor, a function taking the city model and
+returning it. A command can instead give a Step, which says what parts of the
+city model it reads and writes (see PARTS). The commands that only replace the
+vertices and their indices (clean, remove_duplicate_vertices,
+remove_orphan_vertices, compress) also say what they do to them: these
+operations are done on the arrays of a VertexPlan, their new indices composed,
+and the boundaries of the geometries are written once, when a command needs
+them or at the end. An operation that would change nothing is dropped, e.g.
+removing the orphan vertices again. The result is the same as that of the
+processors applied one after the other.
+"""
+
+MODULE_NUMPY_AVAILABLE = True
+try:
+    import numpy as np
+except ImportError as e:
+    MODULE_NUMPY_AVAILABLE = False
+
+from contextlib import ExitStack
+
+import click
+
+from cjio import utils, vertices
+
+#-- the parts of a city model a Step reads and writes:
+#--   "vertices": the vertices and the "transform"
+#--   "geometries": the geometries of the CityObjects and their boundaries
+#--   "appearance": the materials and the textures, in the geometries too
+#--   "metadata": the "metadata" and the CRS
+PARTS = frozenset(("vertices", "geometries", "appearance", "metadata"))
+
+#-- what the vertex operations read and write
+VERTEX_PARTS = frozenset(("vertices", "geometries"))
+
+
+class Step:
+    """A command of the chain, with what it reads and writes
+
+    :param run: The processor, a function taking the city model and returning
+        it; not called for the steps with vertex_ops
+    :param reads: The parts of the city model it reads, all by default
+    :param writes: The parts of the city model it modifies, all by default
+    :param vertex_ops: For the commands that only replace the vertices and
+        their indices, the list of their operations, see VertexPlan.apply()
+    :param message: The status printed when the vertex_ops are done
+    :param warning: Printed when one of the vertex_ops does nothing because
+        the city model doesn't allow it (compress when already compressed)
+    :param stream: A function doing the step from a
+        streaming.CityJSONStream of the input file, when the step is the first
+        of the chain, so that the whole file is not loaded; it returns the
+        city model for the next steps. A step writing nothing is streamed
+        only when it is the only one, see streamed().
+    """
+
+    def __init__(self, run=None, reads=PARTS, writes=PARTS, vertex_ops=None, message=None, warning=None,
+                 stream=None):
+        self.run = run
+        self.stream = stream
+        self.reads = frozenset(reads)
+        self.writes = frozenset(writes)
+        self.vertex_ops = vertex_ops
+        self.message = message
+        self.warning = warning
+        if vertex_ops is not None:
+            self.reads = self.reads | VERTEX_PARTS
+            self.writes = self.writes | VERTEX_PARTS
+
+    def __call__(self, cm):
+        """Do the step alone"""
+        if self.vertex_ops is None:
+            return self.run(cm)
+        utils.print_cmd_status(self.message)
+        for op in self.vertex_ops:
+            if (apply_eager(cm, op) is False) and (self.warning is not None):
+                click.echo(self.warning)
+        return cm
+
+
+def apply_eager(cm, op):
+    """Do a vertex operation with the methods of the city model"""
+    if op[0] == "duplicates":
+        return cm.remove_duplicate_vertices(op[1])
+    elif op[0] == "orphans":
+        return cm.remove_orphan_vertices()
+    elif op[0] == "compress":
+        return cm.compress(op[1])
+    raise ValueError("Unknown vertex operation: %s" % op[0])
+
+
+class VertexPlan:
+    """Vertex operations done on arrays, the boundaries written once
+
+    The indices in the boundaries stay those of the city model until
+    finish(); ``remap`` gives, for each of them, the index of the vertex in
+    ``v`` (-1 for the removed vertices no geometry uses).
+    """
+
+    def __init__(self, cm):
+        self.cm = cm
+        self.bi = cm.get_boundary_index()
+        self.v = cm.get_vertices_array()
+        self.transform = cm.j.get("transform")
+        self.remap = None
+        self.modified = False
+        #-- the vertices are those used, in the order they first appear
+        self.no_orphans = False
+        #-- the compressed vertices (integers) have no duplicates
+        self.no_duplicates = False
+
+    def apply(self, op):
+        """Do an operation on the vertices
+
+        The operations are ("duplicates", precision), ("orphans",) and
+        ("compress", important_digits), as the CityJSON methods
+        remove_duplicate_vertices(), remove_orphan_vertices() and compress().
+
+        :return: What the method returns (the number of vertices removed, or
+            if the city model was compressed), or None if the operation can't
+            be done on the arrays
+        """
+        if op[0] == "duplicates":
+            return self.remove_duplicates(op[1])
+        elif op[0] == "orphans":
+            return self.remove_orphans()
+        elif op[0] == "compress":
+            return self.compress(op[1])
+        raise ValueError("Unknown vertex operation: %s" % op[0])
+
+    def _replace(self, v, newids):
+        if self.remap is None:
+            self.remap = newids
+        else:
+            #-- the indices of the removed vertices stay -1
+            r = self.remap.copy()
+            used = r >= 0
+            r[used] = newids[r[used]]
+            self.remap = r
+        self.v = v
+        self.modified = True
+
+    def remove_duplicates(self, precision):
+        if self.transform is not None:
+            precision = 0
+        if (len(self.v) == 0) or self.no_duplicates:
+            return 0
+        q = vertices.quantize(self.v, precision)
+        if q is None:
+            return None
+        newv, newids = vertices.unique(q)
+        if self.transform is None:
+            newv = newv / (10 ** precision)
+        n = len(self.v) - len(newv)
+        #-- merging vertices keeps them in the order they are first used
+        self._replace(newv, newids)
+        self.no_duplicates = self.transform is not None
+        return n
+
+    def remove_orphans(self):
+        if self.no_orphans:
+            return 0
+        flat = self.bi.flat if self.remap is None else self.remap[self.bi.flat]
+        u, first = np.unique(flat, return_index=True)
+        used = u[np.argsort(first)]
+        newids = np.full(len(self.v), -1, dtype=np.int64)
+        newids[used] = np.arange(len(used))
+        n = len(self.v) - len(used)
+        self._replace(self.v[used], newids)
+        self.no_orphans = True
+        return n
+
+    def compress(self, important_digits):
+        if self.transform is not None:
+            return False
+        if len(self.v) == 0:
+            return None
+        bbox = self.v.min(axis=0).tolist()
+        q = vertices.quantize(self.v - np.array(bbox), important_digits)
+        if q is None:
+            return None
+        self.v = q
+        self.modified = True
+        ss = float('0.' + '0' * (important_digits - 1) + '1')
+        self.transform = {"scale": [ss, ss, ss], "translate": [bbox[0], bbox[1], bbox[2]]}
+        self.remove_duplicates(0)
+        self.remove_orphans()
+        return True
+
+    def finish(self):
+        """Write the vertices, their transform and the boundaries to the city model"""
+        if self.remap is not None:
+            self.bi.remap(self.remap)
+        if self.transform is not None:
+            self.cm.j["transform"] = self.transform
+        if self.modified:
+            self.cm.set_vertices_array(self.v)
+        return self.cm
+
+
+def streamed(steps):
+    """Whether the chain starts with a step reading the input file as a stream"""
+    if len(steps) == 0:
+        return False
+    first = steps[0]
+    if (not isinstance(first, Step)) or (first.stream is None):
+        return False
+    #-- the next steps need the city model anyway
+    return (len(steps) == 1) or (len(first.writes) > 0)
+
+
+def execute(steps, cm):
+    """Apply the processors of the chain of commands to a city model
+
+    The array of the vertices of the city models is kept from one step to
+    the next (see CityJSON.keep_vertices()).
+
+    :param steps: The processors and the Steps, in the order of the chain
+    :return: The city model returned by the last one
+    """
+    with ExitStack() as blocks:
+        return _execute(steps, cm, blocks)
+
+
+def _execute(steps, cm, blocks):
+    kept = []
+    plan = None
+    for step in steps:
+        if hasattr(cm, "keep_vertices") and not any(cm is each for each in kept):
+            blocks.enter_context(cm.keep_vertices())
+            kept.append(cm)
+        if not isinstance(step, Step):
+            step = Step(step)
+        if step.vertex_ops is None:
+            #-- the vertex operations are done before a step needing them
+            if (plan is not None) and ((step.reads | step.writes) & VERTEX_PARTS):
+                cm = plan.finish()
+                plan = None
+            cm = step.run(cm)
+            continue
+        if not MODULE_NUMPY_AVAILABLE:
+            cm = step(cm)
+            continue
+        utils.print_cmd_status(step.message)
+        for op in step.vertex_ops:
+            if plan is None:
+                plan = VertexPlan(cm)
+            done = plan.apply(op)
+            if done is None:
+                cm = plan.finish()
+                plan = None
+                done = apply_eager(cm, op)
+            if (done is False) and (step.warning is not None):
+                click.echo(step.warning)
+    if plan is not None:
+        cm = plan.finish()
+    return cm
@@ -0,0 +1,140 @@
+"""Spatial index of the CityObjects, to select them with a bbox
+
+The 2D centroids of the CityObjects are sorted in a uniform grid of cells. A
+bbox query only looks at the cells it overlaps, and then at the centroids in
+them. The index can be saved next to the CityJSON file and loaded back, it
+holds a key to check that it is still for the same city model.
+"""
+import os
+
+MODULE_NUMPY_AVAILABLE = True
+try:
+    import numpy as np
+except ImportError as e:
+    MODULE_NUMPY_AVAILABLE = False
+
+#-- average number of CityObjects per cell
+POINTS_PER_CELL = 4
+
+SIDECAR_EXTENSION = '.sidx.npz'
+
+
+def centroids(bi, vertices, transform=None):
+    """Compute the centroids of the CityObjects of a BoundaryIndex
+
+    Like CityJSON.get_centroid(), the centroid is the average of the vertices
+    of the boundaries (a vertex used twice counts twice), and the CityObjects
+    without vertices have none.
+
+    :param bi: A boundaries.BoundaryIndex, with its owners
+    :param vertices: The (N, 3) array of the vertices
+    :param transform: The "transform" of the city model, if compressed
+    :return: A tuple with the list of IDs and their (n, 3) array of centroids
+    """
+    ranges = [r for r in bi.owner_ranges() if r[2] > r[1]]
+    if len(ranges) == 0:
+        return ([], np.zeros((0, 3), dtype=np.float64))
+    ids = [r[0] for r in ranges]
+    starts = np.array([r[1] for r in ranges], dtype=np.int64)
+    counts = np.array([r[2] - r[1] for r in ranges], dtype=np.int64)
+    vs = vertices[bi.flat]
+    if vs.dtype.kind in 'iu':
+        sums = np.add.reduceat(vs, starts, axis=0)
+    else:
+        #-- same order of the additions as get_centroid(), so that the
+        #-- centroids on the edges of a bbox are in or out the same way
+        sums = np.array([vs[r[1]:r[2]].sum(axis=0) for r in ranges])
+    pts = sums / counts[:, None]
+    if transform is not None:
+        pts = (pts * np.array(transform["scale"])) + np.array(transform["translate"])
+    return (ids, pts)
+
+
+class SpatialIndex:
+    """Uniform grid over the 2D centroids of CityObjects
+
+    :param ids: The IDs of the CityObjects
+    :param points: Their (n, 2) (or (n, 3)) array of centroids
+    :param key: Something identifying the city model indexed
+    """
+
+    def __init__(self, ids, points, key=None):
+        self.ids = list(ids)
+        self.key = key
+        n = len(self.ids)
+        self.m = max(1, int(np.sqrt(n / POINTS_PER_CELL)))
+        if n > 0:
+            self.points = np.asarray(points, dtype=np.float64)[:, :2]
+            self.min = self.points.min(axis=0)
+            self.max = self.points.max(axis=0)
+        else:
+            self.points = np.zeros((0, 2), dtype=np.float64)
+            self.min = np.zeros(2)
+            self.max = np.zeros(2)
+        size = (self.max - self.min) / self.m
+        self.cell_size = np.where(size > 0, size, 1.0)
+        cells = self._cell(self.points)
+        cells = cells[:, 1] * self.m + cells[:, 0]
+        self.order = np.argsort(cells, kind='stable')
+        self.starts = np.searchsorted(cells[self.order], np.arange(self.m * self.m + 1))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cell(self, xy):
+        c = np.floor((np.asarray(xy) - self.min) / self.cell_size).astype(np.int64)
+        return np.clip(c, 0, self.m - 1)
+
+    def query(self, bbox):
+        """Find the CityObjects whose centroid is in a 2D bbox
+
+        Like the subset of cjio, the bbox is (minx, miny, maxx, maxy) and the
+        max are excluded.
+
+        :return: The list of IDs, in the order of the index
+        """
+        if (len(self.ids) == 0 or bbox[2] <= self.min[0] or bbox[3] <= self.min[1]
+            or bbox[0] > self.max[0] or bbox[1] > self.max[1]):
+            return []
+        c0 = self._cell([bbox[0], bbox[1]])
+        c1 = self._cell([bbox[2], bbox[3]])
+        parts = []
+        for cy in range(c0[1], c1[1] + 1):
+            first = cy * self.m
+            parts.append(self.order[self.starts[first + c0[0]]:self.starts[first + c1[0] + 1]])
+        candidates = np.concatenate(parts)
+        p = self.points[candidates]
+        inside = ((p[:, 0] >= bbox[0]) & (p[:, 1] >= bbox[1]) &
+                  (p[:, 0] < bbox[2]) & (p[:, 1] < bbox[3]))
+        return [self.ids[i] for i in np.sort(candidates[inside]).tolist()]
+
+    def save(self, path):
+        """Write the index to a .npz file"""
+        with open(path, 'wb') as fout:
+            np.savez(fout,
+                     ids=np.array(self.ids, dtype=str),
+                     points=self.points,
+                     key=np.array('' if self.key is None else self.key))
+
+    @classmethod
+    def load(cls, path, key=None):
+        """Read an index written by save()
+
+        :param key: If given, the index is only returned if it has this key
+        :return: The SpatialIndex, or None if the file can't be used
+        """
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as d:
+                k = str(d["key"])
+                if (key is not None) and (k != key):
+                    return None
+                return cls(d["ids"].tolist(), d["points"], k)
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+def sidecar_path(path):
+    """The file where the spatial index of the CityJSON file 'path' is kept"""
+    return path + SIDECAR_EXTENSION
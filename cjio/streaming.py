@@ -0,0 +1,335 @@
+"""Incremental reading of large CityJSON files
+
+The reader scans the file in binary chunks and only records where each of the
+root properties starts and ends. The CityObjects are then decoded one at a
+time, and the other root properties (``vertices``, ``transform``,
+``metadata``...) only when they are asked for. Thus the whole document is never
+in memory at once.
+"""
+import bisect
+import json
+import re
+
+MODULE_NUMPY_AVAILABLE = True
+try:
+    import numpy as np
+except ImportError as e:
+    MODULE_NUMPY_AVAILABLE = False
+
+CHUNK_SIZE = 1 << 20
+
+_WS = re.compile(rb'[ \t\n\r]*')
+_STRING_END = re.compile(rb'(?:[^"\\]|\\.)*"', re.DOTALL)
+_QUOTE = re.compile(rb'"')
+_SCALAR = re.compile(rb'[^ \t\n\r,}\]]+')
+_OPEN = frozenset(b'[{')
+_CLOSE = frozenset(b']}')
+
+
+class _Scanner:
+    """Forward-only byte scanner over a file, with absolute offsets."""
+
+    def __init__(self, fin, offset=0):
+        self.f = fin
+        self.f.seek(offset)
+        self.buf = b''
+        self.base = offset #-- absolute offset of buf[0]
+        self.pos = 0       #-- position in buf
+        self.eof = False
+        self.keep = None   #-- position in buf that must be kept (capture)
+
+    def tell(self):
+        return self.base + self.pos
+
+    def _fill(self):
+        """Read more data, returns False at the end of the file."""
+        if self.eof:
+            return False
+        start = self.pos if self.keep is None else self.keep
+        #-- grow geometrically when capturing, otherwise it's quadratic
+        n = max(CHUNK_SIZE, len(self.buf) - start)
+        data = self.f.read(n)
+        if not data:
+            self.eof = True
+            return False
+        self.buf = self.buf[start:] + data
+        self.base += start
+        self.pos -= start
+        if self.keep is not None:
+            self.keep = 0
+        return True
+
+    def peek(self):
+        """Skip the whitespaces and return the next byte (None at the end)."""
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return None
+
+    def expect(self, c):
+        b = self.peek()
+        if b != ord(c):
+            found = 'end of file' if b is None else repr(chr(b))
+            raise ValueError("Invalid JSON: expected '%s' at byte %d, found %s" % (c, self.tell(), found))
+        self.pos += 1
+
+    def _skip_string(self):
+        #-- self.pos is at the opening quote
+        while True:
+            m = _STRING_END.match(self.buf, self.pos + 1)
+            if m is not None:
+                self.pos = m.end()
+                return
+            if not self._fill():
+                raise ValueError("Invalid JSON: unterminated string at byte %d" % self.tell())
+
+    def _skip_scalar(self):
+        while True:
+            m = _SCALAR.match(self.buf, self.pos)
+            if m is not None and m.end() < len(self.buf):
+                self.pos = m.end()
+                return
+            if not self._fill():
+                if m is None:
+                    raise ValueError("Invalid JSON: value expected at byte %d" % self.tell())
+                self.pos = m.end()
+                return
+
+    def _skip_container(self):
+        #-- self.pos is at the opening bracket; the strings are jumped over
+        #-- and the brackets are counted in between them
+        depth = 0
+        while True:
+            m = _QUOTE.search(self.buf, self.pos)
+            end = len(self.buf) if m is None else m.start()
+            depth, closed = _count_brackets(self.buf, self.pos, end, depth)
+            if closed is not None:
+                self.pos = closed
+                return
+            self.pos = end
+            if m is not None:
+                self._skip_string()
+            elif not self._fill():
+                raise ValueError("Invalid JSON: unterminated array/object at byte %d" % self.tell())
+
+    def skip_value(self, capture=False):
+        """Jump over the next value, and return its bytes if capture."""
+        b = self.peek()
+        if b is None:
+            raise ValueError("Invalid JSON: value expected at end of file")
+        if capture:
+            self.keep = self.pos
+        try:
+            if b == ord('"'):
+                self._skip_string()
+            elif b in _OPEN:
+                self._skip_container()
+            else:
+                self._skip_scalar()
+            if capture:
+                return self.buf[self.keep:self.pos]
+        finally:
+            self.keep = None
+
+    def read_value(self):
+        return json.loads(self.skip_value(capture=True))
+
+
+def _count_brackets(buf, start, end, depth):
+    """Count the brackets in buf[start:end] (no strings in there).
+
+    Returns the new depth and the position just after the bracket closing the
+    container, None if it's not closed in this segment.
+    """
+    if MODULE_NUMPY_AVAILABLE and (end - start) > 256:
+        a = np.frombuffer(buf, dtype=np.uint8, count=end - start, offset=start)
+        d = (a == 91).astype(np.int64) + (a == 123) - (a == 93) - (a == 125)
+        c = np.cumsum(d) + depth
+        i = np.flatnonzero(c == 0)
+        if i.size > 0:
+            return (0, start + int(i[0]) + 1)
+        return (int(c[-1]), None)
+    for i in range(start, end):
+        b = buf[i]
+        if b in _OPEN:
+            depth += 1
+        elif b in _CLOSE:
+            depth -= 1
+            if depth == 0:
+                return (0, i + 1)
+    return (depth, None)
+
+
+class CityJSONStream:
+    """A CityJSON file read lazily.
+
+    Opening it scans the file once to index where the root properties are;
+    their values are decoded only when requested with get(), and the
+    CityObjects are decoded one by one with iter_cityobjects().
+    """
+
+    def __init__(self, path, ignore_duplicate_keys=False):
+        self.path = path
+        self.ignore_duplicate_keys = ignore_duplicate_keys
+        self._offsets = {}
+        self._scan_root()
+        if self.get("type") != "CityJSON":
+            raise ValueError("Not a CityJSON file")
+
+    def _open(self):
+        return open(self.path, 'rb')
+
+    def _scan_root(self):
+        with self._open() as fin:
+            start = 3 if fin.read(3) == b'\xef\xbb\xbf' else 0
+            s = _Scanner(fin, start)
+            s.expect('{')
+            if s.peek() == ord('}'):
+                s.pos += 1
+                return
+            while True:
+                key = s.read_value()
+                s.expect(':')
+                s.peek()
+                begin = s.tell()
+                s.skip_value()
+                if key in self._offsets and not self.ignore_duplicate_keys:
+                    raise ValueError("Invalid CityJSON file, duplicate key: %r" % (key))
+                self._offsets[key] = (begin, s.tell())
+                if s.peek() == ord(','):
+                    s.pos += 1
+                    continue
+                s.expect('}')
+                return
+
+    def keys(self):
+        return self._offsets.keys()
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def get(self, key, default=None):
+        """Decode and return the root property 'key'."""
+        if key not in self._offsets:
+            return default
+        begin, end = self._offsets[key]
+        with self._open() as fin:
+            fin.seek(begin)
+            return json.loads(fin.read(end - begin))
+
+    def _vertex_rows(self):
+        """Yield the bytes of the "vertices", a chunk of whole rows at a time
+
+        Each piece is the rows separated by commas, without the brackets of
+        the array (the rows are arrays of numbers, their ']' can't be in a
+        string).
+        """
+        if "vertices" not in self._offsets:
+            return
+        begin, end = self._offsets["vertices"]
+        with self._open() as fin:
+            fin.seek(begin)
+            if fin.read(1) != b'[':
+                raise ValueError("Invalid CityJSON file: \"vertices\" must be an array")
+            remaining = end - begin - 1
+            rest = b''
+            while remaining > 0:
+                data = fin.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise ValueError("Invalid JSON: unexpected end of file in \"vertices\"")
+                remaining -= len(data)
+                buf = rest + data
+                if remaining == 0:
+                    #-- without the closing bracket of the array
+                    piece, rest = buf.rstrip()[:-1], b''
+                else:
+                    k = buf.rfind(b']')
+                    if k < 0:
+                        rest = buf
+                        continue
+                    piece, rest = buf[:k + 1], buf[k + 1:]
+                #-- the comma after the last row of the previous piece
+                piece = piece.strip(b' \t\n\r,')
+                if len(piece) > 0:
+                    yield piece
+
+    def vertices_at(self, indices):
+        """Decode only the vertices at these indices
+
+        The "vertices" are read a chunk at a time, and (with NumPy) only the
+        rows asked for are decoded.
+
+        :param indices: The vertex indices, sorted and without duplicates
+        :return: The list of the vertices, in the same order
+        :raises: IndexError if an index is not in the "vertices"
+        """
+        indices = list(indices)
+        vs = []
+        k = 0
+        n0 = 0
+        for piece in self._vertex_rows():
+            if MODULE_NUMPY_AVAILABLE:
+                a = np.frombuffer(piece, dtype=np.uint8)
+                starts = np.flatnonzero(a == 91)
+                n1 = n0 + len(starts)
+                k2 = bisect.bisect_left(indices, n1, k)
+                if k2 > k:
+                    ends = np.flatnonzero(a == 93)
+                    if len(ends) != len(starts):
+                        raise ValueError("Invalid CityJSON file: a vertex must be an array of numbers")
+                    rows = np.array(indices[k:k2], dtype=np.int64) - n0
+                    parts = [piece[b:e + 1] for b, e in zip(starts[rows].tolist(), ends[rows].tolist())]
+                    vs.extend(json.loads(b'[' + b','.join(parts) + b']'))
+            else:
+                rows = json.loads(b'[' + piece + b']')
+                n1 = n0 + len(rows)
+                k2 = bisect.bisect_left(indices, n1, k)
+                vs.extend(rows[i - n0] for i in indices[k:k2])
+            k = k2
+            n0 = n1
+        if k < len(indices):
+            raise IndexError("vertex #%d doesn't exist" % indices[k])
+        return vs
+
+    @property
+    def vertices(self):
+        return self.get("vertices", [])
+
+    @property
+    def transform(self):
+        return self.get("transform")
+
+    @property
+    def metadata(self):
+        return self.get("metadata")
+
+    def header(self):
+        """Return the root properties, without "CityObjects" and "vertices"."""
+        return {k: self.get(k) for k in self._offsets if k not in ("CityObjects", "vertices")}
+
+    def iter_cityobjects(self):
+        """Yield the (id, CityObject) pairs, one at a time."""
+        if "CityObjects" not in self._offsets:
+            return
+        seen = set()
+        with self._open() as fin:
+            s = _Scanner(fin, self._offsets["CityObjects"][0])
+            s.expect('{')
+            if s.peek() == ord('}'):
+                return
+            while True:
+                theid = s.read_value()
+                s.expect(':')
+                co = s.read_value()
+                if not self.ignore_duplicate_keys:
+                    if theid in seen:
+                        raise ValueError("Invalid CityJSON file, duplicate key for City Object IDs: %r" % (theid))
+                    seen.add(theid)
+                yield (theid, co)
+                if s.peek() == ord(','):
+                    s.pos += 1
+                    continue
+                s.expect('}')
+                return
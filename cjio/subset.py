@@ -1,44 +1,86 @@
 
 import json
 
+from cjio import boundaries
+
+MODULE_NUMPY_AVAILABLE = True
+try:
+    import numpy as np
+except ImportError as e:
+    MODULE_NUMPY_AVAILABLE = False
+
 def select_co_bbox(j, bbox):
     #-- select the CO whose
     pass
 
-def select_co_ids(j, IDs):
-    IDs = list(IDs)
-    re = set()
-    for theid in j["CityObjects"]:
-        if theid in IDs:
+class CityObjectGraph:
+    """The links between the CityObjects: children, parent, and the members
+    of the CityObjectGroups
+
+    It is kept as long as the "CityObjects" object is the same and has the same
+    size, so the links modified in place are not noticed.
+    """
+
+    def __init__(self, cityobjects):
+        self.cityobjects = cityobjects
+        self.n = len(cityobjects)
+        self.children = {}
+        self.parent = {}
+        self.members = {}
+        for theid, co in cityobjects.items():
+            if "children" in co:
+                self.children[theid] = co["children"]
+            if "parent" in co:
+                self.parent[theid] = co["parent"]
+            if co.get("type") == "CityObjectGroup" and "members" in co:
+                self.members[theid] = co["members"]
+
+    def is_current(self, cityobjects):
+        return (cityobjects is self.cityobjects) and (len(cityobjects) == self.n)
+
+    def linked(self, IDs):
+        """The IDs, the members of the groups, their children and their parent
+
+        Only one level is followed, as cjio has always done: the children of
+        the children are not added, nor the other children of the parent.
+        The IDs that are not CityObjects are left out.
+        """
+        re = set()
+        for theid in IDs:
+            if theid not in self.cityobjects:
+                continue
             re.add(theid)
-    for theid in IDs:
-        if theid not in j["CityObjects"]:
-            IDs.remove(theid)
-            print ("WARNING: ID", theid, "not found in input file; ignored.")
-    #-- deal with CityObjectGroup
-    for each in j["CityObjects"]:
-        if each in IDs:
-            if j["CityObjects"][each]["type"] == "CityObjectGroup" and "members" in j["CityObjects"][each]:
-                for member in j["CityObjects"][each]["members"]:
-                    re.add(member)
-    #-- also add the children
-    for id in j["CityObjects"]:
-        if id in IDs:
-            if "children" in j['CityObjects'][id]:
-                for child in j['CityObjects'][id]['children']:
-                    re.add(child)
-            if "parent" in j['CityObjects'][id]:
-                re.add(j['CityObjects'][id]['parent']) 
-                #-- add siblings
-                if "children" in j['CityObjects'][id]['parent']:
-                    for child in j['CityObjects'][id]['parent']:
-                        re.add(child)
-    return re                
+            re.update(self.members.get(theid, []))
+            re.update(self.children.get(theid, []))
+            if theid in self.parent:
+                re.add(self.parent[theid])
+        return re & self.cityobjects.keys()
+
+
+def select_co_ids(j, IDs, graph=None):
+    """Select the CityObjects with the IDs, the members of the
+    CityObjectGroups, their children and their parent (see
+    CityObjectGraph.linked())
+    """
+    if graph is None:
+        graph = CityObjectGraph(j["CityObjects"])
+    IDs = set(IDs)
+    for theid in sorted(IDs - j["CityObjects"].keys()):
+        print ("WARNING: ID", theid, "not found in input file; ignored.")
+    return graph.linked(IDs)
 
 
 
 def process_geometry(j, j2):
     #-- update vertex indices
+    if MODULE_NUMPY_AVAILABLE:
+        bi = boundaries.BoundaryIndex(*boundaries.collect(j2))
+        used = bi.vertices_in_order()
+        newids = np.zeros(len(j["vertices"]), dtype=np.int64)
+        newids[used] = np.arange(len(used))
+        bi.remap(newids)
+        j2["vertices"] = [j["vertices"][i] for i in used.tolist()]
+        return
     oldnewids = {}
     newvertices = []    
     for each in j2["CityObjects"]:
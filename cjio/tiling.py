@@ -0,0 +1,152 @@
+"""Partition of the CityObjects in tiles, for 3D Tiles
+
+The CityObjects are put in a quadtree by the centre of their bbox: a tile
+with too many CityObjects is cut in four. The CityObjects are in the leaves only, the
+tiles above are there to be refined ("ADD"), and each tile is bounded by the
+3D bbox of the CityObjects below it.
+
+The tiles are in local coordinates, east, north and up from a point of the
+city model, and the "transform" of the root tile places them in ECEF (see
+enu_axes() and root_transform()).
+"""
+
+MODULE_NUMPY_AVAILABLE = True
+try:
+    import numpy as np
+except ImportError as e:
+    MODULE_NUMPY_AVAILABLE = False
+
+#-- maximum number of CityObjects in a tile
+MAX_FEATURES = 200
+
+#-- a tile is not cut anymore below that depth
+MAX_DEPTH = 16
+
+
+def bboxes(bi, vertices, transform=None):
+    """Compute the 3D bbox of the CityObjects of a BoundaryIndex
+
+    :param bi: A boundaries.BoundaryIndex, with its owners
+    :param vertices: The (N, 3) array of the vertices
+    :param transform: The "transform" of the city model, if compressed
+    :return: A tuple with the list of IDs and their (n, 6) array of bboxes,
+        (minx, miny, minz, maxx, maxy, maxz); the CityObjects without
+        vertices have none
+    """
+    ranges = [r for r in bi.owner_ranges() if r[2] > r[1]]
+    if len(ranges) == 0:
+        return ([], np.zeros((0, 6), dtype=np.float64))
+    starts = np.array([r[1] for r in ranges], dtype=np.int64)
+    vs = vertices[bi.flat]
+    b = np.hstack((np.minimum.reduceat(vs, starts, axis=0),
+                   np.maximum.reduceat(vs, starts, axis=0))).astype(np.float64)
+    if transform is not None:
+        b = (b * np.tile(transform["scale"], 2)) + np.tile(transform["translate"], 2)
+    return ([r[0] for r in ranges], b)
+
+
+def quadtree(points, max_features=MAX_FEATURES):
+    """Put the points in a quadtree
+
+    :param points: The (n, 2) (or (n, 3)) array of the points
+    :return: The root tile, a dict with the "indices" of its points (the
+        leaves only, an empty array for the others) and its "children" tiles
+    """
+    points = np.asarray(points, dtype=np.float64)[:, :2]
+    indices = np.arange(len(points))
+    if len(points) == 0:
+        return {"indices": indices, "children": []}
+    return _split(points, indices, points.min(axis=0), points.max(axis=0), max_features, 0)
+
+
+def _split(points, indices, pmin, pmax, max_features, depth):
+    if (len(indices) <= max_features) or (depth >= MAX_DEPTH):
+        return {"indices": indices, "children": []}
+    mid = (pmin + pmax) / 2
+    p = points[indices]
+    right = p[:, 0] >= mid[0]
+    top = p[:, 1] >= mid[1]
+    children = []
+    for r, t in ((False, False), (True, False), (False, True), (True, True)):
+        inside = (right == r) & (top == t)
+        if inside.any():
+            cmin = np.where([r, t], mid, pmin)
+            cmax = np.where([r, t], pmax, mid)
+            children.append(_split(points, indices[inside], cmin, cmax, max_features, depth + 1))
+    return {"indices": np.zeros(0, dtype=np.int64), "children": children}
+
+
+def leaves(tile):
+    """The leaves of a tile, depth-first"""
+    if len(tile["children"]) == 0:
+        return [tile]
+    return [l for c in tile["children"] for l in leaves(c)]
+
+
+def enu_axes(lon, lat):
+    """The east, north and up axes at a point of the ellipsoid, in ECEF
+
+    :param lon: The longitude of the point, in degrees
+    :param lat: The latitude of the point, in degrees
+    :return: The (3, 3) array of the unit vectors, one per row
+    """
+    l, p = np.radians(lon), np.radians(lat)
+    return np.array([[-np.sin(l), np.cos(l), 0.0],
+                     [-np.sin(p) * np.cos(l), -np.sin(p) * np.sin(l), np.cos(p)],
+                     [np.cos(p) * np.cos(l), np.cos(p) * np.sin(l), np.sin(p)]])
+
+
+def root_transform(axes, origin):
+    """The "transform" of the root tile, from the local coordinates to ECEF
+
+    :param axes: The (3, 3) array of the local axes in ECEF, see enu_axes()
+    :param origin: The ECEF coordinates of the local origin
+    :return: The 4x4 matrix, as a list in column-major order
+    """
+    m = np.identity(4)
+    m[:3, :3] = np.asarray(axes, dtype=np.float64).T
+    m[:3, 3] = origin
+    return m.T.reshape(-1).tolist()
+
+
+def tileset(root, bboxes, uris, transform=None):
+    """Make the tileset.json of a quadtree
+
+    :param root: The root tile, see quadtree()
+    :param bboxes: The (n, 6) array of the bboxes of the points of the tiles
+    :param uris: The URI of the content of each leaf, in the order of leaves()
+    :param transform: The "transform" of the root tile, see root_transform()
+    :return: The tileset, as a dict
+    """
+    tile, bbox = _tile(root, bboxes, iter(uris))
+    if transform is not None:
+        tile["transform"] = transform
+    return {
+        "asset": {"version": "1.0", "gltfUpAxis": "Z"},
+        "geometricError": tile["geometricError"],
+        "root": tile
+    }
+
+
+def _tile(tile, bboxes, uris):
+    """The tile of the tileset, and its bbox"""
+    if len(tile["children"]) == 0:
+        b = bboxes[tile["indices"]]
+        children = []
+    else:
+        children = [_tile(c, bboxes, uris) for c in tile["children"]]
+        b = np.array([c[1] for c in children])
+    bbox = np.concatenate((b[:, :3].min(axis=0), b[:, 3:].max(axis=0)))
+    center = (bbox[:3] + bbox[3:]) / 2
+    half = ((bbox[3:] - bbox[:3]) / 2).tolist()
+    t = {
+        "boundingVolume": {"box": center.tolist() + [half[0], 0.0, 0.0, 0.0, half[1], 0.0, 0.0, 0.0, half[2]]},
+        #-- the size of the tile, when it is seen without its CityObjects
+        "geometricError": 0.0 if len(children) == 0 else float(np.sqrt(np.square(half).sum()) * 2),
+        "refine": "ADD"
+    }
+    if len(children) == 0:
+        t["content"] = {"uri": next(uris)}
+    else:
+        t["children"] = [c[0] for c in children]
+    return (t, bbox)
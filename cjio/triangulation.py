@@ -0,0 +1,189 @@
+"""Cache of the triangulation of the geometries, shared by the exporters
+
+The OBJ, STL, glTF and b3dm exports all need the faces triangulated. The
+triangles of each geometry are kept, with a hash of what they depend on: the
+type and the structure of its boundaries, and its own vertices. The vertices
+are numbered in the geometry (in the order they first appear in it) and their
+coordinates are taken relative to its first one, so the hash doesn't change
+when the other geometries are modified, when the vertices are renumbered
+(clean, remove_orphan_vertices, merge...) or when the geometry is translated;
+the triangles are kept with these numbers too. A geometry is only
+triangulated again if its hash has changed. The triangles can be saved next
+to the CityJSON file and loaded back, they are then found by the hash of the
+geometries.
+"""
+import hashlib
+import json
+import os
+
+from cjio import geom_help
+
+MODULE_NUMPY_AVAILABLE = True
+try:
+    import numpy as np
+except ImportError as e:
+    MODULE_NUMPY_AVAILABLE = False
+
+SIDECAR_EXTENSION = '.tri.npz'
+
+
+class LocalIndex:
+    """The vertices of each geometry of a BoundaryIndex, numbered in the geometry
+
+    ``local`` is, for each index of bi.flat, the number of the vertex in its
+    geometry, in the order they first appear in it; ``vertices`` holds the
+    vertices of all the geometries in that order, those of geometry g from
+    ``starts[g]`` to ``starts[g+1]``.
+    """
+
+    def __init__(self, bi):
+        flat = np.asarray(bi.flat, dtype=np.int64)
+        self.n = int(flat.max()) + 1 if len(flat) > 0 else 1
+        gids = bi.geometry_ids()
+        self.u, first, inverse = np.unique(gids * self.n + flat, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        self.rank = np.empty_like(order)
+        self.rank[order] = np.arange(len(order))
+        self.starts = np.zeros(len(bi.geometries) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.u // self.n, minlength=len(bi.geometries)), out=self.starts[1:])
+        self.local = self.rank[inverse.reshape(-1)] - self.starts[gids]
+        self.vertices = (self.u % self.n)[order]
+
+    def to_local(self, a, g):
+        """The vertex indices in a of geometry g, as numbers in the geometry"""
+        return self.rank[np.searchsorted(self.u, g * self.n + a)] - self.starts[g]
+
+    def to_global(self, a, g):
+        """The numbers in geometry g in a, as vertex indices"""
+        return self.vertices[self.starts[g] + a]
+
+
+def geometry_keys(bi, coords, li=None):
+    """The hash of each geometry of a boundaries.BoundaryIndex
+
+    :param coords: The (N, 3) array of the coordinates of the vertices
+    :param li: The LocalIndex of bi
+    """
+    if li is None:
+        li = LocalIndex(bi)
+    local = np.ascontiguousarray(li.local, dtype=np.int64)
+    c = np.asarray(coords, dtype=np.float64)[li.vertices]
+    counts = np.diff(li.starts)
+    #-- relative to the first vertex of the geometry
+    c = np.ascontiguousarray(c - c[np.repeat(li.starts[:-1], counts)])
+    offsets = bi.offsets.tolist()
+    starts = li.starts.tolist()
+    keys = []
+    for i, g in enumerate(bi.geometries):
+        h = hashlib.sha1()
+        h.update(json.dumps([g.get("type"), bi.lengths[i]]).encode())
+        h.update(local[offsets[i]:offsets[i + 1]].tobytes())
+        h.update(c[starts[i]:starts[i + 1]].tobytes())
+        keys.append(h.hexdigest())
+    return keys
+
+
+class Triangulation:
+    """Triangles of the geometries, by CityObject ID and index of the geometry
+
+    ``entries`` holds, for each (ID, index), the hash of the geometry and its
+    triangles (with the vertices numbered in the geometry, see LocalIndex)
+    and their normals. ``stored`` holds the triangles read from a file, by
+    hash.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.stored = {}
+        self.path = None
+        self.modified = False
+
+    def get(self, bi, vnp, jobs=1, coords=None):
+        """Triangulate the geometries of a BoundaryIndex, or reuse their triangles
+
+        The owners of the BoundaryIndex are the IDs of the CityObjects. The
+        geometries not triangulated yet are triangulated together, see
+        geom_help.triangulate_geometries().
+
+        :param vnp: The (N, 3) array of the vertices to triangulate
+        :param jobs: The number of processes triangulating
+        :param coords: The coordinates of the vertices for the hash of the
+            geometries, vnp by default
+        :return: A tuple (triangles, normals, offsets) as
+            geom_help.triangulate_geometries()
+        """
+        li = LocalIndex(bi)
+        keys = geometry_keys(bi, vnp if coords is None else coords, li)
+        slots = []
+        previous = None
+        for owner in bi.owners:
+            i = slots[-1][1] + 1 if owner == previous else 0
+            slots.append((owner, i))
+            previous = owner
+        parts = [None] * len(keys)
+        missing = []
+        for i, (slot, k) in enumerate(zip(slots, keys)):
+            e = self.entries.get(slot)
+            if (e is not None) and (e[0] == k):
+                parts[i] = e[1:]
+            elif k in self.stored:
+                parts[i] = self.stored[k]
+            else:
+                missing.append(i)
+        if len(missing) > 0:
+            triangles, normals, offsets = geom_help.triangulate_geometries(
+                [bi.geometries[i] for i in missing], vnp, jobs, [bi.owners[i] for i in missing])
+            for m, i in enumerate(missing):
+                parts[i] = (li.to_local(triangles[offsets[m]:offsets[m + 1]], i),
+                            normals[offsets[m]:offsets[m + 1]])
+            self.modified = True
+        #-- the geometries that are gone are forgotten
+        self.entries = {slot: (k,) + tuple(p) for slot, k, p in zip(slots, keys, parts)}
+        counts = [len(p[0]) for p in parts]
+        offsets = np.zeros(len(parts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        triangles = np.concatenate([np.zeros((0, 3), dtype=np.int64)] +
+                                   [li.to_global(p[0], i) for i, p in enumerate(parts)])
+        normals = np.concatenate([np.zeros((0, 3), dtype=np.float64)] + [p[1] for p in parts])
+        return (triangles, normals, offsets)
+
+    def save(self, path):
+        """Write the triangles of the current geometries to a .npz file"""
+        entries = list(self.entries.values())
+        counts = np.array([len(e[1]) for e in entries], dtype=np.int64)
+        with open(path, 'wb') as fout:
+            np.savez(fout,
+                     keys=np.array([e[0] for e in entries], dtype=str),
+                     counts=counts,
+                     triangles=np.concatenate([np.zeros((0, 3), dtype=np.int64)] + [e[1] for e in entries]),
+                     normals=np.concatenate([np.zeros((0, 3), dtype=np.float64)] + [e[2] for e in entries]))
+        self.path = path
+        self.modified = False
+
+    def read(self, path):
+        """Add the triangles of a file written by save()
+
+        :return: False if the file can't be used
+        """
+        self.path = path
+        if not os.path.isfile(path):
+            return False
+        try:
+            with np.load(path, allow_pickle=False) as d:
+                keys = d["keys"].tolist()
+                offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+                np.cumsum(d["counts"], out=offsets[1:])
+                triangles = d["triangles"]
+                normals = d["normals"]
+        except (OSError, KeyError, ValueError):
+            return False
+        if (len(triangles) != offsets[-1]) or (len(normals) != offsets[-1]):
+            return False
+        for i, k in enumerate(keys):
+            self.stored[k] = (triangles[offsets[i]:offsets[i + 1]], normals[offsets[i]:offsets[i + 1]])
+        return True
+
+
+def sidecar_path(path):
+    """The file where the triangles of the CityJSON file 'path' are kept"""
+    return path + SIDECAR_EXTENSION
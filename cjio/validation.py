@@ -1,9 +1,21 @@
 
 import os
 import json
+import hashlib
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from sys import platform
 import jsonschema
 import jsonref
 
+from cjio import boundaries, vertices
+
+MODULE_NUMPY_AVAILABLE = True
+try:
+    import numpy as np
+except ImportError as e:
+    MODULE_NUMPY_AVAILABLE = False
+
 #-- ERRORS
  # validate_against_schema
  # parent_children_consistency
@@ -34,50 +46,55 @@ def dict_raise_on_duplicates(ordered_pairs):
     return d
 
 
+def _group_errors(j, theid, co, es):
+    if co['type'] == 'CityObjectGroup':
+        for each in co['members']:
+            if each not in j['CityObjects']:
+                s = "ERROR:   CityObjectGroup (#" + theid + ") contains member #" + each + ", but it doesn't exist." 
+                es.append(s)
+
+
 def city_object_groups(j):
-    isValid = True
     es = []
-    for id in j["CityObjects"]:
-        if j['CityObjects'][id]['type'] == 'CityObjectGroup':
-            for each in j['CityObjects'][id]['members']:
-                if each in j['CityObjects']:
-                    pass
-                else:
-                    s = "ERROR:   CityObjectGroup (#" + id + ") contains member #" + each + ", but it doesn't exist." 
-                    es.append(s)
-                    isValid = False
-    return (isValid, es)
+    for theid, co in j["CityObjects"].items():
+        _group_errors(j, theid, co, es)
+    return (len(es) == 0, es)
 
 
-def parent_children_consistency(j):
-    isValid = True
-    es = []
+def _children_errors(j, theid, co, es):
     #-- do children have the parent too?
-    for theid in j["CityObjects"]:
-        if "children" in j['CityObjects'][theid]:
-            for child in j['CityObjects'][theid]['children']:
-                if (child not in j['CityObjects']):
-                    s = "ERROR:   CityObject #" + child + " doesn't exist."
+    if "children" in co:
+        for child in co['children']:
+            if (child not in j['CityObjects']):
+                s = "ERROR:   CityObject #" + child + " doesn't exist."
+                es.append(s)
+                s = "\t(CityObject #" + theid + " references it as children)"   
+                es.append(s)
+            else:
+                if theid not in j['CityObjects'][child]['parents']:    
+                    s = "ERROR:   CityObject #" + child + " doesn't reference correct parent."
                     es.append(s)
-                    s = "\t(CityObject #" + theid + " references it as children)"   
+                    s = "\t(Parent should be CityObject #" + theid + ")"   
                     es.append(s)
-                    isValid = False
-                else:
-                    if theid not in j['CityObjects'][child]['parents']:    
-                        s = "ERROR:   CityObject #" + child + " doesn't reference correct parent."
-                        es.append(s)
-                        s = "\t(Parent should be CityObject #" + theid + ")"   
-                        es.append(s)
-                        isValid = False
+
+
+def _parents_errors(j, theid, co, es):
     #-- are there orphans?
-    for theid in j["CityObjects"]:
-        if "parents" in j['CityObjects'][theid]:
-            for parent in j['CityObjects'][theid]['parents']:
-                if (parent not in j['CityObjects']):
-                    s = "ERROR:   CityObject #" + theid + " is an orphan (parent #" + parent + " doesn't exist)."
-                    es.append(s)
-                    isValid = False
-    return (isValid, es)
+    if "parents" in co:
+        for parent in co['parents']:
+            if (parent not in j['CityObjects']):
+                s = "ERROR:   CityObject #" + theid + " is an orphan (parent #" + parent + " doesn't exist)."
+                es.append(s)
+
+
+def parent_children_consistency(j):
+    es = []
+    orphans = []
+    for theid, co in j["CityObjects"].items():
+        _children_errors(j, theid, co, es)
+        _parents_errors(j, theid, co, orphans)
+    es += orphans
+    return (len(es) == 0, es)
 
 
 def building_parts(j):
@@ -142,56 +159,55 @@ def building_pi_parent(j):
     return (isValid, es)
 
 
-def semantics_array(j):
-    isValid = True
-    es = []
-    for id in j["CityObjects"]:
-        # print("--", id)
-        geomid = 0
-        for g in j['CityObjects'][id]['geometry']:
-            if 'semantics' not in g:
-                continue
-            else:
-                sem = g['semantics']
-                # TODO: CompositeSolid
-                if g['type'] == 'Solid':
-                    shellid = 0
-                    for shell in g["boundaries"]:
-                        surfaceid = 0
-                        for surface in shell:
-                            i = None
-                            if sem['values'] is not None:
-                                if sem['values'][shellid] is not None:
-                                    i = sem['values'][shellid][surfaceid]
-                            if i is not None:
-                                if ( (type(i) is not int) or (i > (len(sem['surfaces']) - 1)) ):
-                                    s = "ERROR:   semantics arrays problems ( #" + id
-                                    es.append(s)
-                                    s = "; geom=" + str(geomid) + ",shell=" + str(shellid) + ",surface=" + str(surfaceid) + " )"
-                                    es.append(s)
-                                    isValid = False;
-                                    break
-                            surfaceid += 1
-                        shellid += 1
-                if g['type'] == 'MultiSurface' or g['type'] == 'CompositeSurface':
+def _semantics_errors(theid, co, es):
+    geomid = 0
+    for g in co['geometry']:
+        if 'semantics' not in g:
+            continue
+        else:
+            sem = g['semantics']
+            # TODO: CompositeSolid
+            if g['type'] == 'Solid':
+                shellid = 0
+                for shell in g["boundaries"]:
                     surfaceid = 0
-                    for surface in g["boundaries"]:
+                    for surface in shell:
                         i = None
                         if sem['values'] is not None:
-                            # print(surfaceid)
-                            if sem['values'][surfaceid] is not None:
-                                i = sem['values'][surfaceid]
+                            if sem['values'][shellid] is not None:
+                                i = sem['values'][shellid][surfaceid]
                         if i is not None:
                             if ( (type(i) is not int) or (i > (len(sem['surfaces']) - 1)) ):
-                                s = "ERROR:   semantics arrays problems ( #" + id
+                                s = "ERROR:   semantics arrays problems ( #" + theid
                                 es.append(s)
-                                s = "; geom=" + str(geomid) + ",surface=" + str(surfaceid) + " )"
+                                s = "; geom=" + str(geomid) + ",shell=" + str(shellid) + ",surface=" + str(surfaceid) + " )"
                                 es.append(s)
-                                isValid = False;
                                 break
                         surfaceid += 1
-            geomid += 1            
-    return (isValid, es)
+                    shellid += 1
+            if g['type'] == 'MultiSurface' or g['type'] == 'CompositeSurface':
+                surfaceid = 0
+                for surface in g["boundaries"]:
+                    i = None
+                    if sem['values'] is not None:
+                        if sem['values'][surfaceid] is not None:
+                            i = sem['values'][surfaceid]
+                    if i is not None:
+                        if ( (type(i) is not int) or (i > (len(sem['surfaces']) - 1)) ):
+                            s = "ERROR:   semantics arrays problems ( #" + theid
+                            es.append(s)
+                            s = "; geom=" + str(geomid) + ",surface=" + str(surfaceid) + " )"
+                            es.append(s)
+                            break
+                    surfaceid += 1
+        geomid += 1            
+
+
+def semantics_array(j):
+    es = []
+    for theid, co in j["CityObjects"].items():
+        _semantics_errors(theid, co, es)
+    return (len(es) == 0, es)
 
 
 def get_list_attributes_from_schema(n, ls):
@@ -219,25 +235,28 @@ def get_list_attributes_from_schema(n, ls):
     #             else:
     #                 thewarnings[s].append(id)                        
 
-def citygml_attributes(j, js):
-    isValid = True
-    thewarnings = {}
-    for id in j["CityObjects"]:
-        cotype = j['CityObjects'][id]['type']
-        if cotype[0] == "+":
-            continue
-            # TODO : implement for attributes of Extensions?
-        ls = []
-        get_list_attributes_from_schema(js[cotype], ls)
-        if 'attributes' in j['CityObjects'][id]:
-            for a in j['CityObjects'][id]['attributes']:
-                if ( (a[0] != "+") and (a not in ls) ):
-                    isValid = False;
-                    s = "WARNING: attributes '" + a + "' not in CityGML schema"
-                    if s not in thewarnings:
-                        thewarnings[s] = [id]
-                    else:
-                        thewarnings[s].append(id)
+def _citygml_attributes_warnings(theid, co, js, lsattributes, thewarnings):
+    #-- lsattributes: the attributes of each CityObject type, filled as we go
+    cotype = co['type']
+    if cotype[0] == "+":
+        return
+        # TODO : implement for attributes of Extensions?
+    if 'attributes' in co:
+        if cotype not in lsattributes:
+            ls = []
+            get_list_attributes_from_schema(js[cotype], ls)
+            lsattributes[cotype] = set(ls)
+        ls = lsattributes[cotype]
+        for a in co['attributes']:
+            if ( (a[0] != "+") and (a not in ls) ):
+                s = "WARNING: attributes '" + a + "' not in CityGML schema"
+                if s not in thewarnings:
+                    thewarnings[s] = [theid]
+                else:
+                    thewarnings[s].append(theid)
+
+
+def _format_citygml_attributes_warnings(thewarnings):
     ws = []
     for each in thewarnings:
         ws.append(each)
@@ -250,41 +269,82 @@ def citygml_attributes(j, js):
         else:
             s += "\t(" + str(len(thewarnings[each])) + " CityObjects have this warning)"
         ws.append(s)
-    return (isValid, ws)
+    return ws
+
+
+def citygml_attributes(j, js):
+    thewarnings = {}
+    lsattributes = {}
+    for theid, co in j["CityObjects"].items():
+        _citygml_attributes_warnings(theid, co, js, lsattributes, thewarnings)
+    return (len(thewarnings) == 0, _format_citygml_attributes_warnings(thewarnings))
+
+
+def _empty_geometry_warnings(theid, co, ws):
+    if (co['type'] != 'CityObjectGroup') and (len(co['geometry']) == 0):
+        s = "WARNING: " + co['type'] + " #" + theid + " has no geometry."
+        ws.append(s)
 
 
 def geometry_empty(j):
-    isValid = True
     ws = []
-    for id in j["CityObjects"]:
-        if (j['CityObjects'][id]['type'] != 'CityObjectGroup') and (len(j['CityObjects'][id]['geometry']) == 0):
-            isValid = False
-            s = "WARNING: " + j['CityObjects'][id]['type'] + " #" + id + " has no geometry."
-            ws.append(s)
-    return (isValid, ws)
+    for theid, co in j["CityObjects"].items():
+        _empty_geometry_warnings(theid, co, ws)
+    return (len(ws) == 0, ws)
 
 
-def wrong_vertex_index(j):
-    def recusionvisit(a, co, errs):
-      for each in a:
+def _boundary_index(j):
+    #-- None if it can't be built, then the nested arrays are visited
+    if not MODULE_NUMPY_AVAILABLE:
+        return None
+    try:
+        return boundaries.BoundaryIndex(*boundaries.collect(j))
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def _leaves(a, ids):
+    for each in a:
         if isinstance(each, list):
-            recusionvisit(each, co, errs)
+            _leaves(each, ids)
         else:
+            ids.append(each)
+
+
+def _wrong_vertex_errors(j, bi, es):
+    #-- with the flat index of all the boundaries
+    wrong = np.flatnonzero(bi.flat >= len(j['vertices']))
+    if len(wrong) > 0:
+        geomids = np.searchsorted(bi.offsets, wrong, side='right') - 1
+        for each, gi in zip(bi.flat[wrong].tolist(), geomids.tolist()):
+            s = "ERROR:   CityObject #" + bi.owners[gi] + " has geometry with wrong vertex."
+            s += " (vertex #" + str(each) + " doesn't exist)"   
+            es.append(s)
+
+
+def _wrong_vertex_errors_co(j, theid, co, ids, es):
+    #-- without the flat index, the used vertices are collected in ids
+    for g in co['geometry']:
+        vs = []
+        _leaves(g["boundaries"], vs)
+        for each in vs:
             if (each >= len(j['vertices'])):
-                s = "ERROR:   CityObject #" + co + " has geometry with wrong vertex."
+                s = "ERROR:   CityObject #" + theid + " has geometry with wrong vertex."
                 s += " (vertex #" + str(each) + " doesn't exist)"   
-                errs.append(s)
-    errs = []
-    for co in j["CityObjects"]:
-        for g in j['CityObjects'][co]['geometry']:
-            recusionvisit(g["boundaries"], co, errs)    
+                es.append(s)
+        ids.update(vs)
+
+
+def wrong_vertex_index(j):
     es = []
-    if (len(errs) > 0):
-        isValid = False
-        es += errs
+    bi = _boundary_index(j)
+    if bi is not None:
+        _wrong_vertex_errors(j, bi, es)
     else:
-        isValid = True
-    return (isValid, es)    
+        ids = set()
+        for theid, co in j["CityObjects"].items():
+            _wrong_vertex_errors_co(j, theid, co, ids, es)
+    return (len(es) == 0, es)    
 
 
 def cityjson_properties(j, js):
@@ -302,14 +362,49 @@ def cityjson_properties(j, js):
 def duplicate_vertices(j):
     isValid = True
     ws = []
-    thev = set()
-    duplicates = set()
-    for v in j["vertices"]:
-        s = str(v[0]) + " " + str(v[1]) + " " + str(v[2])
-        if s in thev:
-            duplicates.add(s)
-        else:
-            thev.add(s)
+    duplicates = []
+    a = None
+    if MODULE_NUMPY_AVAILABLE:
+        try:
+            a = vertices.to_array(j["vertices"])
+        except ValueError:
+            a = None
+    if a is not None:
+        firsts = []
+        index = np.arange(len(a))
+        if a.dtype.kind == 'f':
+            #-- 1 and 1.0 are different strings, but the same float: the
+            #-- vertices with an integral coordinate (maybe an int in the file)
+            #-- are compared as strings, the others by the bits of the floats
+            #-- (like the strings, -0.0 and 0.0 are different)
+            integral = (a == np.floor(a)).any(axis=1)
+            seen = {}
+            for i in np.flatnonzero(integral).tolist():
+                v = j["vertices"][i]
+                s = str(v[0]) + " " + str(v[1]) + " " + str(v[2])
+                if s not in seen:
+                    seen[s] = i
+                elif seen[s] is not None:
+                    firsts.append(seen[s])
+                    seen[s] = None
+            index = np.flatnonzero(~integral)
+            a = a[index].view(np.int64)
+        if len(a) > 0:
+            u, first, counts = np.unique(a, axis=0, return_index=True, return_counts=True)
+            firsts.extend(index[first[counts > 1]].tolist())
+        for i in sorted(firsts):
+            v = j["vertices"][i]
+            duplicates.append(str(v[0]) + " " + str(v[1]) + " " + str(v[2]))
+    else:
+        thev = set()
+        dups = set()
+        for v in j["vertices"]:
+            s = str(v[0]) + " " + str(v[1]) + " " + str(v[2])
+            if s in thev:
+                dups.add(s)
+            else:
+                thev.add(s)
+        duplicates = list(dups)
     if len(duplicates) > 0:
         s = 'WARNING: there are ' + str(len(duplicates)) + ' duplicate vertices in j["vertices"]'
         ws.append(s)
@@ -321,19 +416,10 @@ def duplicate_vertices(j):
     return (isValid, ws)
 
 
-def orphan_vertices(j):
-    def recusionvisit(a, ids):
-      for each in a:
-        if isinstance(each, list):
-            recusionvisit(each, ids)
-        else:
-            ids.add(each)
+def _orphan_vertices_warnings(j, ids):
+    #-- ids: the set of the vertex indices used
     isValid = True
     ws = []
-    ids = set()
-    for co in j["CityObjects"]:
-        for g in j['CityObjects'][co]['geometry']:
-            recusionvisit(g["boundaries"], ids)
     noorphans = len(j["vertices"]) - len(ids)
     if noorphans > 0:
         s = 'WARNING: there are ' + str(noorphans) + ' orphan vertices in j["vertices"]'
@@ -345,26 +431,265 @@ def orphan_vertices(j):
             all.add(i)
         symdiff = all.symmetric_difference(ids)
         s = '\t['
-        for each in symdiff:
+        for each in sorted(symdiff):
             s += str(each) + ', '
         s += ']'
         ws.append(s)
     return (isValid, ws)
 
 
-def validate_against_schema(j, js, longerr):
-    isValid = True
+def orphan_vertices(j):
+    bi = _boundary_index(j)
+    if bi is not None:
+        ids = set(np.unique(bi.flat).tolist())
+    else:
+        ids = set()
+        for co in j["CityObjects"].values():
+            for g in co['geometry']:
+                vs = []
+                _leaves(g["boundaries"], vs)
+                ids.update(vs)
+    return _orphan_vertices_warnings(j, ids)
+
+
+def internal_consistency(j, js, jsco, parent_children=True, report=None):
+    """Run all the checks of the internal consistency in one pass
+
+    Each CityObject is visited once and given to each check, and the checks
+    of the vertex indices are done on the flat index of the boundaries (if
+    NumPy is available). The errors and warnings are the same, and in the
+    same order, as when calling the functions one after the other (as
+    CityJSON.validate() used to do).
+
+    :param js: The CityJSON schema (for the root properties)
+    :param jsco: The schema of the CityObjects (for the CityGML attributes)
+    :param parent_children: Check the parents/children (CityJSON v0.7+)
+    :param report: A function called with the name of each check, in the
+        order they used to be run, when its results are collected
+    :return: A tuple (isValid, woWarnings, errors, warnings)
+    """
+    if report is None:
+        report = lambda check: None
+    cos = j["CityObjects"]
+    bi = _boundary_index(j)
+    ids = None if bi is not None else set()
+    #-- the errors of each check, then the warnings
+    es_children, es_parents, es_vertices, es_groups, es_semantics = [], [], [], [], []
+    ws_empty = []
+    thewarnings = {}
+    lsattributes = {}
+    for theid, co in cos.items():
+        if parent_children:
+            _children_errors(j, theid, co, es_children)
+            _parents_errors(j, theid, co, es_parents)
+        if bi is None:
+            _wrong_vertex_errors_co(j, theid, co, ids, es_vertices)
+        _group_errors(j, theid, co, es_groups)
+        _semantics_errors(theid, co, es_semantics)
+        _empty_geometry_warnings(theid, co, ws_empty)
+        _citygml_attributes_warnings(theid, co, jsco, lsattributes, thewarnings)
+    report("Vertex indices coherent")
+    if bi is not None:
+        _wrong_vertex_errors(j, bi, es_vertices)
+        ids = set(np.unique(bi.flat).tolist())
+    report("Specific for CityGroups")
+    report("Semantic arrays coherent with geometry")
+    es = es_children + es_parents + es_vertices + es_groups + es_semantics
+    results = []
+    report("Root properties")
+    results.append(cityjson_properties(j, js))
+    report("Empty geometries")
+    results.append((len(ws_empty) == 0, ws_empty))
+    report("Duplicate vertices")
+    results.append(duplicate_vertices(j))
+    report("Orphan vertices")
+    results.append(_orphan_vertices_warnings(j, ids))
+    report("CityGML attributes")
+    results.append((len(thewarnings) == 0, _format_citygml_attributes_warnings(thewarnings)))
+    ws = []
+    for b, errs in results:
+        if b == False:
+            ws += errs
+    woWarnings = all(b for b, errs in results)
+    return (len(es) == 0, woWarnings, es, ws)
+
+
+#-- the schemas already resolved, and their validators
+_schemas = {}
+_validators = {}
+MAX_VALIDATORS = 256
+#-- folder where the resolved schemas are pickled, None to keep them in memory only
+_schema_cache_dir = None
+
+
+def default_schema_cache_dir():
+    """The folder of the user for the cache of cjio"""
+    if platform == "win32" and "LOCALAPPDATA" in os.environ:
+        base = os.environ["LOCALAPPDATA"]
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "cjio")
+
+
+def set_schema_cache_dir(folder):
+    """Pickle the resolved schemas in this folder (None to stop doing it)"""
+    global _schema_cache_dir
+    _schema_cache_dir = folder
+
+
+def _base_uri(folder):
+    abs_path = os.path.abspath(folder)
+    #-- because Windows uses \ and not /
+    if platform == "darwin" or platform == "linux" or platform == "linux2":
+        return 'file://{}/'.format(abs_path)
+    else:
+        return 'file:///{}/'.format(abs_path.replace('\\', '/'))
+
+
+def _dereference(obj, memo):
+    #-- replace the jsonref proxies by what they point to, the schema is then
+    #-- made of plain dicts/lists (which can be pickled, and are much faster
+    #-- to go through). The references loops are kept as loops.
+    while isinstance(obj, jsonref.JsonRef):
+        obj = obj.__subject__
+    if isinstance(obj, dict):
+        if id(obj) not in memo:
+            d = {}
+            memo[id(obj)] = d
+            for k, v in obj.items():
+                d[k] = _dereference(v, memo)
+        return memo[id(obj)]
+    if isinstance(obj, list):
+        if id(obj) not in memo:
+            l = []
+            memo[id(obj)] = l
+            l.extend(_dereference(v, memo) for v in obj)
+        return memo[id(obj)]
+    return obj
+
+
+def _schema_digest(path):
+    #-- the schema and the ones it can refer to: those in the same folder
+    #-- and in the parent folder
+    h = hashlib.sha1()
+    h.update(jsonref.__version__.encode() if hasattr(jsonref, '__version__') else b'')
+    h.update(path.encode())
+    folder = os.path.dirname(path)
+    for d in (folder, os.path.dirname(folder)):
+        for f in sorted(os.listdir(d)):
+            p = os.path.join(d, f)
+            if f.endswith('.json') and os.path.isfile(p):
+                h.update(f.encode())
+                with open(p, 'rb') as fin:
+                    h.update(fin.read())
+    return h.hexdigest()
+
+
+def load_schema(path):
+    """Load a schema file with its references resolved
+
+    Each file is read and resolved once (as long as it's not modified), the
+    same object is returned afterwards. If set_schema_cache_dir() was used,
+    the resolved schema is also pickled in that folder, keyed by a hash of the
+    schema files, and read back from there the next time.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    if key in _schemas:
+        return _schemas[key]
+    js = None
+    pkl = None
+    if _schema_cache_dir is not None:
+        pkl = os.path.join(_schema_cache_dir, _schema_digest(path) + '.pickle')
+        try:
+            with open(pkl, 'rb') as fin:
+                js = pickle.load(fin)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            js = None
+    if js is None:
+        with open(path) as fin:
+            js = jsonref.loads(fin.read(), jsonschema=True, base_uri=_base_uri(os.path.dirname(path)))
+        js = _dereference(js, {})
+        if pkl is not None:
+            try:
+                os.makedirs(_schema_cache_dir, exist_ok=True)
+                with open(pkl, 'wb') as fout:
+                    pickle.dump(js, fout, protocol=pickle.HIGHEST_PROTOCOL)
+            except OSError:
+                pass
+    _schemas[key] = js
+    return js
+
+
+def get_validator(js):
+    """The validator of a schema, made once per schema object"""
+    if id(js) not in _validators:
+        if len(_validators) >= MAX_VALIDATORS:
+            _validators.clear()
+        #-- the schema is kept with it, so that its id() stays unique
+        _validators[id(js)] = (js, jsonschema.Draft7Validator(js, format_checker=jsonschema.FormatChecker()))
+    return _validators[id(js)][1]
+
+
+def _format_error(err, longerr):
+    if (longerr == False) and (len(err.relative_path) > 0) and (err.relative_path[0] == 'CityObjects'):
+        return "CityObject is not schema-valid: " + str(err.relative_path[1])
+    else:
+        return err.message
+
+
+def _schema_errors(j, js, longerr, prefix=None):
+    #-- the errors as (key to sort them, message) tuples. With a prefix, j is
+    #-- js at this (instance path, schema path) of the whole document, and the
+    #-- errors are made as if the whole document was validated
     es = []
+    for err in get_validator(js).iter_errors(j):
+        if prefix is not None:
+            err.path.extendleft(reversed(prefix[0]))
+            err.schema_path.extendleft(reversed(prefix[1]))
+        es.append((str(err), _format_error(err, longerr)))
+    return es
+
+
+#-- the schema of the CityObjects in the processes of validate_against_schema()
+_worker_schema = None
+
+def _init_worker(js):
+    global _worker_schema
+    _worker_schema = js
+
+
+def _validate_cityobjects(cityobjects, longerr):
+    return _schema_errors(cityobjects, _worker_schema, longerr,
+                          (['CityObjects'], ['properties', 'CityObjects']))
+
+
+def validate_against_schema(j, js, longerr, jobs=1):
+    """Validate j against the schema js
+
+    With jobs > 1 (and j a CityJSON object), the document without its
+    CityObjects is validated first, then the CityObjects are validated in
+    chunks by that number of processes. The errors are the same, and in the
+    same order, as with one process.
+    """
     #-- lazy validation to catch as many as possible
-    myvalidator = jsonschema.Draft7Validator(js, format_checker=jsonschema.FormatChecker())
-    for err in sorted(myvalidator.iter_errors(j), key=str):
-        isValid = False
-        if (longerr == False) and (len(err.relative_path) > 0) and (err.relative_path[0] == 'CityObjects'):
-            a = "CityObject is not schema-valid: " + str(err.relative_path[1])
-            es.append(a)
-        else:
-            es.append(err.message)
-    return (isValid, es)
+    if ((jobs > 1) and isinstance(j, dict) and isinstance(j.get("CityObjects"), dict) and
+        len(j["CityObjects"]) > 1 and "CityObjects" in js.get("properties", {})):
+        skeleton = dict(j)
+        skeleton["CityObjects"] = {}
+        es = _schema_errors(skeleton, js, longerr)
+        ids = list(j["CityObjects"])
+        n = max(1, -(-len(ids) // (jobs * 4)))
+        chunks = [{theid: j["CityObjects"][theid] for theid in ids[i:i + n]} for i in range(0, len(ids), n)]
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(js["properties"]["CityObjects"],)) as pool:
+            for errs in pool.map(_validate_cityobjects, chunks, [longerr] * len(chunks)):
+                es += errs
+    else:
+        es = _schema_errors(j, js, longerr)
+    es.sort(key=lambda e: e[0])
+    return (len(es) == 0, [e[1] for e in es])
 
     # try:
     #     jsonschema.Draft4Validator(js, format_checker=jsonschema.FormatChecker()).validate(j)
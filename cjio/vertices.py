@@ -0,0 +1,62 @@
+"""Array operations on the vertices of a city model"""
+
+MODULE_NUMPY_AVAILABLE = True
+try:
+    import numpy as np
+except ImportError as e:
+    MODULE_NUMPY_AVAILABLE = False
+
+
+def to_array(vertices, transform=None):
+    """Convert a list of vertices to an (N, 3) array
+
+    Integers (compressed vertices) stay integers, so that writing the array
+    back with tolist() gives the same JSON.
+    """
+    if len(vertices) == 0:
+        return np.zeros((0, 3), dtype=np.int64 if transform is not None else np.float64)
+    a = np.array(vertices)
+    if a.ndim != 2 or a.shape[1] != 3 or a.dtype.kind not in 'if':
+        raise ValueError("Vertices must be a list of (x, y, z) numbers")
+    return a
+
+
+def quantize(a, digits):
+    """Scale the coordinates by 10**digits and round them to integers
+
+    Gives the same integers as formatting each coordinate with '%.{digits}f'
+    and removing the dot, which is what cjio has always done. The few
+    coordinates that are too close to a tie to be decided with floats are
+    formatted like that.
+
+    :return: An array of int64, or None if the integers can't be exact
+    """
+    a = np.asarray(a)
+    x = a.astype(np.float64) * (10 ** digits)
+    if x.size == 0:
+        return x.astype(np.int64)
+    if np.abs(x).max() >= 2**52:
+        return None
+    q = np.rint(x)
+    eps = np.finfo(np.float64).eps
+    ambiguous = np.abs(x - np.floor(x) - 0.5) <= (np.abs(x) + 1.0) * 4 * eps
+    if ambiguous.any():
+        p = '%.' + str(digits) + 'f'
+        for i in zip(*np.nonzero(ambiguous)):
+            q[i] = int((p % a[i]).replace('.', ''))
+    return q.astype(np.int64)
+
+
+def unique(q):
+    """Find the unique rows of q, in the order they first appear
+
+    :return: A tuple with the array of unique rows, and for each row of q
+        the index of its unique row
+    """
+    if len(q) == 0:
+        return (q, np.zeros(0, dtype=np.int64))
+    u, first, inverse = np.unique(q, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return (u[order], rank[inverse.reshape(-1)])
@@ -0,0 +1,39 @@
+"""Flat index of the geometry boundaries
+
+"""
+import copy
+
+from cjio import boundaries
+
+
+class TestBoundaryIndex:
+    def test_flatten(self):
+        b = [[[0, 1, 2, 3], [4, 5, 6]], [[7, 8, 9]]]
+        flat, lengths = boundaries.flatten(b, 3)
+        assert flat == list(range(10))
+        assert lengths == [[2, 1], [4, 3, 3]]
+        assert boundaries.unflatten(flat, lengths) == b
+
+    def test_round_trip(self, zurich_subset):
+        j = copy.deepcopy(zurich_subset.j)
+        bi = boundaries.BoundaryIndex(*boundaries.collect(j))
+        bi.update(bi.flat.copy())
+        assert j == zurich_subset.j
+        assert bi.is_current(boundaries.collect(j)[0])
+
+    def test_remap(self):
+        geoms = [{'type': 'MultiSurface', 'boundaries': [[[2, 1, 0]]]},
+                 {'type': 'MultiPoint', 'boundaries': [1, 3]}]
+        bi = boundaries.BoundaryIndex(geoms, ['a', 'b'])
+        assert bi.vertices_in_order().tolist() == [2, 1, 0, 3]
+        assert bi.owner_ranges() == [('a', 0, 3), ('b', 3, 5)]
+        bi.remap([10, 11, 12, 13])
+        assert geoms[0]['boundaries'] == [[[12, 11, 10]]]
+        assert geoms[1]['boundaries'] == [11, 13]
+
+    def test_irregular(self):
+        geoms = [{'type': 'MultiSurface', 'boundaries': [[[0, 1, [2]]]]}]
+        bi = boundaries.BoundaryIndex(geoms)
+        assert bi.flat.tolist() == [0, 1, 2]
+        bi.remap([5, 6, 7])
+        assert geoms[0]['boundaries'] == [[[5, 6, [7]]]]
@@ -5,9 +5,10 @@ import pytest
 import os.path
 from click.testing import CliRunner
 import copy
-from cjio import cityjson, models
+from cjio import cityjson, models, vertices
 from cjio import cjio
 from math import isclose
+import numpy as np
 
 
 @pytest.fixture(scope='module')
@@ -149,11 +150,69 @@ class TestCityJSON:
         assert isclose(cm.j["vertices"][0][0], 4.36772776578513, abs_tol=0.00001)
         assert (cm.j["metadata"]["geographicalExtent"][5] - cm.j["metadata"]["geographicalExtent"][2]) == 6.1
 
+    def test_subset_ids(self, dummy, capsys):
+        cm = copy.deepcopy(dummy)
+        s = cm.get_subset_ids(['nothere', 'mygroup1', 'absent'])
+        #-- one level only: the children of the members are not added
+        assert set(s.j["CityObjects"]) == {'mygroup1', '102636712', 'mylake'}
+        out = capsys.readouterr().out.splitlines()
+        assert out == ["WARNING: ID absent not found in input file; ignored.",
+                       "WARNING: ID nothere not found in input file; ignored."]
+        cm = copy.deepcopy(dummy)
+        s = cm.get_subset_ids(['itcanbeastringtoo'])
+        assert set(s.j["CityObjects"]) == {'itcanbeastringtoo', '801'}
+        #-- "parents" (CityJSON v1.0) is not followed, the parent would have
+        #-- children not in the subset
+        cm = copy.deepcopy(dummy)
+        s = cm.get_subset_ids(['801'])
+        assert set(s.j["CityObjects"]) == {'801'}
+
+    def test_reproject_jobs(self, delft_1b):
+        cm = copy.deepcopy(delft_1b)
+        cm.reproject(4937)
+        cm2 = copy.deepcopy(delft_1b)
+        cm2.reproject(4937, jobs=3, chunk_size=100)
+        assert cm.j["vertices"] == cm2.j["vertices"]
+
     def test_convert_to_stl(self, delft):
          cm = copy.deepcopy(delft)
          obj = cm.export2stl()
 
-    def test_export_stl_cmd(self, data_dir, data_output_dir):
+    def test_export_to_file(self, delft, tmp_path, monkeypatch):
+        monkeypatch.setattr(cityjson, 'EXPORT_CHUNK_SIZE', 7)
+        cm = copy.deepcopy(delft)
+        for export in (cm.export2obj, cm.export2stl):
+            p = str(tmp_path / 'out.txt')
+            with open(p, 'w') as fo:
+                assert export(fo) is fo
+            with open(p) as fo:
+                assert fo.read() == export().getvalue()
+
+    def test_export_stl_vertices(self, delft, cube_compressed, monkeypatch):
+        monkeypatch.setattr(cityjson, 'EXPORT_CHUNK_SIZE', 7)
+        for cm in (copy.deepcopy(delft), copy.deepcopy(cube_compressed)):
+            lines = cm.export2stl().getvalue().splitlines()
+            triangles = cm.get_triangulation()[0]
+            expected = ["vertex %s %s %s" % tuple(str(x) for x in cm.j["vertices"][i])
+                        for i in triangles.ravel().tolist()]
+            assert [l for l in lines if l.startswith('vertex')] == expected
+
+    def test_export_stl_binary(self, delft):
+        cm = copy.deepcopy(delft)
+        b = cm.export2stl(binary=True).getvalue()
+        lines = cm.export2stl().getvalue().splitlines()
+        n = int(np.frombuffer(b[80:84], dtype='<u4')[0])
+        assert n == sum(1 for l in lines if l.startswith('facet'))
+        assert len(b) == 84 + 50 * n
+        facets = np.frombuffer(b[84:], dtype=cityjson.STL_FACET)
+        v = np.array([[float(x) for x in l.split()[1:]] for l in lines if l.startswith('vertex')])
+        #-- translated by the minimum corner, written in the header
+        offset = np.array([float(x) for x in b[:80].split()[2:5]])
+        assert b[:15] == b'cjio translate '
+        assert np.array_equal(offset, np.floor(v.min(axis=0)))
+        assert np.allclose(facets['vertices'].reshape(-1, 3) + offset, v, rtol=0, atol=1e-4)
+
+    def test_export_stl_cmd(self, data_dir, tmp_path):
         """Debugging"""
         p = os.path.join(data_dir, 'delft.json')
         runner = CliRunner()
@@ -161,4 +220,59 @@ class TestCityJSON:
                                args=[p,
                                      'export',
                                      '--format', 'stl',
-                                     data_output_dir])
+                                     str(tmp_path)])
+
+    def test_vertices_array(self, cube):
+        cm = copy.deepcopy(cube)
+        v = cm.get_vertices_array()
+        assert v.shape == (len(cm.j["vertices"]), 3)
+        cm.set_vertices_array(v + 1)
+        assert cm.j["vertices"][0] == [a + 1 for a in cube.j["vertices"][0]]
+        cm.j["vertices"] = [[0, 0, 0]]
+        assert cm.get_vertices_array().tolist() == [[0, 0, 0]]
+
+    def test_vertices_modified_in_place(self, cube):
+        cm = copy.deepcopy(cube)
+        assert cm.calculate_bbox()[2::3] == [0, 1]
+        c = cm.get_centroid("id-1")
+        for v in cm.j["vertices"]:
+            v[2] += 100
+        assert cm.calculate_bbox()[2::3] == [100, 101]
+        assert cm.get_centroid("id-1")[2] == c[2] + 100
+        #-- in a block, the array is kept
+        with cm.keep_vertices():
+            v = cm.get_vertices_array()
+            assert cm.get_vertices_array() is v
+            assert copy.deepcopy(cm)._keep_vertices == 0
+        assert cm._vertices is None
+
+    def test_compress_same_as_python(self, delft, monkeypatch):
+        cm1 = copy.deepcopy(delft)
+        cm1.compress(3)
+        monkeypatch.setattr(cityjson, 'MODULE_NUMPY_AVAILABLE', False)
+        cm2 = copy.deepcopy(delft)
+        cm2.compress(3)
+        assert cm1.j["vertices"] == cm2.j["vertices"]
+        assert cm1.j["transform"] == cm2.j["transform"]
+
+    def test_compress_quantize_fails(self, delft, monkeypatch):
+        cm1 = copy.deepcopy(delft)
+        cm1.compress(3)
+        #-- the integers can't be exact, the vertices are converted one by one
+        quantize = vertices.quantize
+        monkeypatch.setattr(vertices, 'quantize', lambda a, digits: None if digits == 3 else quantize(a, digits))
+        cm2 = copy.deepcopy(delft)
+        cm2.get_vertices_array()
+        cm2.compress(3)
+        assert cm1.j["vertices"] == cm2.j["vertices"]
+        assert cm1.j["transform"] == cm2.j["transform"]
+
+    def test_remove_duplicate_vertices_same_as_python(self, zurich_subset, monkeypatch):
+        cm1 = copy.deepcopy(zurich_subset)
+        cm1.decompress()
+        cm2 = copy.deepcopy(cm1)
+        n1 = cm1.remove_duplicate_vertices(2)
+        monkeypatch.setattr(cityjson, 'MODULE_NUMPY_AVAILABLE', False)
+        n2 = cm2.remove_duplicate_vertices(2)
+        assert n1 == n2
+        assert cm1.j == cm2.j
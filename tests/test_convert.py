@@ -1,12 +1,140 @@
+import copy
+import json
 import os.path
 from click.testing import CliRunner
 
+import numpy as np
+
 from cjio import convert
 from cjio import cjio
+from cjio import geom_help
+from cjio import boundaries
+from cjio import cityjson
+
+
+class TestTriangulation:
+
+    def test_triangulate_geometries(self):
+        vnp = np.array([[0, 0, 0], [4, 0, 0], [4, 4, 0], [0, 4, 0],
+                        [1, 1, 0], [1, 2, 0], [2, 2, 0], [2, 1, 0],
+                        [0, 0, 1]], dtype=np.float64)
+        geoms = [{'type': 'MultiSurface', 'boundaries': [[[0, 1, 2, 3]]]},
+                 {'type': 'MultiPoint', 'boundaries': [8]},
+                 {'type': 'Solid', 'boundaries': [[[[0, 1, 2, 3], [4, 5, 6, 7]],
+                                                   [[0, 1, 8]]]]}]
+        triangles, normals, offsets = geom_help.triangulate_geometries(geoms, vnp)
+        assert offsets.tolist() == [0, 2, 2, 11]
+        assert triangles[:2].tolist() == [[2, 3, 0], [2, 0, 1]]
+        assert triangles[-1].tolist() == [0, 1, 8]
+        #-- the square with a hole is cut in 8 triangles
+        assert len(set(triangles[2:10].ravel().tolist())) == 8
+        assert normals[:10].tolist() == [[0, 0, 1]] * 10
+
+    def test_triangulate_parallel(self, delft):
+        geoms, owners = boundaries.collect(delft.j)
+        vnp = np.array(delft.j["vertices"], dtype=np.float64)
+        serial = geom_help.triangulate_geometries(geoms, vnp)
+        parallel = geom_help.triangulate_geometries(geoms, vnp, jobs=2, owners=owners)
+        for a, b in zip(serial, parallel):
+            assert np.array_equal(a, b)
+
+    def test_triangulate_face(self):
+        vnp = np.array([[0, 0, 0], [4, 0, 0], [4, 4, 0], [0, 4, 0]], dtype=np.float64)
+        assert geom_help.triangulate_face([[0, 1, 2]], vnp) == [[0, 1, 2]]
+        assert len(geom_help.triangulate_face([[0, 1, 2, 3]], vnp)) == 2
+
+
+def read_glb(glb):
+    """The JSON and the binary chunk of a glb"""
+    b = glb.getvalue()
+    n = int.from_bytes(b[12:16], 'little')
+    return (json.loads(b[20:20 + n].decode('utf-8')), b[28 + n:])
+
+
+def read_accessor(gltf, binary, i):
+    a = gltf["accessors"][i]
+    bv = gltf["bufferViews"][a["bufferView"]]
+    dtype = {5120: '<i1', 5122: '<i2', 5123: '<u2', 5125: '<u4', 5126: '<f4'}[a["componentType"]]
+    size = {"SCALAR": 1, "VEC3": 3, "VEC4": 4}[a["type"]]
+    itemsize = np.dtype(dtype).itemsize
+    return np.ndarray((a["count"], size), dtype=dtype, buffer=binary,
+                      offset=bv["byteOffset"] + a.get("byteOffset", 0),
+                      strides=(bv.get("byteStride", itemsize * size), itemsize))
 
 
 class TestGltf:
 
+    def test_indexed(self, delft):
+        triangles, normals, offsets = delft.get_triangulation()
+        vertices = np.array(delft.j["vertices"], dtype=np.float32)
+        for indexed in (True, False):
+            gltf, binary = read_glb(convert.to_glb(delft.j, triangles=(triangles, normals, offsets), indexed=indexed))
+            assert len(gltf["bufferViews"]) == 2
+            corners = []
+            for coi, mesh in enumerate(gltf["meshes"]):
+                p = mesh["primitives"][0]
+                idx = read_accessor(gltf, binary, p["indices"]).reshape(-1)
+                pos = read_accessor(gltf, binary, p["attributes"]["POSITION"])
+                bid = read_accessor(gltf, binary, p["attributes"]["_BATCHID"]).reshape(-1)
+                assert gltf["accessors"][p["indices"]]["componentType"] == 5123
+                assert list(delft.j["CityObjects"])[bid[0]] == mesh["name"]
+                assert (bid == bid[0]).all()
+                assert len(pos) == (len(np.unique(idx)) if indexed else len(idx))
+                corners.append(pos[idx])
+            assert np.array_equal(np.concatenate(corners), vertices[triangles.reshape(-1)])
+
+    def test_quantize(self, delft):
+        triangles, normals, offsets = delft.get_triangulation()
+        gltf, binary = read_glb(convert.to_glb(delft.j, triangles=(triangles, normals, offsets),
+                                               quantize=True, normals=True))
+        assert gltf["extensionsRequired"] == ["KHR_mesh_quantization"]
+        owners = list(delft.j["CityObjects"])
+        for mesh, node in zip(gltf["meshes"][:100], gltf["nodes"]):
+            p = mesh["primitives"][0]
+            idx = read_accessor(gltf, binary, p["indices"]).reshape(-1)
+            pos = read_accessor(gltf, binary, p["attributes"]["POSITION"]) * node["scale"] + node["translation"]
+            n = read_accessor(gltf, binary, p["attributes"]["NORMAL"]) / 127
+            #-- the same triangles, in another order
+            theid = owners.index(mesh["name"])
+            geoms = sum(len(co.get("geometry", [])) for co in list(delft.j["CityObjects"].values())[:theid])
+            t = triangles[offsets[geoms]:offsets[geoms + len(delft.j["CityObjects"][mesh["name"]]["geometry"])]]
+            expected = np.array(delft.j["vertices"])[t].reshape(-1, 9)
+            got = pos[idx].reshape(-1, 9)
+            d = np.abs(got[:, None, :] - expected[None, :, :]).max(axis=2)
+            assert sorted(d.argmin(axis=1).tolist()) == list(range(len(t)))
+            assert (d.min(axis=1) <= node["scale"][0]).all()
+            #-- the degenerate triangles have no normal
+            length = np.linalg.norm(n, axis=1)
+            assert (np.isclose(length, 1, atol=0.02) | (length == 0)).all()
+
+    def test_instancing(self, dummy):
+        gltf, binary = read_glb(convert.to_glb(dummy.j))
+        assert gltf["extensionsUsed"] == ["EXT_mesh_gpu_instancing"]
+        nodes = [n for n in gltf["nodes"] if "extensions" in n]
+        assert len(nodes) == 1
+        assert gltf["meshes"][nodes[0]["mesh"]]["name"] == "template-0"
+        attributes = nodes[0]["extensions"]["EXT_mesh_gpu_instancing"]["attributes"]
+        coi = list(dummy.j["CityObjects"]).index("onebigtree-template")
+        g = dummy.j["CityObjects"]["onebigtree-template"]["geometry"][0]
+        assert read_accessor(gltf, binary, attributes["TRANSLATION"]).tolist() == [dummy.j["vertices"][g["boundaries"][0]]]
+        assert read_accessor(gltf, binary, attributes["ROTATION"]).tolist() == [[0, 0, 0, 1]]
+        assert read_accessor(gltf, binary, attributes["SCALE"]).tolist() == [[2, 2, 2]]
+        assert read_accessor(gltf, binary, attributes["_BATCHID"]).tolist() == [[coi]]
+
+    def test_instance_trs(self):
+        #-- 90 degrees around z, scaled by 3, moved by (1, 2, 3)
+        m = [0, -3, 0, 1, 3, 0, 0, 2, 0, 0, 3, 3, 0, 0, 0, 1]
+        translation, rotation, scale = convert.instance_trs(m, np.array([10, 0, 0]))
+        assert np.allclose(translation, [11, 2, 3])
+        assert np.allclose(rotation, [0, 0, np.sqrt(0.5), np.sqrt(0.5)])
+        assert np.allclose(scale, [3, 3, 3])
+
+    def test_optimize_vertex_cache(self):
+        triangles = np.array([[0, 1, 2], [3, 4, 5], [2, 1, 6], [5, 4, 7]])
+        order = convert.optimize_vertex_cache(triangles, 8)
+        assert sorted(order.tolist()) == [0, 1, 2, 3]
+        assert order.tolist()[:2] == [0, 2]
+
     def test_convert_to_glb(self, delft):
         glb = convert.to_glb(delft.j)
 
@@ -27,19 +155,102 @@ class TestB3dm:
         glb = convert.to_glb(delft.j)
         b3dm = convert.to_b3dm(delft, glb)
 
+    def test_batch_table(self, delft):
+        cm = copy.deepcopy(delft)
+        ids = list(cm.j["CityObjects"])
+        cm.j["CityObjects"][ids[0]]["attributes"]["storeys"] = 3
+        cm.j["CityObjects"][ids[1]]["attributes"]["storeys"] = 4
+        b3dm = cm.export2b3dm().getvalue()
+        header = np.frombuffer(b3dm[:28], dtype='<u4')
+        assert header[2] == len(b3dm)
+        assert all(n % 8 == 0 for n in (28 + header[3], 28 + header[3] + header[5]))
+        start = 28 + header[3]
+        bt = json.loads(b3dm[start:start + header[5]].decode('utf-8'))
+        body = b3dm[start + header[5]:start + header[5] + header[6]]
+        assert bt["measuredHeight"]["componentType"] == "DOUBLE"
+        heights = np.frombuffer(body, dtype='<f8', count=len(ids), offset=bt["measuredHeight"]["byteOffset"])
+        for theid, h in zip(ids, heights.tolist()):
+            v = cm.j["CityObjects"][theid]["attributes"].get("measuredHeight")
+            assert (v == h) if v is not None else np.isnan(h)
+        assert bt["storeys"]["componentType"] == "DOUBLE"
+        assert bt["lokaalid"] == [cm.j["CityObjects"][theid]["attributes"]["lokaalid"] for theid in ids]
+        assert b3dm[start + header[5] + header[6]:][:4] == b'glTF'
+
+    def test_batch_table_column(self):
+        assert convert.batch_table_column([1, 2, -3])[1] == "INT"
+        assert np.isnan(convert.batch_table_column([1, 2.5, None])[0][2])
+        assert convert.batch_table_column([1, "a"]) is None
+        assert convert.batch_table_column([True, False]) is None
+        assert convert.batch_table_column([None, None]) is None
+
+
 class Test3dtiles:
 
-    def test_export_3dtiles_cmd(self, data_dir, data_output_dir):
-        """Debugging"""
+    def test_export_tiles(self, delft, tmp_path):
+        cm = copy.deepcopy(delft)
+        ts = cm.export2tiles(str(tmp_path / 'serial'), max_features=50)
+        cm.export2tiles(str(tmp_path / 'parallel'), jobs=2, max_features=50)
+        with open(str(tmp_path / 'serial' / 'tileset.json')) as f:
+            assert json.load(f) == ts
+        uris = []
+        def visit(tile):
+            if "content" in tile:
+                assert tile["geometricError"] == 0
+                uris.append(tile["content"]["uri"])
+            for c in tile.get("children", []):
+                b, cb = tile["boundingVolume"]["box"], c["boundingVolume"]["box"]
+                for i in range(3):
+                    assert b[i] - b[3 + 4 * i] <= cb[i] - cb[3 + 4 * i] + 1e-9
+                    assert cb[i] + cb[3 + 4 * i] <= b[i] + b[3 + 4 * i] + 1e-9
+                visit(c)
+        visit(ts["root"])
+        assert len(uris) > 1
+        batch_length = 0
+        for uri in uris:
+            with open(str(tmp_path / 'serial' / uri), 'rb') as f:
+                b3dm = f.read()
+            with open(str(tmp_path / 'parallel' / uri), 'rb') as f:
+                assert f.read() == b3dm
+            n = int.from_bytes(b3dm[12:16], 'little')
+            batch_length += json.loads(b3dm[28:28 + n].decode('utf-8'))["BATCH_LENGTH"]
+        assert batch_length == sum(1 for co in delft.j["CityObjects"].values() if len(co.get("geometry", [])) > 0)
+
+    def test_export_tiles_ecef(self, delft, tmp_path):
+        cm = copy.deepcopy(delft)
+        ts = cm.export2tiles(str(tmp_path), max_features=50)
+        m = np.array(ts["root"]["transform"]).reshape(4, 4).T
+        #-- the centre of the model, in Delft
+        assert np.allclose(m[:3, :3].T.dot(m[:3, :3]), np.identity(3))
+        assert 6360000 < np.linalg.norm(m[:3, 3]) < 6370000
+        x, y, z = cityjson.get_transformer(7415, 4978).transform(84878.0, 447586.0, 8.0)
+        assert np.allclose(m[:3, 3], [x, y, z], atol=100)
+        #-- the box of the model around the origin, in metres
+        box = ts["root"]["boundingVolume"]["box"]
+        assert np.abs(box[:3]).max() < 5
+        assert np.allclose([box[3], box[7], box[11]], [262.2, 163.8, 8.6], atol=5)
+
+    def test_export_tiles_no_crs(self, delft, tmp_path, capsys):
+        cm = copy.deepcopy(delft)
+        del cm.j["metadata"]["referenceSystem"]
+        ts = cm.export2tiles(str(tmp_path), max_features=50)
+        assert "no CRS" in capsys.readouterr().out
+        m = np.array(ts["root"]["transform"]).reshape(4, 4).T
+        assert np.allclose(m[:3, :3], np.identity(3))
+        assert np.allclose(m[:3, 3], [84878.6535, 447586.8175, 8.197])
+
+    def test_export_3dtiles_cmd(self, data_dir, tmp_path):
         p = os.path.join(data_dir, 'delft.json')
         runner = CliRunner()
         result = runner.invoke(cjio.cli,
                                args=[p,
                                      'export',
                                      '--format', '3dtiles',
-                                     data_output_dir])
+                                     str(tmp_path)])
+        assert result.exit_code == 0
+        with open(str(tmp_path / 'tileset.json')) as f:
+            assert "transform" in json.load(f)["root"]
 
-    def test_export_3dtiles_partition_cmd(self, data_dir, data_output_dir):
+    def test_export_3dtiles_partition_cmd(self, data_dir, tmp_path):
         """Debugging"""
         p = os.path.join(data_dir, 'delft.json')
         runner = CliRunner()
@@ -48,4 +259,4 @@ class Test3dtiles:
                                      'partition',
                                      'export',
                                      '--format', '3dtiles',
-                                     data_output_dir])
\ No newline at end of file
+                                     str(tmp_path)])
\ No newline at end of file
@@ -2,7 +2,11 @@
 
 """
 import os
-from cjio import cityjson
+import copy
+import json
+import pytest
+from click.testing import CliRunner
+from cjio import cityjson, cjio, streaming
 from cjio.models import CityObject, Geometry
 
 class TestLoading:
@@ -29,3 +33,88 @@ class TestExport:
         cm = cityjson.load(p)
         df = cm.to_dataframe()
         assert len(df) == len(cm.cityobjects)
+
+def resolved(j):
+    """The CityObjects, with the coordinates of the vertices in their geometries"""
+    def replace(a):
+        return [replace(each) if isinstance(each, list) else j["vertices"][each] for each in a]
+    cos = {}
+    for theid, co in j["CityObjects"].items():
+        cos[theid] = dict(co, geometry=[{"type": g["type"], "lod": g.get("lod"), "boundaries": replace(g["boundaries"])}
+                                        for g in co.get("geometry", [])])
+    return cos
+
+
+class TestStreaming:
+    def test_iter_cityobjects(self, data_dir, delft):
+        p = os.path.join(data_dir, 'delft.json')
+        cos = dict(cityjson.iter_cityobjects(p))
+        assert cos == delft.j['CityObjects']
+
+    def test_root_properties(self, data_dir, dummy):
+        p = os.path.join(data_dir, 'dummy', 'dummy.json')
+        s = streaming.CityJSONStream(p)
+        assert list(s.keys()) == list(dummy.j.keys())
+        assert s.vertices == dummy.j['vertices']
+        assert s.metadata == dummy.j['metadata']
+        assert "CityObjects" not in s.header()
+
+    def test_small_chunks(self, data_dir, zurich_subset, monkeypatch):
+        monkeypatch.setattr(streaming, 'CHUNK_SIZE', 17)
+        p = os.path.join(data_dir, 'zurich', 'zurich_subset_lod2.json')
+        s = streaming.CityJSONStream(p)
+        assert dict(s.iter_cityobjects()) == zurich_subset.j['CityObjects']
+        assert s.vertices == zurich_subset.j['vertices']
+
+    def test_vertices_at(self, data_dir, zurich_subset, monkeypatch):
+        monkeypatch.setattr(streaming, 'CHUNK_SIZE', 17)
+        p = os.path.join(data_dir, 'zurich', 'zurich_subset_lod2.json')
+        s = streaming.CityJSONStream(p)
+        vs = zurich_subset.j['vertices']
+        indices = [0, 1, 5, 6, 100, len(vs) - 1]
+        assert s.vertices_at(indices) == [vs[i] for i in indices]
+        assert s.vertices_at([]) == []
+        with pytest.raises(IndexError):
+            s.vertices_at([len(vs)])
+
+    def test_subset_decodes_used_vertices(self, data_dir, delft, monkeypatch, tmp_path):
+        get = streaming.CityJSONStream.get
+        def get_root(self, key, default=None):
+            assert key not in ("CityObjects", "vertices")
+            return get(self, key, default)
+        monkeypatch.setattr(streaming.CityJSONStream, 'get', get_root)
+        p = os.path.join(data_dir, 'delft.json')
+        theid = next(iter(delft.j['CityObjects']))
+        s = cityjson.get_subset_ids_stream(streaming.CityJSONStream(p), [theid])
+        assert resolved(s.j) == resolved(copy.deepcopy(delft).get_subset_ids([theid]).j)
+        assert len(s.j['vertices']) < len(delft.j['vertices'])
+
+    def test_info_same_as_loaded(self, data_dir, dummy):
+        p = os.path.join(data_dir, 'dummy', 'dummy.json')
+        for long in (False, True):
+            assert cityjson.get_info_stream(streaming.CityJSONStream(p), long) == dummy.get_info(long)
+
+    def test_commands_not_loading(self, data_dir, dummy, monkeypatch, tmp_path):
+        def fail(*args, **kwargs):
+            raise AssertionError("the whole file is loaded")
+        monkeypatch.setattr(cityjson.CityJSON, 'read', fail)
+        get = streaming.CityJSONStream.get
+        def get_root(self, key, default=None):
+            assert key != "CityObjects"
+            return get(self, key, default)
+        monkeypatch.setattr(streaming.CityJSONStream, 'get', get_root)
+        p = os.path.join(data_dir, 'dummy', 'dummy.json')
+        runner = CliRunner()
+        result = runner.invoke(cjio.cli, args=[p, 'info', '--long'])
+        assert result.exit_code == 0
+        assert '"vertices_total": %d' % len(dummy.j["vertices"]) in result.output
+        p_out = str(tmp_path / 'subset.json')
+        result = runner.invoke(cjio.cli, args=[p, 'subset', '--id', 'mygroup1', 'save', p_out])
+        assert result.exit_code == 0
+        with open(p_out) as fin:
+            j = json.load(fin)
+        #-- the vertices are numbered in the order of a set of IDs
+        assert resolved(j) == resolved(copy.deepcopy(dummy).get_subset_ids(['mygroup1']).j)
+        #-- info after another command needs the city model
+        result = runner.invoke(cjio.cli, args=[p, 'remove_textures', 'info'])
+        assert isinstance(result.exception, AssertionError)
@@ -0,0 +1,217 @@
+"""Merge of city models written to a file
+
+"""
+import copy
+import json
+import os.path
+from io import StringIO
+
+from click.testing import CliRunner
+
+from cjio import cityjson, cjio, merging
+
+
+def coordinates(cm, theid):
+    """The boundaries of the geometries of a CityObject, with the coordinates"""
+    def replace(a):
+        return [replace(each) if isinstance(each, list) else cm.j["vertices"][each] for each in a]
+    return [replace(g["boundaries"]) for g in cm.j["CityObjects"][theid].get("geometry", [])]
+
+
+class TestMergeWriter:
+    def test_same_as_merge(self, rotterdam_subset, dummy):
+        ids = list(rotterdam_subset.j["CityObjects"])
+        cms = [rotterdam_subset.get_subset_ids(ids[:5]),
+               rotterdam_subset.get_subset_ids(ids[5:]),
+               dummy]
+        merged = copy.deepcopy(cms[0])
+        merged.merge(copy.deepcopy(cms[1:]))
+        out = StringIO()
+        writer = merging.MergeWriter(out)
+        for cm in copy.deepcopy(cms):
+            writer.add(cm)
+        writer.close()
+        j = json.loads(out.getvalue())
+        assert sorted(j) == sorted(merged.j)
+        for k in j:
+            if k != "metadata":
+                assert j[k] == merged.j[k]
+        assert writer.duplicates == []
+        #-- the lineage of the merge, and the extent of all the city models
+        def lineage(metadata):
+            return [(l["processStep"]["description"], l.get("featureIDs"), l.get("source"))
+                    for l in metadata["lineage"]]
+        assert len(j["metadata"]["lineage"]) > 0
+        assert lineage(j["metadata"]) == lineage(merged.j["metadata"])
+        merged.update_bbox()
+        assert j["metadata"]["geographicalExtent"] == merged.j["metadata"]["geographicalExtent"]
+
+    def test_first_not_modified(self, data_dir):
+        with open(os.path.join(data_dir, 'dummy', 'dummy.json'), 'r') as fin:
+            cm = cityjson.CityJSON(file=fin)
+        before = copy.deepcopy(cm.j)
+        writer = merging.MergeWriter(StringIO())
+        writer.add(cm)
+        writer.close()
+        assert cm.j == before
+
+    def test_duplicates(self, dummy):
+        out = StringIO()
+        writer = merging.MergeWriter(out)
+        for cm in (copy.deepcopy(dummy), copy.deepcopy(dummy)):
+            writer.add(cm)
+        writer.close()
+        j = json.loads(out.getvalue())
+        assert list(j["CityObjects"]) == list(dummy.j["CityObjects"])
+        assert writer.duplicates == list(dummy.j["CityObjects"])
+        assert len(j["vertices"]) == len(dummy.j["vertices"])
+        assert len(j["geometry-templates"]["templates"]) == 2 * len(dummy.j["geometry-templates"]["templates"])
+
+    def test_duplicates_vertices(self, rotterdam_subset):
+        ids = list(rotterdam_subset.j["CityObjects"])
+        #-- the subsets share the CityObjects of the city model
+        cms = [copy.deepcopy(rotterdam_subset).get_subset_ids(ids[:5]),
+               copy.deepcopy(rotterdam_subset).get_subset_ids(ids[3:])]
+        for numpy in (True, False):
+            if not numpy:
+                merging.MODULE_NUMPY_AVAILABLE = False
+            try:
+                out = StringIO()
+                writer = merging.MergeWriter(out)
+                for cm in copy.deepcopy(cms):
+                    writer.add(cm)
+                writer.close()
+            finally:
+                merging.MODULE_NUMPY_AVAILABLE = True
+            assert sorted(writer.duplicates) == sorted(ids[3:5])
+            result = cityjson.CityJSON(j=json.loads(out.getvalue()))
+            #-- no orphans, and the geometries have the same coordinates
+            assert result.remove_orphan_vertices() == 0
+            expected = copy.deepcopy(rotterdam_subset)
+            expected.decompress()
+            for theid in ids:
+                assert coordinates(result, theid) == coordinates(expected, theid)
+
+    def test_merge_output_cmd(self, data_dir, tmp_path):
+        p = os.path.join(data_dir, 'rotterdam', 'rotterdam_subset.json')
+        p_out = str(tmp_path / 'merged.json')
+        runner = CliRunner()
+        result = runner.invoke(cjio.cli,
+                               args=[os.path.join(data_dir, 'dummy', 'dummy.json'),
+                                     'merge', '--output', p_out, p])
+        assert result.exit_code == 0
+        with open(p_out) as fin:
+            j = json.load(fin)
+        with open(p) as fin:
+            assert len(j["CityObjects"]) == len(json.load(fin)["CityObjects"]) + 10
+
+
+class TestParse:
+    def test_load(self, data_dir):
+        p = os.path.join(data_dir, 'rotterdam', 'rotterdam_subset.json')
+        cm = merging.load(merging.parse(p))
+        #-- the boundaries are written by the next update
+        bi = cm.get_boundary_index()
+        assert bi.pending
+        assert all(g["boundaries"] is None for g in bi.geometries)
+        bi.update(bi.flat)
+        assert not bi.pending
+        with open(p, 'r') as fin:
+            expected = cityjson.CityJSON(file=fin)
+        expected.decompress()
+        assert cm.j == expected.j
+        assert cm.get_boundary_index().flat.tolist() == expected.get_boundary_index().flat.tolist()
+
+    def test_iter_parsed(self, data_dir):
+        paths = [os.path.join(data_dir, 'rotterdam', 'rotterdam_subset.json'),
+                 os.path.join(data_dir, 'dummy', 'dummy.json'),
+                 os.path.join(data_dir, 'rotterdam', 'rotterdam_one.json')]
+        cms = list(merging.iter_parsed(paths, 2))
+        assert [cm.path for cm in cms] == paths
+
+    def test_writer(self, data_dir):
+        paths = [os.path.join(data_dir, 'dummy', 'dummy.json'),
+                 os.path.join(data_dir, 'rotterdam', 'rotterdam_subset.json')]
+        results = []
+        def read(p):
+            with open(p, 'r') as fin:
+                return cityjson.CityJSON(file=fin)
+        for cms in ([read(p) for p in paths], [merging.load(merging.parse(p)) for p in paths]):
+            out = StringIO()
+            writer = merging.MergeWriter(out)
+            for cm in cms:
+                writer.add(cm)
+            writer.close()
+            j = json.loads(out.getvalue())
+            del j["metadata"]
+            results.append(j)
+        assert results[0] == results[1]
+
+    def test_merge_jobs_cmd(self, data_dir, tmp_path):
+        p = os.path.join(data_dir, 'rotterdam', '*.json')
+        results = []
+        for jobs in ('1', '2'):
+            p_out = str(tmp_path / ('merged_%s.json' % jobs))
+            runner = CliRunner()
+            result = runner.invoke(cjio.cli,
+                                   args=[os.path.join(data_dir, 'dummy', 'dummy.json'),
+                                         'merge', '--jobs', jobs, p,
+                                         'save', p_out])
+            assert result.exit_code == 0
+            with open(p_out) as fin:
+                j = json.load(fin)
+            del j["metadata"]
+            results.append(j)
+        assert results[0] == results[1]
+
+
+class TestMergeCompressed:
+    def test_same_as_compress(self, rotterdam_subset, dummy):
+        ids = list(rotterdam_subset.j["CityObjects"])
+        cms = [rotterdam_subset.get_subset_ids(ids[:5]),
+               rotterdam_subset.get_subset_ids(ids[5:]),
+               dummy]
+        expected = copy.deepcopy(cms)
+        expected[0].merge(expected[1:])
+        expected[0].compress(3)
+        merged = copy.deepcopy(cms)
+        merged[0].merge(merged[1:], important_digits=3)
+        for k in ("CityObjects", "vertices", "transform"):
+            assert merged[0].j[k] == expected[0].j[k]
+
+    def test_shared_vertices(self, delft):
+        merged = copy.deepcopy(delft)
+        merged.merge([copy.deepcopy(delft)], important_digits=3)
+        expected = copy.deepcopy(delft)
+        expected.compress(3)
+        assert len(merged.j["vertices"]) == len(expected.j["vertices"])
+
+
+class TestMergeLoD:
+    def test_lod_key(self):
+        assert cityjson.lod_key(2) == cityjson.lod_key(2.0) == cityjson.lod_key("2") == "2"
+        assert cityjson.lod_key(2.2) == cityjson.lod_key("2.2") == "2.2"
+        assert cityjson.lod_key(None) is None
+
+    def test_merge_lods(self, delft):
+        theid = next(iter(delft.j["CityObjects"]))
+        cm = cityjson.CityJSON()
+        cm.j["CityObjects"][theid] = copy.deepcopy(delft.j["CityObjects"][theid])
+        cm.j["vertices"] = copy.deepcopy(delft.j["vertices"])
+        other = copy.deepcopy(cm)
+        g = other.j["CityObjects"][theid]["geometry"][0]
+        lod = g["lod"]
+        g["lod"] = str(lod)
+        g2 = copy.deepcopy(g)
+        g2["lod"] = 2.2
+        other.j["CityObjects"][theid]["geometry"].append(g2)
+        again = copy.deepcopy(other)
+        cm.merge([other, again])
+        assert [cityjson.lod_key(g["lod"]) for g in cm.j["CityObjects"][theid]["geometry"]] == [cityjson.lod_key(lod), "2.2"]
+
+    def test_merge_instances(self, dummy):
+        cm = copy.deepcopy(dummy)
+        cm.merge([copy.deepcopy(dummy)])
+        geoms = cm.j["CityObjects"]["onebigtree-template"]["geometry"]
+        assert [g["template"] for g in geoms] == [0]
+        assert len(cm.j["geometry-templates"]["templates"]) == 4
@@ -0,0 +1,84 @@
+"""Execution of the chain of commands, with the vertex operations done together
+
+"""
+import copy
+import json
+import os.path
+
+from click.testing import CliRunner
+
+from cjio import cjio, pipeline
+
+
+def vertex_step(*ops):
+    return pipeline.Step(vertex_ops=list(ops), message='test', warning='already compressed')
+
+
+CHAINS = [
+    [("duplicates", 3), ("orphans",)],
+    [("duplicates", 3), ("orphans",), ("compress", 3)],
+    [("orphans",), ("orphans",), ("duplicates", 2)],
+    [("compress", 2), ("duplicates", 3), ("orphans",), ("compress", 3)],
+    [("duplicates", 1), ("compress", 3), ("orphans",)],
+]
+
+
+class TestPipeline:
+    def test_same_as_eager(self, delft, dummy, cube_compressed):
+        for cm in (delft, dummy, cube_compressed):
+            for chain in CHAINS:
+                steps = [vertex_step(op) for op in chain]
+                expected = copy.deepcopy(cm)
+                for step in steps:
+                    expected = step(expected)
+                result = pipeline.execute(steps, copy.deepcopy(cm))
+                assert json.dumps(result.j) == json.dumps(expected.j)
+
+    def test_boundaries_written_once(self, delft):
+        cm = copy.deepcopy(delft)
+        bi = cm.get_boundary_index()
+        updates = []
+        update = bi.update
+        bi.update = lambda flat: updates.append(flat) or update(flat)
+        pipeline.execute([vertex_step(("duplicates", 3), ("orphans",)),
+                          pipeline.Step(lambda cm: cm, reads=["metadata"], writes=["metadata"]),
+                          vertex_step(("compress", 3)),
+                          vertex_step(("orphans",))], cm)
+        assert len(updates) == 1
+        assert "transform" in cm.j
+
+    def test_barrier(self, delft):
+        cm = copy.deepcopy(delft)
+        seen = []
+        pipeline.execute([vertex_step(("compress", 3)),
+                          lambda cm: seen.append("transform" in cm.j) or cm], cm)
+        assert seen == [True]
+
+    def test_redundant(self, delft):
+        cm = copy.deepcopy(delft)
+        plan = pipeline.VertexPlan(cm)
+        assert plan.apply(("compress", 3)) is True
+        v = plan.v
+        assert plan.apply(("orphans",)) == 0
+        assert plan.apply(("duplicates", 3)) == 0
+        assert plan.apply(("compress", 3)) is False
+        assert plan.v is v
+
+    def test_clean_compress_cmd(self, data_dir, tmp_path):
+        p = os.path.join(data_dir, 'delft.json')
+        p_out = str(tmp_path / 'delft_clean_compress.json')
+        runner = CliRunner()
+        result = runner.invoke(cjio.cli,
+                               args=[p, 'clean', 'compress', 'remove_orphan_vertices', 'compress', 'save', p_out])
+        assert result.exit_code == 0
+        assert "already compressed" in result.output
+        with open(p, 'r') as fin:
+            expected = cjio.cityjson.CityJSON(file=fin)
+        expected.remove_duplicate_vertices(3)
+        expected.remove_orphan_vertices()
+        expected.compress(3)
+        with open(p_out, 'r') as fin:
+            j = json.load(fin)
+        assert j["vertices"] == expected.j["vertices"]
+        assert j["transform"] == expected.j["transform"]
+        assert j["CityObjects"] == expected.j["CityObjects"]
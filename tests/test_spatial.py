@@ -0,0 +1,62 @@
+"""Spatial index of the CityObjects
+
+"""
+import copy
+
+import numpy as np
+
+from cjio import cityjson, spatial
+
+
+class TestSpatialIndex:
+    def test_query(self, delft):
+        cm = copy.deepcopy(delft)
+        si = cm.get_spatial_index()
+        bbox = [84800, 447500, 85000, 447700]
+        expected = []
+        for coid in cm.j["CityObjects"]:
+            c = cm.get_centroid(coid)
+            if c is not None and bbox[0] <= c[0] < bbox[2] and bbox[1] <= c[1] < bbox[3]:
+                expected.append(coid)
+        assert si.query(bbox) == expected
+        assert si.query([0, 0, 1, 1]) == []
+        assert cm.get_spatial_index() is si
+
+    def test_invalidated(self, delft, monkeypatch):
+        cm = copy.deepcopy(delft)
+        si = cm.get_spatial_index()
+        #-- the vertices are not read again to know the index is current
+        monkeypatch.setattr(cityjson.CityJSON, 'get_vertices_array', None)
+        assert cm.get_spatial_index() is si
+        monkeypatch.undo()
+        bbox = [84800, 447500, 85000, 447700]
+        cm.translate([1000, 0, 0], False)
+        si2 = cm.get_spatial_index()
+        assert si2 is not si
+        assert si2.query([bbox[0] + 1000, bbox[1], bbox[2] + 1000, bbox[3]]) == si.query(bbox)
+        cm.remove_duplicate_vertices(0)
+        si3 = cm.get_spatial_index()
+        assert si3 is not si2
+        cm.j["transform"] = {"scale": [2, 2, 2], "translate": [0, 0, 0]}
+        assert np.allclose(cm.get_spatial_index().points, si3.points * 2)
+
+    def test_empty(self):
+        si = spatial.SpatialIndex([], [])
+        assert si.query([0, 0, 1, 1]) == []
+
+    def test_sidecar(self, delft, tmp_path):
+        cm = copy.deepcopy(delft)
+        cm.path = str(tmp_path / 'delft.json')
+        si = cm.get_spatial_index(sidecar=True)
+        p = spatial.sidecar_path(cm.path)
+        si2 = spatial.SpatialIndex.load(p, si.key)
+        assert si2.ids == si.ids
+        assert (si2.points == si.points).all()
+        assert spatial.SpatialIndex.load(p, 'another key') is None
+        #-- the same number of vertices and boundaries, two of them swapped
+        theid = next(theid for theid, co in cm.j["CityObjects"].items() if "geometry" in co)
+        g = cm.j["CityObjects"][theid]["geometry"][0]
+        g["boundaries"] = copy.deepcopy(g["boundaries"])
+        b = g["boundaries"][0][0]
+        b[0], b[1] = b[1], b[0]
+        assert cm._spatial_key() != si.key
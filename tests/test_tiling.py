@@ -0,0 +1,37 @@
+"""Partition of the CityObjects in tiles
+
+"""
+import numpy as np
+
+from cjio import tiling
+
+
+class TestQuadtree:
+    def test_quadtree(self):
+        points = np.random.RandomState(1).uniform(0, 100, (1000, 2))
+        root = tiling.quadtree(points, max_features=30)
+        leaves = tiling.leaves(root)
+        assert sorted(np.concatenate([l["indices"] for l in leaves]).tolist()) == list(range(1000))
+        assert max(len(l["indices"]) for l in leaves) <= 30
+
+    def test_same_points(self):
+        root = tiling.quadtree(np.zeros((50, 2)), max_features=10)
+        assert sum(len(l["indices"]) for l in tiling.leaves(root)) == 50
+
+    def test_tileset(self):
+        bboxes = np.array([[0, 0, 0, 1, 1, 1], [10, 10, 0, 11, 12, 3]], dtype=float)
+        root = tiling.quadtree((bboxes[:, :2] + bboxes[:, 3:5]) / 2, max_features=1)
+        ts = tiling.tileset(root, bboxes, ['a.b3dm', 'b.b3dm'])
+        assert ts["root"]["boundingVolume"]["box"] == [5.5, 6, 1.5, 5.5, 0, 0, 0, 6, 0, 0, 0, 1.5]
+        assert [c["content"]["uri"] for c in ts["root"]["children"]] == ['a.b3dm', 'b.b3dm']
+        assert ts["root"]["children"][1]["boundingVolume"]["box"][:3] == [10.5, 11, 1.5]
+
+    def test_root_transform(self):
+        axes = tiling.enu_axes(90, 0)
+        assert np.allclose(axes, [[-1, 0, 0], [0, 0, 1], [0, 1, 0]])
+        m = np.array(tiling.root_transform(axes, [0, 6378137, 0])).reshape(4, 4).T
+        #-- up, 1 m above the origin
+        assert np.allclose(m.dot([0, 0, 1, 1]), [0, 6378138, 0, 1])
+        ts = tiling.tileset({"indices": np.array([0]), "children": []}, np.zeros((1, 6)), ['a.b3dm'],
+                            tiling.root_transform(axes, [0, 6378137, 0]))
+        assert len(ts["root"]["transform"]) == 16
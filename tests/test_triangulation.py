@@ -0,0 +1,64 @@
+"""Cache of the triangulation of the geometries
+
+"""
+import copy
+
+import numpy as np
+
+from cjio import triangulation
+
+
+class TestTriangulation:
+    def test_reuse(self, delft):
+        cm = copy.deepcopy(delft)
+        triangles, normals, offsets = cm.get_triangulation()
+        tr = cm._triangulation
+        entries = dict(tr.entries)
+        again = cm.get_triangulation()
+        assert np.array_equal(again[0], triangles)
+        assert all(tr.entries[slot][1] is e[1] for slot, e in entries.items())
+
+    def test_invalidate(self, delft):
+        cm = copy.deepcopy(delft)
+        cm.get_triangulation()
+        entries = dict(cm._triangulation.entries)
+        theid = next(iter(cm.j["CityObjects"]))
+        g = cm.j["CityObjects"][theid]["geometry"][0]
+        g["boundaries"] = copy.deepcopy(g["boundaries"])
+        g["boundaries"][0][0].reverse()
+        triangles, normals, offsets = cm.get_triangulation()
+        for slot, e in cm._triangulation.entries.items():
+            assert (e[1] is entries[slot][1]) == (slot != (theid, 0))
+        cm._triangulation = None
+        fresh = cm.get_triangulation()
+        for a, b in zip(fresh, (triangles, normals, offsets)):
+            assert np.array_equal(a, b)
+
+    def test_sidecar(self, delft, tmp_path):
+        cm = copy.deepcopy(delft)
+        cm.path = str(tmp_path / 'delft.json')
+        triangles, normals, offsets = cm.get_triangulation(sidecar=True)
+        tr = triangulation.Triangulation()
+        assert tr.read(triangulation.sidecar_path(cm.path))
+        assert len(tr.stored) == len(set(e[0] for e in cm._triangulation.entries.values()))
+        cm2 = copy.deepcopy(delft)
+        cm2.path = cm.path
+        cm2._triangulation = tr
+        again = cm2.get_triangulation()
+        assert not tr.modified
+        assert np.array_equal(again[0], triangles)
+
+    def test_renumbered(self, delft):
+        cm = copy.deepcopy(delft)
+        triangles, normals, offsets = cm.get_triangulation()
+        entries = dict(cm._triangulation.entries)
+        #-- a vertex far away first: the other ones are renumbered, and the
+        #-- minx,miny changes
+        v = cm.get_vertices_array()
+        cm.set_vertices_array(np.vstack((v.min(axis=0) - 1000, v)))
+        bi = cm.get_boundary_index()
+        bi.update(bi.flat + 1)
+        again = cm.get_triangulation()
+        assert all(cm._triangulation.entries[slot][1] is e[1] for slot, e in entries.items())
+        assert np.array_equal(again[0], triangles + 1)
+        assert np.array_equal(again[1], normals)
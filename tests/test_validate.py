@@ -3,11 +3,80 @@
 """
 import pytest
 import copy
-from cjio import cityjson,models
+from cjio import cityjson,models,validation
 
 
 
 class TestValidate:
+    def test_schema_loaded_once(self, minimal, tmp_path):
+        b, js, v = minimal.fetch_schema()
+        b, js2, v = minimal.fetch_schema()
+        assert js is js2
+        assert validation.get_validator(js) is validation.get_validator(js2)
+        #-- pickled, and read back the same
+        validation._schemas.clear()
+        validation.set_schema_cache_dir(str(tmp_path))
+        try:
+            b, js3, v = minimal.fetch_schema()
+            assert len(list(tmp_path.iterdir())) == 1
+            validation._schemas.clear()
+            b, js4, v = minimal.fetch_schema()
+        finally:
+            validation.set_schema_cache_dir(None)
+        assert js4 is not js3
+        assert js4["properties"].keys() == js3["properties"].keys()
+        (isValid, woWarnings, es, ws) = minimal.validate()
+        assert isValid == True
+
+    def test_internal_consistency(self, dummy):
+        cm = copy.deepcopy(dummy)
+        cm.j["CityObjects"]["grp"] = {"type": "CityObjectGroup", "members": ["nope"], "geometry": []}
+        cm.j["vertices"].append(cm.j["vertices"][0])
+        b, js, v = cm.fetch_schema()
+        b, jsco = cm.fetch_schema_cityobjects()
+        isValid, woWarnings, es, ws = validation.internal_consistency(cm.j, js, jsco)
+        assert isValid == False
+        assert woWarnings == False
+        assert es == validation.parent_children_consistency(cm.j)[1] + \
+                     validation.wrong_vertex_index(cm.j)[1] + \
+                     validation.city_object_groups(cm.j)[1] + \
+                     validation.semantics_array(cm.j)[1]
+        for w in validation.duplicate_vertices(cm.j)[1]:
+            assert w in ws
+
+    def test_duplicate_vertices(self, monkeypatch):
+        j = {"vertices": [[1, 2, 3], [1.0, 2.0, 3.0], [1.5, 2, 3], [1.5, 2.0, 3.0],
+                          [0.5, 0.25, 0.1], [-0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [0.5, 0.25, 0.1],
+                          [1, 2, 3]]}
+        b, ws = validation.duplicate_vertices(j)
+        assert b == False
+        assert ws == ['WARNING: there are 2 duplicate vertices in j["vertices"]',
+                      '\t(1 2 3)', '\t(0.5 0.25 0.1)']
+        monkeypatch.setattr(validation, 'MODULE_NUMPY_AVAILABLE', False)
+        assert sorted(validation.duplicate_vertices(j)[1]) == sorted(ws)
+
+    def test_checks_reported(self, dummy):
+        b, js, v = dummy.fetch_schema()
+        b, jsco = dummy.fetch_schema_cityobjects()
+        checks = []
+        validation.internal_consistency(dummy.j, js, jsco, report=checks.append)
+        assert checks == ["Vertex indices coherent", "Specific for CityGroups",
+                          "Semantic arrays coherent with geometry", "Root properties",
+                          "Empty geometries", "Duplicate vertices", "Orphan vertices",
+                          "CityGML attributes"]
+
+    def test_schema_jobs(self, cube):
+        cm = copy.deepcopy(cube)
+        co = cm.j["CityObjects"]["id-1"]
+        for i in range(4):
+            cm.j["CityObjects"]["copy-%d" % i] = copy.deepcopy(co)
+        cm.j["CityObjects"]["copy-2"]["type"] = "Foo"
+        b, js, v = cm.fetch_schema()
+        for longerr in (False, True):
+            re = validation.validate_against_schema(cm.j, js, longerr)
+            assert re[0] == False
+            assert validation.validate_against_schema(cm.j, js, longerr, jobs=2) == re
+
     def test_minimal(self, minimal):
         (isValid, woWarnings, es, ws) = minimal.validate()
         assert isValid == True